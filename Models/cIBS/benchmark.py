@@ -0,0 +1,220 @@
+import argparse
+import multiprocessing
+import subprocess
+import platform
+import resource
+import json
+import time
+import sys
+import numpy as np
+from os import cpu_count
+from visualsearch.grid import Grid
+from visualsearch.visibility_map import VisibilityMap
+from visualsearch.visual_searcher import VisualSearcher
+from visualsearch.models.trial_state import TrialState
+from scripts import loader, constants
+
+" Measures the throughput and peak memory of the search model on synthetic trials, with the supplied configuration, for each grid size and number of processes "
+" Each case runs in a process of its own, so that its peak memory isn't that of the cases which ran before it "
+" Results can be written to a JSON file and compared against those of another commit "
+
+# Timings compared between runs, with the key under which they're stored. Lower is better for all of them
+COMPARED_TIMINGS = [('visibility_map', 'visibility_map_time'), ('target_similarity', 'target_similarity_time'), \
+    ('next_fixation', 'time_per_saccade'), ('search', 'search_time_per_saccade')]
+
+def main(config_name, cell_size, grids_sizes, numbers_of_processes, batch_size, repetitions, max_saccades, seed, output_file, baseline_file):
+    config = loader.load_config(constants.CONFIG_DIR, config_name, 1, 1, batch_size, False, {})
+    config['cell_size'] = cell_size
+    if max_saccades is not None:
+        config['max_saccades'] = max_saccades
+
+    results = []
+    for grid_size in grids_sizes:
+        for number_of_processes in numbers_of_processes:
+            print('Grid size: ' + str(grid_size) + ', ' + str(number_of_processes) + ' process(es)...')
+            case_result = run_in_new_process(dict(config, proc_number=number_of_processes), grid_size, batch_size, repetitions, seed)
+            print_case(case_result)
+            results.append(case_result)
+
+    benchmark = {'environment' : environment(), 'config_name' : config_name, 'config' : config, 'trial_batch_size' : batch_size, \
+        'repetitions' : repetitions, 'seed' : seed, 'results' : results}
+    if output_file is not None:
+        with open(output_file, 'w') as json_file:
+            json.dump(benchmark, json_file, indent=4)
+        print('Results saved to ' + output_file)
+    if baseline_file is not None:
+        compare(loader.load_dict_from_json(baseline_file), benchmark)
+
+def run_in_new_process(config, grid_size, batch_size, repetitions, seed):
+    results_queue = multiprocessing.Queue()
+    # It isn't a daemon, since the search model may start a pool of processes of its own
+    case_process  = multiprocessing.Process(target=run_case, args=(results_queue, config, grid_size, batch_size, repetitions, seed))
+    case_process.start()
+    case_result = results_queue.get()
+    case_process.join()
+    if isinstance(case_result, Exception):
+        raise case_result
+
+    return case_result
+
+def run_case(results_queue, config, grid_size, batch_size, repetitions, seed):
+    " Executed in the process of the case. If it fails, the exception is put in the queue instead, so that the main process doesn't wait forever "
+    try:
+        results_queue.put(measure_case(config, grid_size, batch_size, repetitions, seed))
+    except Exception as error:
+        results_queue.put(error)
+
+def measure_case(config, grid_size, batch_size, repetitions, seed):
+    " Times the construction of the visibility map and the target similarity map, the computation of the next fixation and the whole search of a synthetic trial "
+    """ Output (dict). Fields:
+            grid_size, proc_number and number_of_cells
+            visibility_map_time, target_similarity_time (float) : seconds taken to build each of them, median of the repetitions
+            time_per_saccade (float)        : seconds taken by next_fixations, per trial, on a synthetic posterior. Median of the repetitions
+            search_time_per_saccade (float) : seconds taken by VisualSearcher.search on a synthetic trial, divided by the number of saccades it made
+            saccades_per_second (float)     : inverse of search_time_per_saccade
+            pairs_per_second (float)        : (candidate, target location) pairs evaluated per second by next_fixations
+            peak_rss, peak_rss_workers (float) : peak memory, in MB, of this process and of its largest worker
+    """
+    cell_size  = config['cell_size']
+    image_size = (grid_size[0] * cell_size, grid_size[1] * cell_size)
+    grid       = Grid(np.array(image_size), cell_size)
+
+    visibility_map_times = []
+    for _ in range(repetitions):
+        start = time.time()
+        visibility_map = VisibilityMap(image_size, grid, constants.SIGMA)
+        visibility_map_times.append(time.time() - start)
+
+    visual_searcher = VisualSearcher(config, grid, visibility_map, output_path=None)
+    try:
+        image, target, target_bbox, grid_prior, initial_fixation = synthetic_trial(image_size, grid, seed)
+        target_similarity_times = []
+        for _ in range(repetitions):
+            start = time.time()
+            visual_searcher.initialize_target_similarity_map('synthetic', image, target, target_bbox)
+            target_similarity_times.append(time.time() - start)
+
+        # Each saccade has its own posteriors, so that no result of previous saccades is reused
+        # Trials of the batch are searched in lockstep
+        trial_states    = [TrialState() for _ in range(batch_size)]
+        next_fixation_times = []
+        for repetition in range(repetitions):
+            posteriors = np.array([synthetic_posterior(grid, visibility_map, seed + repetition * batch_size + trial) for trial in range(batch_size)])
+            start = time.time()
+            visual_searcher.search_model.next_fixations(posteriors, trial_states)
+            next_fixation_times.append((time.time() - start) / batch_size)
+
+        start = time.time()
+        trial_scanpath = visual_searcher.search('synthetic', image_size, image, grid_prior, target, target_bbox, initial_fixation)
+        search_time    = time.time() - start
+    finally:
+        visual_searcher.close()
+
+    number_of_cells  = grid.size()[0] * grid.size()[1]
+    time_per_saccade = float(np.median(next_fixation_times))
+    # The last fixation isn't followed by a saccade
+    number_of_saccades = max(len(trial_scanpath['scanpath_x']) - 1, 1)
+    # ru_maxrss is given in kilobytes in Linux
+    return {'grid_size' : [int(size) for size in grid.size()], 'proc_number' : config['proc_number'], 'number_of_cells' : int(number_of_cells), \
+        'visibility_map_time' : float(np.median(visibility_map_times)), 'target_similarity_time' : float(np.median(target_similarity_times)), \
+        'time_per_saccade' : time_per_saccade, 'pairs_per_second' : number_of_cells ** 2 / time_per_saccade, \
+        'search_saccades' : number_of_saccades, 'search_time_per_saccade' : search_time / number_of_saccades, 'saccades_per_second' : number_of_saccades / search_time, \
+        'peak_rss' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 'peak_rss_workers' : resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+def synthetic_trial(image_size, grid, seed):
+    " Random search image, with the target cut next to its bottom right corner, a random prior and an initial fixation at the top left corner "
+    random_state = np.random.RandomState(seed)
+    image        = random_state.random_sample(image_size) * 255
+    target_size  = (min(image_size[0] // 4, 72), min(image_size[1] // 4, 72))
+    # The end of the bounding box has to fall inside the grid
+    target_bbox  = [image_size[0] - target_size[0] - 1, image_size[1] - target_size[1] - 1, image_size[0] - 1, image_size[1] - 1]
+    target       = image[target_bbox[0]:target_bbox[2], target_bbox[1]:target_bbox[3]].copy()
+    grid_prior   = random_state.random_sample(grid.size())
+
+    return image, target, target_bbox, grid_prior, (0, 0)
+
+def synthetic_posterior(grid, visibility_map, seed):
+    " Posterior after a single fixation at the center of the grid, with a random prior and random target similarity "
+    random_state = np.random.RandomState(seed)
+    grid_size    = grid.size()
+    fixation     = (grid_size[0] // 2, grid_size[1] // 2)
+    likelihood   = random_state.standard_normal(grid_size) * np.square(visibility_map.at_fixation(fixation))
+    posterior    = random_state.random_sample(grid_size) * np.exp(likelihood)
+
+    return posterior / np.sum(posterior)
+
+def environment():
+    " Commit and machine on which the benchmark ran, so that results are only compared when they're comparable "
+    try:
+        commit = subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit' : commit, 'date' : time.strftime('%Y-%m-%d %H:%M:%S'), 'machine' : platform.machine(), 'processor' : platform.processor(), \
+        'cpu_count' : cpu_count(), 'python' : platform.python_version(), 'numpy' : np.__version__}
+
+def print_case(case_result):
+    print('Grid size: ' + str(tuple(case_result['grid_size'])) + ' (' + str(case_result['number_of_cells']) + ' cells), ' + str(case_result['proc_number']) + ' process(es)')
+    print('Visibility map: ' + str(round(case_result['visibility_map_time'], 4)) + ' seconds. Target similarity map: ' + str(round(case_result['target_similarity_time'], 4)) + ' seconds')
+    print('Time per saccade: ' + str(round(case_result['time_per_saccade'], 4)) + ' seconds (' + str(round(case_result['pairs_per_second'])) + ' (candidate, target location) pairs per second)')
+    print('Search: ' + str(round(case_result['saccades_per_second'], 2)) + ' saccades per second (' + str(case_result['search_saccades']) + ' saccades)')
+    print('Peak RSS: ' + str(round(case_result['peak_rss'], 1)) + ' MB (main process), ' + str(round(case_result['peak_rss_workers'], 1)) + ' MB (largest worker)\n')
+
+def compare(baseline, benchmark):
+    " Prints the speedup of each case over the one with the same grid size and number of processes in the baseline "
+    print('Speedup over ' + str(baseline['environment']['commit']) + ' (baseline time / current time)')
+    print('Grid size'.ljust(12) + ' Processes  ' + ''.join(name.ljust(19) for name, _ in COMPARED_TIMINGS) + 'Peak RSS (MB)')
+    baseline_results = {(tuple(result['grid_size']), result['proc_number']) : result for result in baseline['results']}
+    for result in benchmark['results']:
+        case = (tuple(result['grid_size']), result['proc_number'])
+        if case not in baseline_results:
+            continue
+        baseline_result = baseline_results[case]
+        speedups = ['{:.2f}x'.format(baseline_result[key] / result[key]) if result[key] > 0 else '-' for _, key in COMPARED_TIMINGS]
+        print((str(case[0][0]) + 'x' + str(case[0][1])).ljust(12) + ' ' + str(case[1]).ljust(10) + ' ' + ''.join(speedup.ljust(19) for speedup in speedups) \
+            + str(round(baseline_result['peak_rss'], 1)) + ' -> ' + str(round(result['peak_rss'], 1)))
+
+def grid_size_argument(value):
+    " Parses a grid size given as rows x columns (e.g. 24x32) "
+    try:
+        rows, columns = map(int, value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('Grid sizes must be given as rows x columns (e.g. 24x32)')
+
+    return (rows, columns)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the time per saccade, the throughput and the peak memory of the Visual Search model, for several grid sizes and numbers of processes')
+    parser.add_argument('--cfg', '--config', type=str, default='default', help='Name of configuration setup', metavar='cfg')
+    parser.add_argument('--size', '--image_size', type=int, nargs=2, default=[768, 1024], help='Height and width of the image, in pixels. Ignored if --grids is given', metavar='size')
+    parser.add_argument('--cell', '--cell_size', type=int, default=None, help='Size of the cells in the grid. Default is the one in the configuration', metavar='cell')
+    parser.add_argument('--grids', '--grid_sizes', type=grid_size_argument, nargs='+', default=None, \
+         help='Grid sizes to benchmark, as rows x columns (e.g. 12x16 24x32 48x64 66x106). Images are made so that their cells are of the size given', metavar='grids')
+    parser.add_argument('--m', '--multiprocess', nargs='*', default=['1'], \
+         help='Numbers of processes on which to run the model. Each one is benchmarked. Leave blank to use all cores available.')
+    parser.add_argument('--b', '--trial_batch_size', type=int, default=1, help='Number of trials whose next fixations are computed at once')
+    parser.add_argument('--r', '--repetitions', type=int, default=3, help='Number of times each measure is repeated. Their median is reported')
+    parser.add_argument('--s', '--max_saccades', type=int, default=None, help='Maximum number of saccades of the synthetic search. Default is the one in the configuration')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic trials')
+    parser.add_argument('--o', '--output', type=str, default=None, help='JSON file where to save the results')
+    parser.add_argument('--compare', type=str, default=None, help='JSON file with the results of a previous benchmark, whose cases are compared with these', metavar='compare')
+
+    args = parser.parse_args()
+
+    numbers_of_processes = []
+    for number_of_processes in (args.m if args.m else ['all']):
+        if number_of_processes == 'all':
+            numbers_of_processes.append(cpu_count())
+        elif not number_of_processes.isdigit() or int(number_of_processes) < 1:
+            print('Invalid value for --multiprocess argument')
+            sys.exit(-1)
+        else:
+            numbers_of_processes.append(int(number_of_processes))
+
+    config_cell_size = args.cell if args.cell is not None else loader.load_dict_from_json(constants.CONFIG_DIR + args.cfg + '.json')['cell_size']
+    if args.grids is not None:
+        grids_sizes = args.grids
+    else:
+        grids_sizes = [tuple(Grid(np.array(args.size), config_cell_size).size())]
+
+    main(args.cfg, config_cell_size, grids_sizes, numbers_of_processes, args.b, args.r, args.s, args.seed, args.o, args.compare)
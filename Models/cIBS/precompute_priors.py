@@ -0,0 +1,46 @@
+import argparse
+import sys
+from os import path
+from visualsearch.utils import utils
+from visualsearch.utils.deepgaze.create_saliencymap import create_saliencymaps
+from scripts import loader, constants
+
+" Creates the DeepGaze II saliency maps, used as prior, of every image of the dataset which doesn't have one yet "
+" DeepGaze II is loaded once, and images go through it in batches "
+
+# Number of batches of images loaded in background threads while the current one goes through DeepGaze II
+PREFETCHED_BATCHES = 2
+
+def main(image_name, image_range, batch_size):
+    dataset_info      = loader.load_dataset_info(constants.DATASET_INFO_FILE)
+    trials_properties = loader.load_trials_properties(dataset_info['trials_properties_file'], image_name, image_range, {})
+    image_size        = (dataset_info['image_height'], dataset_info['image_width'])
+    prior_path        = dataset_info['saliency_dir'] + 'deepgaze/'
+
+    # Each image is searched in as many trials as targets it has
+    images_names   = list(dict.fromkeys(trial['image'] for trial in trials_properties))
+    missing_images = [image_name for image_name in images_names if not path.exists(path.join(prior_path, image_name))]
+    print(str(len(images_names) - len(missing_images)) + '/' + str(len(images_names)) + ' saliency maps were already created')
+    if not missing_images:
+        return
+
+    # Images are resized to the size of the dataset, as they are when searched
+    images = utils.prefetch(lambda image_name: utils.load_image(dataset_info['images_dir'], image_name, image_size), missing_images, PREFETCHED_BATCHES * batch_size)
+    create_saliencymaps(images, [path.join(prior_path, image_name) for image_name in missing_images], batch_size)
+    print('Created ' + str(len(missing_images)) + ' saliency maps at ' + prior_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create the DeepGaze II saliency maps of the dataset which are missing')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--img', '--image_name', type=str, default=None, help='Name of the image whose saliency map to create', metavar='img')
+    group.add_argument('--rng', '--range', type=int, nargs=2, default=None, help='Range of image numbers whose saliency maps to create. \
+         For example, 1 100 creates those of the image 1 through 100', metavar='rng')
+    parser.add_argument('--b', '--batch_size', type=int, default=8, help='Number of images which go through DeepGaze II at once. Default is 8')
+
+    args = parser.parse_args()
+
+    if args.b < 1:
+        print('Invalid value for --batch_size argument')
+        sys.exit(-1)
+
+    main(args.img, args.rng, args.b)
@@ -0,0 +1,47 @@
+import argparse
+import sys
+from visualsearch import sweep
+from scripts import loader, constants
+
+" Runs visualsearch/sweep.py according to the supplied parameters "
+
+def main(sweep_name, image_name, image_range, number_of_processes, number_of_trial_processes, trial_batch_size, save_probability_maps):
+    dataset_info      = loader.load_dataset_info(constants.DATASET_INFO_FILE)
+    output_path       = loader.create_output_folders(dataset_info['save_path'] + 'sweeps/' + sweep_name, sweep_name, image_name, image_range)
+    configs           = loader.load_sweep_configs(constants.CONFIG_DIR, sweep_name, number_of_processes, number_of_trial_processes, trial_batch_size, save_probability_maps)
+    trials_properties = loader.load_trials_properties(dataset_info['trials_properties_file'], image_name, image_range, {})
+
+    sweep.run(configs, dataset_info, trials_properties, output_path, constants.SIGMA)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Run the Visual Search model with every configuration of a sweep, computing what they share once')
+    parser.add_argument('--sweep', type=str, default='calibration', help='Name of the sweep, in configs/sweeps. It specifies a base configuration \
+        and the values of each parameter to try. Every combination of them is run', metavar='sweep')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--img', '--image_name', type=str, default=None, help='Name of the image on which to run the model', metavar='img')
+    group.add_argument('--rng', '--range', type=int, nargs=2, default=None, help='Range of image numbers on which to run the model. \
+         For example, 1 100 runs the model on the image 1 through 100', metavar='rng')
+    parser.add_argument('--m', '--multiprocess', nargs='?', const='all', default=1, \
+         help='Number of processes on which to run the model. Leave blank to use all cores available.')
+    parser.add_argument('--t', '--trial_processes', nargs='?', const='all', default=1, \
+         help='Number of processes on which to search different trials at the same time, with every configuration. Leave blank to use all cores available. \
+             Saccades are not parallelized when searching more than one trial at a time.')
+    parser.add_argument('--b', '--trial_batch_size', type=int, default=1, \
+         help='Number of trials searched in lockstep by each process, whose next fixations are computed at once. Default is 1')
+    parser.add_argument('--s', '--save_prob_map', action='store_true', \
+         help='Save probability map for each saccade')
+
+    args = parser.parse_args()
+
+    if (isinstance(args.m, str) and args.m != 'all') and int(args.m) < 1:
+        print('Invalid value for --multiprocess argument')
+        sys.exit(-1)
+    if (isinstance(args.t, str) and args.t != 'all') and int(args.t) < 1:
+        print('Invalid value for --trial_processes argument')
+        sys.exit(-1)
+    if args.b < 1:
+        print('Invalid value for --trial_batch_size argument')
+        sys.exit(-1)
+
+    main(args.sweep, args.img, args.rng, args.m, args.t, args.b, args.s)
@@ -5,11 +5,11 @@ from scripts import loader, constants
 
 " Runs visualsearch/main.py according to the supplied parameters "
 
-def main(config_name, image_name, image_range, number_of_processes, save_probability_maps):
+def main(config_name, image_name, image_range, number_of_processes, number_of_trial_processes, trial_batch_size, save_probability_maps):
     dataset_info      = loader.load_dataset_info(constants.DATASET_INFO_FILE)
     output_path       = loader.create_output_folders(dataset_info['save_path'], config_name, image_name, image_range)
     checkpoint        = loader.load_checkpoint(output_path)
-    config            = loader.load_config(constants.CONFIG_DIR, config_name, number_of_processes, save_probability_maps, checkpoint)
+    config            = loader.load_config(constants.CONFIG_DIR, config_name, number_of_processes, number_of_trial_processes, trial_batch_size, save_probability_maps, checkpoint)
     trials_properties = loader.load_trials_properties(dataset_info['trials_properties_file'], image_name, image_range, checkpoint)
 
     visualsearch.run(config, dataset_info, trials_properties, output_path, constants.SIGMA)
@@ -25,6 +25,11 @@ if __name__ == "__main__":
          For example, 1 100 runs the model on the image 1 through 100', metavar='rng')
     parser.add_argument('--m', '--multiprocess', nargs='?', const='all', default=1, \
          help='Number of processes on which to run the model. Leave blank to use all cores available.')
+    parser.add_argument('--t', '--trial_processes', nargs='?', const='all', default=1, \
+         help='Number of processes on which to search different trials at the same time. Leave blank to use all cores available. \
+             Saccades are not parallelized when searching more than one trial at a time.')
+    parser.add_argument('--b', '--trial_batch_size', type=int, default=1, \
+         help='Number of trials searched in lockstep by each process, whose next fixations are computed at once. Default is 1')
     parser.add_argument('--s', '--save_prob_map', action='store_true', \
          help='Save probability map for each saccade')
 
@@ -33,5 +38,11 @@ if __name__ == "__main__":
     if (isinstance(args.m, str) and args.m != 'all') and int(args.m) < 1:
         print('Invalid value for --multiprocess argument')
         sys.exit(-1)
+    if (isinstance(args.t, str) and args.t != 'all') and int(args.t) < 1:
+        print('Invalid value for --trial_processes argument')
+        sys.exit(-1)
+    if args.b < 1:
+        print('Invalid value for --trial_batch_size argument')
+        sys.exit(-1)
 
-    main(args.cfg, args.img, args.rng, args.m, args.s)
\ No newline at end of file
+    main(args.cfg, args.img, args.rng, args.m, args.t, args.b, args.s)
\ No newline at end of file
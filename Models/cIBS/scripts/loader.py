@@ -1,34 +1,54 @@
 import json
-from os import makedirs, path, remove, cpu_count
+import itertools
+from os import makedirs, cpu_count
+from visualsearch.utils import checkpoint_log
+
+# Values of the configuration fields which previous versions didn't have, with which they behaved as they did
+# Configurations resumed from their checkpoints lack them
+CONFIG_DEFAULTS = {'engine' : 'loop', 'quadrature' : 'trapezoid', 'quadrature_nodes' : 50, 'quadrature_tolerance' : 1e-6, 'norm_cdf_backend' : 'table', \
+    'posterior_pruning_epsilon' : 0, 'candidate_screening' : 0, 'screening_validation' : False, 'branch_and_bound' : False, \
+    'precision' : 'float64', 'precision_validation' : False, 'probability_maps_dtype' : 'float64'}
 
 def load_checkpoint(output_path):
     checkpoint = {}
-    checkpoint_file = output_path + 'checkpoint.json'
-    if path.exists(checkpoint_file):
+    if checkpoint_log.legacy_exists(output_path):
+        if checkpoint_log.exists(output_path):
+            print('Warning: ' + checkpoint_log.LEGACY_CHECKPOINT_FILE + ' of a previous version is ignored, since ' + checkpoint_log.CHECKPOINT_FILE + ' was found')
+        else:
+            checkpoint_log.convert_legacy(output_path)
+            print('Checkpoint of a previous version converted to ' + checkpoint_log.CHECKPOINT_FILE)
+    if checkpoint_log.exists(output_path):
         answer = input('Checkpoint found! Resume execution? (Y/N): ').upper()
-        if answer not in ['Y', 'N']:
+        while answer not in ['Y', 'N']:
             print('Invalid answer. Please try again')
-            load_checkpoint(output_path)
+            answer = input('Checkpoint found! Resume execution? (Y/N): ').upper()
         if answer == 'Y':
-            checkpoint = load_dict_from_json(checkpoint_file)
-            print('Checkpoint loaded. Resuming execution...\n')
+            checkpoint = checkpoint_log.replay(output_path)
+            print('Checkpoint loaded (' + str(len(checkpoint['scanpaths'])) + ' trials already searched). Resuming execution...\n')
         if answer == 'N':
-            remove(checkpoint_file)
+            checkpoint_log.erase(output_path)
             print('Checkpoint deleted\n')
     
     return checkpoint
 
-def load_config(config_dir, config_name, number_of_processes, save_probability_maps, checkpoint):
+def load_config(config_dir, config_name, number_of_processes, number_of_trial_processes, trial_batch_size, save_probability_maps, checkpoint):
     if checkpoint:
         config = checkpoint['configuration']
     else:
         config = load_dict_from_json(config_dir + config_name + '.json')
+    config = dict(CONFIG_DEFAULTS, **config)
 
     if number_of_processes == 'all':
         config['proc_number'] = cpu_count()
     else:
         config['proc_number'] = int(number_of_processes)
 
+    if number_of_trial_processes == 'all':
+        config['trial_processes'] = cpu_count()
+    else:
+        config['trial_processes'] = int(number_of_trial_processes)
+
+    config['trial_batch_size']      = trial_batch_size
     config['save_probability_maps'] = save_probability_maps
 
     print('%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%')
@@ -37,6 +57,17 @@ def load_config(config_dir, config_name, number_of_processes, save_probability_m
     else:
         print('Successfully loaded ' + config_name + '.json!')
     print('Search model: ' + config['search_model'])
+    print('Precision: ' + config['precision'] + (' (validated against float64)' if config['precision_validation'] and config['precision'] != 'float64' else ''))
+    if config['search_model'] == 'bayesian':
+        print('Bayesian engine: ' + config['engine'])
+        print('Quadrature: ' + config['quadrature'] + ' (' + str(config['quadrature_nodes']) + ' nodes)')
+        print('Normal cdf backend: ' + config['norm_cdf_backend'])
+        if config['posterior_pruning_epsilon'] > 0:
+            print('Posterior pruning epsilon: ' + str(config['posterior_pruning_epsilon']))
+        if config['candidate_screening'] > 0:
+            print('Candidate screening: top ' + str(config['candidate_screening']) + (' (validated)' if config['screening_validation'] else ''))
+        if config['branch_and_bound']:
+            print('Branch and bound is ENABLED')
     print('Target similarity: ' + config['target_similarity'])
     print('Prior: ' + config['prior'])
     print('Max. saccades: ' + str(config['max_saccades']))
@@ -44,15 +75,37 @@ def load_config(config_dir, config_name, number_of_processes, save_probability_m
     print('Scale factor: ' + str(config['scale_factor']))
     print('Additive shift: ' + str(config['additive_shift']))
     print('Random seed: ' + str(config['seed']))
-    if config['proc_number'] > 1:
+    if config['trial_processes'] > 1:
+        print('Searching ' + str(config['trial_processes']) + ' trials at a time')
+    elif config['proc_number'] > 1:
         print('Multiprocessing is ENABLED!')
     else:
         print('Multiprocessing is DISABLED')
+    if config['trial_batch_size'] > 1:
+        print('Trials are searched in batches of ' + str(config['trial_batch_size']) + ', in lockstep')
     if config['save_probability_maps']:
-        print('Probability maps will be saved for each saccade')
+        print('Probability maps will be saved for each saccade, in ' + config['probability_maps_dtype'])
     print('%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%\n')
     return config
 
+def load_sweep_configs(config_dir, sweep_name, number_of_processes, number_of_trial_processes, trial_batch_size, save_probability_maps):
+    " Builds a configuration for each combination of the values of the parameters in the sweep, on top of its base configuration "
+    """ Output:
+            configs (dict) : configurations indexed by name, which is made of the name and value of each parameter (e.g. scale_factor_3-additive_shift_4)
+    """
+    sweep       = load_dict_from_json(config_dir + 'sweeps/' + sweep_name + '.json')
+    base_config = load_config(config_dir, sweep['base'], number_of_processes, number_of_trial_processes, trial_batch_size, save_probability_maps, {})
+    parameters  = sweep['parameters']
+
+    configs = {}
+    for values in itertools.product(*parameters.values()):
+        config_values = dict(zip(parameters.keys(), values))
+        config_name   = '-'.join(parameter + '_' + str(value) for parameter, value in config_values.items())
+        configs[config_name] = dict(base_config, **config_values)
+
+    print('Sweep ' + sweep_name + ': ' + str(len(configs)) + ' configurations, over ' \
+        + ', '.join(parameter + ' (' + ', '.join(map(str, values)) + ')' for parameter, values in parameters.items()) + '\n')
+    return configs
 
 def load_dataset_info(dataset_info_file):
     return load_dict_from_json(dataset_info_file)
@@ -0,0 +1,73 @@
+import argparse
+import time
+import sys
+import numpy as np
+from visualsearch.grid import Grid
+from visualsearch.visibility_map import VisibilityMap
+from visualsearch.models.bayesian_model import BayesianModel
+from benchmark import synthetic_posterior, grid_size_argument
+from scripts import loader, constants
+
+" Checks that the loop and the vectorized engines of bayesian search give the same probability of being correct at every candidate, on synthetic posteriors "
+" The rest of the configuration (quadrature, normal cdf backend, precision) is the one supplied. Both engines run in a single process "
+" Exits with an error if they differ by more than the tolerance, or if they choose different fixations "
+
+def main(config_name, cell_size, grids_sizes, repetitions, seed, tolerance):
+    config = loader.load_dict_from_json(constants.CONFIG_DIR + config_name + '.json')
+    print('Configuration: ' + config_name + '. Quadrature: ' + config['quadrature'] + ' (' + str(config['quadrature_nodes']) + ' nodes), normal cdf backend: ' \
+        + config['norm_cdf_backend'] + ', precision: ' + config['precision'])
+
+    all_match = True
+    for grid_size in grids_sizes:
+        image_size     = (grid_size[0] * cell_size, grid_size[1] * cell_size)
+        grid           = Grid(np.array(image_size), cell_size)
+        visibility_map = VisibilityMap(image_size, grid, constants.SIGMA)
+        engines_times  = {'loop' : 0, 'vectorized' : 0}
+        max_absolute_difference, max_relative_difference, different_fixations = 0, 0, 0
+        for repetition in range(repetitions):
+            posterior  = synthetic_posterior(grid, visibility_map, seed + repetition)
+            candidates = [(row, column) for row in range(grid.size()[0]) for column in range(grid.size()[1])]
+            job        = (posterior.astype(config['precision']), np.arange(len(candidates)), candidates)
+
+            probability_of_being_correct = {}
+            for engine in engines_times:
+                search_model = initialize_model(config, grid.size(), visibility_map, engine)
+                start = time.time()
+                probability_of_being_correct[engine] = search_model.compute_probability_of_being_correct([job])[0]
+                engines_times[engine] += time.time() - start
+
+            absolute_difference     = np.abs(probability_of_being_correct['loop'] - probability_of_being_correct['vectorized'])
+            max_absolute_difference = max(max_absolute_difference, np.max(absolute_difference))
+            max_relative_difference = max(max_relative_difference, np.max(absolute_difference / np.abs(probability_of_being_correct['loop'])))
+            different_fixations    += np.argmax(probability_of_being_correct['loop']) != np.argmax(probability_of_being_correct['vectorized'])
+
+        grid_matches = max_relative_difference <= tolerance and not different_fixations
+        all_match    = all_match and grid_matches
+        print('Grid size: ' + str(tuple(int(size) for size in grid.size())) + '. Max. absolute difference: ' + '{:.3e}'.format(max_absolute_difference) + ', max. relative difference: ' \
+            + '{:.3e}'.format(max_relative_difference) + ', different fixations: ' + str(different_fixations) + ' of ' + str(repetitions) + ' -> ' + ('OK' if grid_matches else 'MISMATCH'))
+        print('Loop engine: ' + str(round(engines_times['loop'], 3)) + ' seconds. Vectorized engine: ' + str(round(engines_times['vectorized'], 3)) + ' seconds (' \
+            + '{:.2f}x'.format(engines_times['loop'] / engines_times['vectorized']) + ' speedup)\n')
+
+    if not all_match:
+        print('The engines differ by more than the tolerance (' + str(tolerance) + ')')
+        sys.exit(-1)
+    print('Both engines match')
+
+def initialize_model(config, grid_size, visibility_map, engine):
+    " Same model as the one VisualSearcher creates, with the given engine and without multiprocessing, screening nor branch and bound "
+    return BayesianModel(grid_size, visibility_map, config['norm_cdf_tolerance'], 1, engine, config['quadrature'], config['quadrature_nodes'], \
+        config['quadrature_tolerance'], config['norm_cdf_backend'], precision=config['precision'])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check that the loop and the vectorized engines of the Visual Search model compute the same probability of being correct')
+    parser.add_argument('--cfg', '--config', type=str, default='default', help='Name of configuration setup', metavar='cfg')
+    parser.add_argument('--cell', '--cell_size', type=int, default=32, help='Size of the cells in the grid', metavar='cell')
+    parser.add_argument('--grids', '--grid_sizes', type=grid_size_argument, nargs='+', default=[(6, 8), (8, 10)], \
+         help='Grid sizes to check, as rows x columns. The loop engine is slow, so they should be small', metavar='grids')
+    parser.add_argument('--r', '--repetitions', type=int, default=3, help='Number of synthetic posteriors checked for each grid size')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic posteriors')
+    parser.add_argument('--t', '--tolerance', type=float, default=1e-6, help='Largest relative difference allowed between the engines')
+
+    args = parser.parse_args()
+
+    main(args.cfg, args.cell, args.grids, args.r, args.seed, args.t)
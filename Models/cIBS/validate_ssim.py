@@ -0,0 +1,88 @@
+import argparse
+import sys
+import numpy as np
+from skimage.metrics import structural_similarity
+from skimage.util.dtype import dtype_range
+from visualsearch.target_similarity.ssim import Ssim, WINDOW_SIZE
+
+" Checks that the SSIM target similarity, which compares every tile of the same size at once, gives the same map as comparing each tile "
+" with skimage.metrics.structural_similarity, one at a time. Cases are synthetic and cover targets at the corners and edges of the image, "
+" images whose size isn't a multiple of the target's, and tiles at the borders smaller than the window, whose value is zero "
+" Exits with an error if any value differs by more than the tolerance "
+
+# Each case is given by the image size, the target size and the upper left pixel of the target, in (rows, columns)
+CASES = [((240, 320), (40, 64), (0, 0)), ((240, 320), (40, 64), (200, 256)), ((240, 320), (40, 64), (100, 128)), \
+    ((233, 311), (37, 45), (0, 150)), ((233, 311), (37, 45), (196, 266)), ((233, 311), (37, 45), (101, 17)), \
+    ((200, 250), (30, 40), (3, 5)), ((200, 250), (30, 40), (165, 207)), ((64, 64), (64, 64), (0, 0)), ((97, 131), (9, 8), (50, 61))]
+
+def main(seed, tolerance):
+    random_state = np.random.RandomState(seed)
+    # compute_target_similarity doesn't depend on the state set by the constructor, which builds the whole target similarity map
+    ssim = Ssim.__new__(Ssim)
+
+    max_difference = 0
+    for image_size, target_size, target_start in CASES:
+        for image_type in [np.uint8, np.float64]:
+            image = random_state.randint(0, 256, size=image_size).astype(image_type)
+            if image_type == np.float64:
+                image /= 255
+            target_end  = (target_start[0] + target_size[0], target_start[1] + target_size[1])
+            # The target is the part of the image in its bounding box, with noise, so that its similarity isn't the same everywhere
+            target      = image[target_start[0]:target_end[0], target_start[1]:target_end[1]].copy()
+            target[random_state.random_sample(target_size) < 0.2] = image.max()
+            target_bbox = [target_start[0], target_start[1], target_end[0] - 1, target_end[1] - 1]
+
+            difference     = np.max(np.abs(ssim.compute_target_similarity(image, target, target_bbox) - reference_target_similarity(ssim, image, target, target_bbox)))
+            max_difference = max(max_difference, difference)
+            print('Image ' + str(image_size) + ' (' + np.dtype(image_type).name + '), target ' + str(target_size) + ' at ' + str(target_start) + ': max. difference ' \
+                + '{:.3e}'.format(difference) + (' -> OK' if difference <= tolerance else ' -> MISMATCH'))
+
+    if max_difference > tolerance:
+        print('SSIM differs from skimage by more than the tolerance (' + str(tolerance) + ')')
+        sys.exit(-1)
+    print('SSIM matches skimage')
+
+def reference_target_similarity(ssim, image, target, target_bbox):
+    " SSIM between the target and each tile of the image, aligned with its bounding box, computed one tile at a time with skimage "
+    target_size = np.shape(target)[:2]
+    image_size  = np.shape(image)[:2]
+    ssim_values = np.zeros(shape=image_size, dtype=np.float64)
+
+    off_bounds_area = ssim.get_image_off_bounds_area(target_bbox, target_size, image_size)
+    padding         = (np.tile(target_size, 2) - off_bounds_area) % np.tile(target_size, 2)
+    padded_image_shape = tuple(np.array(image_size) + padding[0:2] + padding[2:4])
+    data_range      = dtype_range[image.dtype.type][1] - dtype_range[image.dtype.type][0]
+
+    for row in range(0, padded_image_shape[0], target_size[0]):
+        for column in range(0, padded_image_shape[1], target_size[1]):
+            # Tiles at the borders of the image are cropped, and so is the part of the target they're compared with
+            row_in_image, column_in_image = row - padding[0], column - padding[1]
+            end_row, end_column = row_in_image + target_size[0], column_in_image + target_size[1]
+            target_to_use = target
+            if row_in_image < 0:
+                target_to_use = target_to_use[padding[0]:target_size[0], :]
+                row_in_image  = 0
+            if column_in_image < 0:
+                target_to_use   = target_to_use[:, padding[1]:target_size[1]]
+                column_in_image = 0
+            if row_in_image >= image_size[0] - off_bounds_area[2]:
+                target_to_use = target_to_use[0:target_size[0] - padding[2], :]
+                end_row       = end_row - padding[2]
+            if column_in_image >= image_size[1] - off_bounds_area[3]:
+                target_to_use = target_to_use[:, 0:target_size[1] - padding[3]]
+                end_column    = end_column - padding[3]
+
+            tile = image[row_in_image:end_row, column_in_image:end_column]
+            if tile.shape[0] >= WINDOW_SIZE and tile.shape[1] >= WINDOW_SIZE:
+                ssim_values[row_in_image:end_row, column_in_image:end_column] += structural_similarity(tile, target_to_use, data_range=data_range)
+
+    return ssim_values
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check that the SSIM target similarity gives the same map as skimage.metrics.structural_similarity, tile by tile')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic images')
+    parser.add_argument('--t', '--tolerance', type=float, default=1e-9, help='Largest absolute difference allowed')
+
+    args = parser.parse_args()
+
+    main(args.seed, args.t)
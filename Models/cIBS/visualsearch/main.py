@@ -2,13 +2,21 @@ from .visibility_map  import VisibilityMap
 from .visual_searcher import VisualSearcher
 from .grid import Grid
 from .utils import utils
+from .utils import checkpoint_log
+from .utils import metrics
 from . import prior
+from multiprocessing import Pool
+from functools import partial
 import numpy as np
+import signal
 import time
 import sys
 
 " Runs the visual search model on the image/s specified with the supplied configuration "
 
+# Number of batches of trials whose images are loaded in background threads while the current one is searched
+PREFETCHED_BATCHES = 2
+
 def run(config, dataset_info, trials_properties, output_path, sigma):
     """ Input:
             Config (dict). One entry. Fields:
@@ -16,16 +24,33 @@ def run(config, dataset_info, trials_properties, output_path, sigma):
                 target_similarity (string)   : correlation, geisler
                 prior             (string)   : deepgaze, mlnet, flat, center
                 max_saccades      (int)      : maximum number of saccades allowed
+                seed              (int)      : seed from which the seed of each trial is derived
                 cell_size         (int)      : size (in pixels) of the cells in the grid
                 scale_factor      (int)      : modulates the variance of target similarity and prevents 1 / d' from diverging in bayesian search
                 additive_shift    (int)      : modulates the variance of target similarity and prevents 1 / d' from diverging in bayesian search
                 save_probability_maps (bool) : indicates whether to save the posterior to a file after each saccade or not
+                probability_maps_dtype (string) : float64, float32, float16. Floating point type in which the probability maps are saved
                 proc_number       (int)      : number of processes on which to execute bayesian search
+                trial_processes   (int)      : number of processes on which to search different trials at the same time. If greater than one, proc_number is ignored
+                trial_batch_size  (int)      : number of trials searched in lockstep by each process, whose next fixations are computed at once
+                engine            (string)   : loop, vectorized. How bayesian search evaluates each possible next fixation
+                quadrature        (string)   : trapezoid, gauss_legendre, gauss_hermite, adaptive. Rule used by bayesian search to integrate the probability of being correct
+                quadrature_nodes  (int)      : number of nodes of the quadrature rule. For the adaptive rule, it's the number of nodes of each panel
+                quadrature_tolerance (float) : absolute error allowed in each integral by the adaptive rule
+                norm_cdf_backend  (string)   : table, uniform_table, ndtr, erf. How bayesian search evaluates the normal cdf
+                posterior_pruning_epsilon (float) : maximum posterior mass of the possible target locations left out by bayesian search at each saccade. Zero disables pruning
+                candidate_screening (int)    : number of possible next fixations, ranked by a cheap proxy, on which bayesian search computes the probability of being correct. Zero disables screening
+                screening_validation (bool)  : indicates whether to also evaluate every possible next fixation when screening, to count how often it chooses a different one
+                branch_and_bound  (bool)     : indicates whether bayesian search discards, with bounds, the possible next fixations which can't be the best one. The fixation chosen is the same. It can't be used along with candidate screening
+                precision         (string)   : float64, float32. Floating point type of the likelihood, the posterior and the tensors of bayesian search
+                precision_validation (bool)  : indicates whether to also search each image in double precision, to report where the scanpath diverges from it
             Dataset info (dict). One entry. Fields:
                 name          (string) : name of the dataset
                 images_dir    (string) : folder path where search images are stored
                 targets_dir   (string) : folder path where the targets are stored
                 saliency_dir  (string) : folder path where the saliency maps are stored
+                target_similarity_dir (string) : folder path where the target similarity maps are stored, so that they're computed only once
+                grid_priors_dir (string)       : folder path where the priors are stored once reduced to the grid, so that they're decoded only once
                 image_height  (int)    : default image height (in pixels)
                 image_width   (int)    : default image width (in pixels)
             Trials properties (dict):
@@ -41,59 +66,145 @@ def run(config, dataset_info, trials_properties, output_path, sigma):
             Output path (string) : folder path where scanpaths and the probability maps will be stored
         Output:
             Output_path/scanpaths/Scanpaths.json: Dictionary indexed by image name where each entry contains the scanpath for that given image, alongside the configuration used.
-            Output_path/probability_maps/image_name/: In this folder, the probability map computed for each saccade is stored. This is done for every image in trials_properties.
+            Output_path/probability_maps/image_name.npz: In this file, the probability map computed for each saccade is stored, as fixation_1, fixation_2, etc. This is done for every image in trials_properties.
+            They can be read with utils.probability_maps.load
+            Output_path/metrics.jsonl: seconds spent by each trial in each phase of the search, one line per trial, followed by the median and 95th percentile of each phase
     """
-    images_dir    = dataset_info['images_dir']
-    targets_dir   = dataset_info['targets_dir']
-    saliency_dir  = dataset_info['saliency_dir']
-    prior_name    = config['prior']
-    
+    prior_name = config['prior']
     image_size = (dataset_info['image_height'], dataset_info['image_width'])
     cell_size  = config['cell_size']
     
     # Initialize objects
     grid            = Grid(np.array(image_size), cell_size)
     visibility_map  = VisibilityMap(image_size, grid, sigma)
-    visual_searcher = VisualSearcher(config, grid, visibility_map, output_path)
+    visual_searcher = VisualSearcher(config, grid, visibility_map, output_path, dataset_info['target_similarity_dir'])
 
     print('Press Ctrl + C to interrupt execution and save a checkpoint \n')
 
-    # If resuming execution, load previously generated data
-    scanpaths, targets_found, previous_time = utils.load_data_from_checkpoint(output_path)
+    # If resuming execution, replay the trials already searched
+    scanpaths, targets_found, previous_time = {}, 0, 0
+    resume = checkpoint_log.exists(output_path)
+    if resume:
+        checkpoint = checkpoint_log.replay(output_path)
+        scanpaths, targets_found, previous_time = checkpoint['scanpaths'], checkpoint['targets_found'], checkpoint['time_elapsed']
+    # Each trial is recorded as soon as it's searched, so that no progress is lost if the execution is interrupted
+    log = checkpoint_log.CheckpointLog(output_path, config, trials_properties)
+    metrics_log = metrics.MetricsLog(output_path, resume)
 
     trial_number = len(scanpaths.keys())
     total_trials = len(trials_properties) + trial_number
+    trials       = [(trial, trial_number + index + 1, total_trials) for index, trial in enumerate(trials_properties)]
+    batch_size   = config['trial_batch_size']
+    batches      = [trials[batch_start:batch_start + batch_size] for batch_start in range(0, len(trials), batch_size)]
+    trials_pool  = None
     start = time.time()
     try:
-        for trial in trials_properties:
-            trial_number += 1
-            image_name  = trial['image']
-            target_name = trial['target'] 
-            print('Searching in image ' + image_name + ' (' + str(trial_number) + '/' + str(total_trials) + ')...')
-            
-            image       = utils.load_image(images_dir, image_name, image_size)
-            target      = utils.load_image(targets_dir, target_name)
-            image_prior = prior.load(image, image_name, image_size, prior_name, saliency_dir)
-            
-            initial_fixation = (trial['initial_fixation_row'], trial['initial_fixation_column'])
-            target_bbox      = [trial['target_matched_row'], trial['target_matched_column'], \
-                                    trial['target_height'] + trial['target_matched_row'], trial['target_width'] + trial['target_matched_column']]
-
-            trial_scanpath = visual_searcher.search(image_name, image_size, image, image_prior, target, target_bbox, initial_fixation)
+        if config['trial_processes'] > 1:
+            # Each process searches a whole batch of trials, so saccades are not parallelized
+            trials_pool    = Pool(config['trial_processes'], initializer=initialize_trial_worker, initargs=(config, grid, visibility_map, output_path, dataset_info['target_similarity_dir'], ))
+            trials_results = trials_pool.imap_unordered(search_trials_in_worker, [(batch, dataset_info, image_size, grid, prior_name) for batch in batches])
+        else:
+            # The images of the next batches are loaded while searching the current one
+            loaded_batches = utils.prefetch(partial(load_trials, dataset_info=dataset_info, image_size=image_size, grid=grid, prior_name=prior_name), batches, PREFETCHED_BATCHES)
+            trials_results = (search_loaded_trials(visual_searcher, trials_data) for trials_data in loaded_batches)
 
+        for image_name, trial_scanpath, target_bbox, trial_timings in (trial_result for batch_results in trials_results for trial_result in batch_results):
             if trial_scanpath:
                 # If there were no errors, save the scanpath
                 utils.add_scanpath_to_dict(image_name, trial_scanpath, target_bbox, grid, config, dataset_info['name'], scanpaths)
+                log.append(image_name, scanpaths[image_name], time.time() - start + previous_time)
+                metrics_log.append(image_name, trial_timings)
                 if trial_scanpath['target_found']:
                     targets_found += 1
+        metrics_summary = metrics_log.finish()
     except KeyboardInterrupt:
-        time_elapsed = time.time() - start + previous_time
-        utils.save_checkpoint(config, scanpaths, targets_found, trials_properties, time_elapsed, output_path)        
+        print('\nCheckpoint saved at ' + output_path)
+        print('Run the script again to resume execution')
         sys.exit(0)
+    finally:
+        log.close()
+        metrics_log.close()
+        visual_searcher.close()
+        if trials_pool is not None:
+            trials_pool.terminate()
+            trials_pool.join()
 
     time_elapsed = time.time() - start + previous_time
+    # Compact the log into the scanpaths file
     utils.save_scanpaths(output_path, scanpaths)
-    utils.erase_checkpoint(output_path)
+    checkpoint_log.erase(output_path)
 
     print('Total targets found: ' + str(targets_found) + '/' + str(len(scanpaths.keys())))
-    print('Total time elapsed:  ' + str(round(time_elapsed, 4))   + ' seconds')
\ No newline at end of file
+    print('Total time elapsed:  ' + str(round(time_elapsed, 4))   + ' seconds\n')
+    metrics.print_summary(metrics_summary)
+
+def search_trials(visual_searcher, batch, dataset_info, image_size, grid, prior_name):
+    " Loads the images of a batch of trials and runs the visual search model on them, in lockstep "
+    """ Output:
+            List with, for each trial:
+                image_name     (string) : name of the search image
+                trial_scanpath (dict)   : scanpath made by the model, empty if there were errors
+                target_bbox    (array)  : bounding box of the target in the search image, in pixels
+                trial_timings  (dict)   : seconds spent in each phase, from loading the images to searching them, as described in utils.metrics
+    """
+    return search_loaded_trials(visual_searcher, load_trials(batch, dataset_info, image_size, grid, prior_name))
+
+def search_loaded_trials(visual_searcher, trials_data):
+    " Runs the visual search model on a batch of trials whose images have already been loaded, in lockstep. The output is that of search_trials "
+    for (search_args, _, _), (_, trial_number, total_trials) in trials_data:
+        print('Searching in image ' + search_args[0] + ' (' + str(trial_number) + '/' + str(total_trials) + ')...')
+    trials_scanpaths = visual_searcher.search_batch([search_args for (search_args, _, _), _ in trials_data])
+
+    return [(search_args[0], trial_scanpath, target_bbox, dict(load_timings, **trial_scanpath.pop('timings', {}))) \
+        for ((search_args, target_bbox, load_timings), _), trial_scanpath in zip(trials_data, trials_scanpaths)]
+
+def load_trials(batch, dataset_info, image_size, grid, prior_name):
+    " Loads the images of a batch of trials. Each one is returned alongside its trial properties, number and total number of trials "
+    return [(load_trial(trial, dataset_info, image_size, grid, prior_name), (trial, trial_number, total_trials)) for trial, trial_number, total_trials in batch]
+
+def load_trial(trial, dataset_info, image_size, grid, prior_name):
+    " Loads the images of the trial, and its prior reduced to the grid "
+    """ Output:
+            search_args (tuple)  : image_name, image_size, image, grid_prior, target, target_bbox and initial_fixation, as taken by VisualSearcher.search
+            target_bbox (array)  : bounding box of the target in the search image, in pixels
+            load_timings (dict)  : seconds spent loading the images and the prior. When they're loaded in background threads, it's the time they took there
+    """
+    start = time.time()
+    image_name, image, target, target_bbox, initial_fixation = load_trial_images(trial, dataset_info, image_size)
+    images_load_time = time.time() - start
+    start = time.time()
+    grid_prior  = prior.load(image, image_name, image_size, prior_name, dataset_info['saliency_dir'], grid, dataset_info['grid_priors_dir'])
+    load_timings = {'image_load' : images_load_time, 'prior_load' : time.time() - start}
+
+    return (image_name, image_size, image, grid_prior, target, target_bbox, initial_fixation), target_bbox, load_timings
+
+def load_trial_images(trial, dataset_info, image_size):
+    " Loads the search image and the target of the trial, which don't depend on the configuration "
+    """ Output:
+            image_name (string), image (2D array), target (2D array), target_bbox (array) and initial_fixation (int, int), as taken by VisualSearcher.search
+    """
+    image_name  = trial['image']
+    target_name = trial['target'] 
+    
+    image       = utils.load_image(dataset_info['images_dir'], image_name, image_size)
+    target      = utils.load_image(dataset_info['targets_dir'], target_name)
+    
+    initial_fixation = (trial['initial_fixation_row'], trial['initial_fixation_column'])
+    target_bbox      = [trial['target_matched_row'], trial['target_matched_column'], \
+                            trial['target_height'] + trial['target_matched_row'], trial['target_width'] + trial['target_matched_column']]
+
+    return image_name, image, target, target_bbox, initial_fixation
+
+# Visual searcher held by each process of the trials pool
+worker_visual_searcher = None
+
+def initialize_trial_worker(config, grid, visibility_map, output_path, target_similarity_dir):
+    " Executed once by each process of the trials pool when it starts "
+    global worker_visual_searcher
+    # Interruptions are handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_config = dict(config, proc_number=1)
+    worker_visual_searcher = VisualSearcher(worker_config, grid, visibility_map, output_path, target_similarity_dir)
+
+def search_trials_in_worker(batch_args):
+    return search_trials(worker_visual_searcher, *batch_args)
@@ -1,130 +1,576 @@
 import numpy as np
 import warnings
-from scipy.stats import norm
 from scipy.interpolate import interp1d
-from multiprocessing import Process, shared_memory
-from os import cpu_count
+from scipy.special import ndtr
+from multiprocessing import Pool
+from . import quadrature, norm_cdf
+import signal
+
+# Maximum number of elements held by each tensor of the vectorized engine at any given time. Small batches stay in cache
+VECTORIZED_BATCH_SIZE = 2 ** 16
+# Maximum number of elements of each tile of log ratios between the posterior at every cell and at the target locations
+LOG_RATIOS_TILE_SIZE = 2 ** 22
+# Number of cells with the highest posterior, and of cells most visible from each candidate, with which branch and bound compares each target location to bound
+# the probability of being correct. More cells hardly make the bounds tighter
+BOUND_COMPARED_CELLS = 8
+# Number of candidates, in descending order of their bounds, evaluated by the first step of branch and bound. Each step evaluates twice as many as the previous one
+BRANCH_AND_BOUND_FIRST_CANDIDATES = 4
+# Bounds are enlarged by this relative margin, so that rounding and quadrature errors can't make them lower than the values they bound
+BOUND_RELATIVE_MARGIN = 1e-6
+# In single precision, the margin is at least this many times the machine epsilon
+BOUND_MARGIN_IN_EPSILONS = 1000
 
 class BayesianModel:
-    def __init__(self, grid_size, visibility_map, norm_cdf_tolerance, number_of_processes):
+    def __init__(self, grid_size, visibility_map, norm_cdf_tolerance, number_of_processes, engine='loop', quadrature_method='trapezoid', quadrature_nodes=50, quadrature_tolerance=None, \
+        norm_cdf_backend='table', posterior_pruning_epsilon=0, candidate_screening=0, screening_validation=False, branch_and_bound=False, precision='float64'):
+        if candidate_screening > 0 and branch_and_bound:
+            raise ValueError('Candidate screening and branch and bound can\'t be used at the same time')
         self.grid_size      = grid_size
+        # Floating point type of the posterior and of the tensors of bayesian search. The probability of being correct at each fixation is summed in double precision
+        self.dtype          = np.dtype(precision)
+        # Below double precision, the visibility map underflows to zero far from the fixation, where b and m overflow and normcdf(m * w + b) is NaN
+        # It's floored at a value small enough for normcdf(m * w + b) to still be a step, but for which b and m are finite. Double precision is left as it is
+        self.visibility_floor = 0 if self.dtype == np.float64 else np.sqrt(np.finfo(self.dtype).tiny)
         self.visibility_map = visibility_map
-        self.norm_cdf_table = self.create_norm_cdf_table(norm_cdf_tolerance)
+        self.norm_cdf       = norm_cdf.create(norm_cdf_backend, norm_cdf_tolerance)
         self.number_of_processes = number_of_processes
-    
-    def create_norm_cdf_table(self, norm_cdf_tolerance):
-        # TODO: Agregar para qué sirve
-        " Build normal curve table with default mean and variance. Row values go from norm_cdf_tolerance to 1 - norm_cdf_tolerance "
-        """ Input:
-                norm_cdf_tolerance (float) : value from which to compute the normal distribution probabilities
-            Output:
-                norm_cdf_table (dict) : table with the cumulative normal distribution values in the 'x' key
-        """
-        columns = norm.ppf(np.arange(start=norm_cdf_tolerance, stop=1, step=norm_cdf_tolerance))
-        rows    = norm.cdf(columns)
-
-        return {'x': columns, 'y': rows}
+        self.engine         = engine
+        self.quadrature     = quadrature.create(quadrature_method, quadrature_nodes, quadrature_tolerance)
+        self.pool           = None
+        # Arrays reused by every call of the vectorized engine, so that memory isn't allocated again for each batch. Each worker of the pool has its own
+        self.scratch_buffers = {}
+        self.posterior_pruning_epsilon = posterior_pruning_epsilon
+        # Posterior mass of the target locations left out in the last call to next_fixation
+        self.dropped_posterior_mass    = 0
+        self.candidate_screening       = candidate_screening
+        self.screening_validation      = screening_validation
+        # Outcome of the screening in the last call to next_fixation (None, 'screened' or 'fallback') and, if validated, whether it chose a different fixation
+        self.screening_outcome         = None
+        self.screening_mismatch        = None
+        self.branch_and_bound          = branch_and_bound
+        if branch_and_bound:
+            self.bound_relative_margin       = max(BOUND_RELATIVE_MARGIN, BOUND_MARGIN_IN_EPSILONS * np.finfo(self.dtype).eps)
+            self.max_conditional_probability = self.compute_max_conditional_probability()
+            # Bounds use scipy's normal cdf, so they're enlarged by the largest error of the backend
+            self.norm_cdf_error              = self.norm_cdf.max_error()
+        # Number of candidates on which branch and bound computed the probability of being correct at every target location, in the last call to next_fixation
+        self.fully_evaluated_candidates = None
     
     def next_fixation(self, posterior):
         " Computes the next fixation according to the posterior, which size is equal to the grid "
+        " The model itself holds the results of the search, as a TrialState does for each trial of next_fixations "
         """ Input:
                 posterior (2D array) : probability map of the size of the grid
             Output:
                 next_fix (int, int) : cell in the grid which maximizes the probability of being correct about the target being in that cell in regard to the posterior
         """
+        return self.next_fixations(posterior[np.newaxis], [self])[0]
+
+    def next_fixations(self, posteriors, trial_states):
+        " Computes the next fixation of each trial of a batch, searched in lockstep. Each trial goes through the same steps as in next_fixation, "
+        " but at each step the probability of being correct is computed for every trial at once, so that the visibility map at each candidate is shared "
+        """ Input:
+                posteriors (3D array) : probability map of each trial, of the size of the grid
+                trial_states (list of TrialState) : results of the search of each trial, which are updated
+            Output:
+                next_fixations (list of (int, int)) : next fixation of each trial
+        """
+        trials_steps   = [self.fixation_steps(posterior.astype(self.dtype, copy=False), trial_state) for posterior, trial_state in zip(posteriors, trial_states)]
+        next_fixations = [None] * len(trials_steps)
+        # Job (posterior, target locations, candidates) requested by each trial whose next fixation hasn't been chosen yet
+        pending_jobs   = {}
+
+        def advance(trial, probability_of_being_correct):
+            try:
+                pending_jobs[trial] = trials_steps[trial].send(probability_of_being_correct)
+            except StopIteration as steps_end:
+                next_fixations[trial] = steps_end.value
+
+        for trial in range(len(trials_steps)):
+            advance(trial, None)
+        while pending_jobs:
+            trials  = sorted(pending_jobs)
+            results = self.compute_probability_of_being_correct([pending_jobs.pop(trial) for trial in trials])
+            for trial, probability_of_being_correct in zip(trials, results):
+                advance(trial, probability_of_being_correct)
+
+        return next_fixations
+
+    def fixation_steps(self, posterior, trial_state):
+        " Generator which chooses the next fixation of a trial. It yields the jobs (posterior, target locations, candidates) "
+        " whose probability of being correct it needs, which is sent back to it, and returns the next fixation "
         # Alpha está al pedo, se multiplica y resta por él cuando vale 1
         alpha = 1 
+        target_locations, trial_state.dropped_posterior_mass = self.select_target_locations(posterior)
+        trial_state.screening_outcome  = None
+        trial_state.screening_mismatch = None
+
+        number_of_cells = self.grid_size[0] * self.grid_size[1]
+        if 0 < self.candidate_screening < number_of_cells:
+            return (yield from self.screening_steps(posterior, target_locations, trial_state))
+        if self.branch_and_bound:
+            return (yield from self.branch_and_bound_steps(posterior, target_locations, trial_state))
+
+        candidates = self.all_candidates()
         probability_at_each_fixation = np.empty(shape=self.grid_size)
+        probability_of_being_correct = yield posterior, target_locations, candidates
+        self.store_probability(probability_at_each_fixation, probability_of_being_correct, candidates)
 
-        if self.number_of_processes > 1:
-            self.parallelize_probability_computation(probability_at_each_fixation, posterior)
-        else:
-            self.compute_probability_on_rows(probability_at_each_fixation, posterior, rows=range(self.grid_size[0]))
-        
-        # Get the fixation which maximizes the probability of being correct
+        return self.fixation_with_highest_probability(probability_at_each_fixation)
+
+    def screening_steps(self, posterior, target_locations, trial_state):
+        " Ranks the possible next fixations by a cheap proxy and only computes the probability of being correct at the self.candidate_screening best ranked "
+        " If the best of them was ranked in the lower half by the proxy, the ranking isn't reliable and every other candidate is evaluated as well "
+        " Were self.screening_validation True, every other candidate is always evaluated, to know whether the fixation chosen by screening is the best one "
+        # Candidates which aren't evaluated can't be chosen
+        probability_at_each_fixation = np.full(shape=self.grid_size, fill_value=-np.inf)
+        ranking    = np.argsort(-self.screening_proxy(posterior).flatten(), kind='mergesort')
+        candidates = [np.unravel_index(index, self.grid_size) for index in ranking]
+        screened_candidates, other_candidates = candidates[:self.candidate_screening], candidates[self.candidate_screening:]
+
+        probability_of_being_correct = yield posterior, target_locations, screened_candidates
+        self.store_probability(probability_at_each_fixation, probability_of_being_correct, screened_candidates)
+        next_fix = self.fixation_with_highest_probability(probability_at_each_fixation)
+        next_fix_rank = screened_candidates.index(next_fix)
+        if 2 * next_fix_rank >= self.candidate_screening:
+            trial_state.screening_outcome = 'fallback'
+            probability_of_being_correct  = yield posterior, target_locations, other_candidates
+            self.store_probability(probability_at_each_fixation, probability_of_being_correct, other_candidates)
+
+            return self.fixation_with_highest_probability(probability_at_each_fixation)
+
+        trial_state.screening_outcome = 'screened'
+        if self.screening_validation:
+            exhaustive_probability_at_each_fixation = np.copy(probability_at_each_fixation)
+            probability_of_being_correct = yield posterior, target_locations, other_candidates
+            self.store_probability(exhaustive_probability_at_each_fixation, probability_of_being_correct, other_candidates)
+            trial_state.screening_mismatch = self.fixation_with_highest_probability(exhaustive_probability_at_each_fixation) != next_fix
+
+        return next_fix
+
+    def branch_and_bound_steps(self, posterior, target_locations, trial_state):
+        " Exact version of fixation_steps, which stops computing the probability of being correct at the candidates which can't be the best one "
+        " Candidates are evaluated in descending order of an upper bound of their probability of being correct, in chunks which double in size, until "
+        " the bound of the next one is below the best probability found. Each of them is evaluated over every target location, so the fixation chosen is the same "
+        upper_bounds = self.upper_bounds_of_probability(posterior.flatten().astype(np.float64), target_locations) * (1 + self.bound_relative_margin)
+        ranking      = np.argsort(-upper_bounds, kind='mergesort')
+        # Candidates which weren't evaluated can't be chosen
+        probability_at_each_fixation = np.full(shape=self.grid_size, fill_value=-np.inf)
+        best_probability = -np.inf
+        chunk_start = 0
+        chunk_size  = max(BRANCH_AND_BOUND_FIRST_CANDIDATES, self.number_of_processes)
+        trial_state.fully_evaluated_candidates = 0
+        while chunk_start < len(ranking) and upper_bounds[ranking[chunk_start]] >= best_probability:
+            chunk      = ranking[chunk_start:chunk_start + chunk_size]
+            candidates = self.candidates_from_indexes(chunk[upper_bounds[chunk] >= best_probability])
+            probability_on_chunk = yield posterior, target_locations, candidates
+            self.store_probability(probability_at_each_fixation, probability_on_chunk, candidates)
+
+            best_probability = max(best_probability, np.max(probability_on_chunk))
+            trial_state.fully_evaluated_candidates += len(candidates)
+            chunk_start += chunk_size
+            chunk_size  *= 2
+
+        return self.fixation_with_highest_probability(probability_at_each_fixation)
+
+    def upper_bounds_of_probability(self, posterior_flattened, target_locations):
+        " Upper bound of the probability of being correct at each candidate, in double precision. Being correct given that the target is at location t "
+        " requires the posterior at t to end up higher than at every other cell j, which by itself has probability normcdf(sqrt(s) / 2 + (log p_t - log p_j) / sqrt(s)), "
+        " with s = d_t ** 2 + d_j ** 2 and d the visibility map at the candidate. The smallest of these is taken over the cells with the highest posterior "
+        " and the cells most visible from the candidate, which are the ones that make it small "
+        """ Input:
+                posterior_flattened (1D array) : posterior of every cell, in double precision
+                target_locations (1D array of ints) : flattened indexes of the possible target locations to consider
+            Output:
+                upper_bounds (1D array) : upper bound of the probability of being correct at each cell of the grid, flattened
+        """
+        number_of_cells = len(posterior_flattened)
+        compared_cells  = min(BOUND_COMPARED_CELLS, number_of_cells - 1)
+        with np.errstate(divide='ignore'):
+            log_posterior = np.log(posterior_flattened)
+        highest_posterior = np.argsort(-posterior_flattened, kind='mergesort')[:compared_cells]
+
+        upper_bounds = np.empty(shape=number_of_cells)
+        for index, candidate in enumerate(self.all_candidates()):
+            visibility_map = self.visibility_at_fixation(candidate).flatten().astype(np.float64)
+            compared       = np.union1d(highest_posterior, np.argpartition(-visibility_map, compared_cells)[:compared_cells])
+            # Cells which aren't visible or where the posterior is zero don't bound the probability (their normcdf is a step or one)
+            compared       = compared[(visibility_map[compared] > 0) & (posterior_flattened[compared] > 0)]
+            if not len(compared):
+                upper_bounds[index] = np.sum(posterior_flattened[target_locations])
+                continue
+
+            upper_bounds[index] = 0
+            batch_size = max(VECTORIZED_BATCH_SIZE // len(compared), 1)
+            for batch_start in range(0, len(target_locations), batch_size):
+                batch_locations = target_locations[batch_start:batch_start + batch_size]
+                s = np.square(visibility_map[batch_locations])[:, np.newaxis] + np.square(visibility_map[compared])
+                z = np.sqrt(s) / 2 + (log_posterior[batch_locations][:, np.newaxis] - log_posterior[compared]) / np.sqrt(s)
+                # The target location isn't compared with itself
+                z[batch_locations[:, np.newaxis] == compared] = np.inf
+                conditional_bounds   = np.minimum(ndtr(np.min(z, axis=1)) + self.norm_cdf_error, 1)
+                upper_bounds[index] += np.sum(posterior_flattened[batch_locations] * conditional_bounds)
+
+        # The quadrature rule may give a slightly higher value than the integral
+        return upper_bounds * self.max_conditional_probability
+
+    def candidates_from_indexes(self, indexes):
+        return [np.unravel_index(index, self.grid_size) for index in indexes]
+
+    def compute_max_conditional_probability(self):
+        " Largest value the quadrature rule gives to the probability of being correct given a target location "
+        " Since the product of normcdfs is at most one, it's the largest integral of phi alone over the possible limits of integration "
+        min_w     = np.linspace(-20, 20, 4000, endpoint=False, dtype=self.dtype)
+        integrals = self.quadrature.integrate(lambda rows, w_range: np.ones(shape=w_range.shape, dtype=self.dtype), min_w, 20)
+
+        return max(np.max(integrals), 1) * (1 + self.bound_relative_margin)
+
+    def screening_proxy(self, posterior):
+        " Posterior smoothed by the visibility map: for each possible next fixation, the posterior of every cell weighted by how visible it is from there "
+        proxy = np.empty(shape=self.grid_size)
+        for row, column in self.all_candidates():
+            proxy[row, column] = np.sum(posterior * self.visibility_map.at_fixation((row, column)))
+
+        return proxy
+
+    def all_candidates(self):
+        return [(row, column) for row in range(self.grid_size[0]) for column in range(self.grid_size[1])]
+
+    def fixation_with_highest_probability(self, probability_at_each_fixation):
+        " Get the fixation which maximizes the probability of being correct "
         coordinates = np.where(probability_at_each_fixation == np.max(probability_at_each_fixation))
         next_fix    = (coordinates[0][0], coordinates[1][0])
 
-        return next_fix      
-    
-    def parallelize_probability_computation(self, probability_at_each_fixation, posterior):
-        " This method is only executed if self.number_of_processes is greater than one "
-        " It divides the computation of the rows of the matrix probability_at_each_fixation in self.number_of_processes processes "
-        """ Input: 
-                probability_at_each_fixation (2D array) : matrix of the size of the grid which will hold the values of the probability of being correct at each location
+        return next_fix
+
+    def store_probability(self, probability_at_each_fixation, probability_of_being_correct, candidates):
+        " Stores the probability of being correct at each of the candidates (list of cells) in the matrix probability_at_each_fixation "
+        for index, (possible_nextfix_row, possible_nextfix_column) in enumerate(candidates):
+            probability_at_each_fixation[possible_nextfix_row, possible_nextfix_column] = probability_of_being_correct[index]
+
+    def compute_probability_of_being_correct(self, jobs):
+        " For each job, computes the probability of being correct at each candidate as the sum over the target locations of the probability of being correct "
+        " given that the target is at each of them, weighted by the posterior. It's done in parallel if self.number_of_processes is greater than one "
+        """ Input:
+                jobs (list of tuples). Each job is given by:
+                    posterior (2D array) : probability map of the size of the grid
+                    target_locations (1D array of ints) : flattened indexes of the possible target locations to consider
+                    candidates (list of (int, int)) : possible next fixations on which to compute the probability of being correct
+            Output:
+                probabilities_of_being_correct (list of 1D arrays) : for each job, the probability of being correct at each candidate, in double precision
+                    Target locations left out don't add to it
+        """
+        if self.number_of_processes > 1:
+            return self.parallelize_probability_computation(jobs)
+        else:
+            return self.compute_probability_of_being_correct_on_jobs(jobs)
+
+    def select_target_locations(self, posterior):
+        " Chooses the possible target locations over which the probability of being correct is summed "
+        " The locations with the lowest posterior are left out, as long as their cumulative posterior doesn't exceed self.posterior_pruning_epsilon "
+        " Since the probability of being correct given a target location is at most one, the probability of being correct at each possible next fixation "
+        " is underestimated by at most the posterior mass left out "
+        """ Input:
                 posterior (2D array) : probability map of the size of the grid
+            Output:
+                target_locations (1D array of ints) : flattened indexes, in increasing order, of the possible target locations to consider
+                dropped_posterior_mass (float)      : sum of the posterior at the locations left out
         """
-        try:
-            # Processes will iterate over the rows of probability_at_each_fixation. Divide the rows in equal chunks.
-            number_of_procs  = self.number_of_processes
-            number_of_rows   = self.grid_size[0]
-            remainder        = number_of_rows % number_of_procs
-            indexes          = list(range(number_of_rows)) 
-            chunks = [indexes[i * (number_of_rows // number_of_procs) + min(i, remainder):(i + 1) * (number_of_rows // number_of_procs) + min(i + 1, remainder)] for i in range(number_of_procs)]
-
-            # Create shared memory and allocate the matrix in it
-            shared_mem       = shared_memory.SharedMemory(create=True, size=probability_at_each_fixation.nbytes)
-            shared_matrix    = np.ndarray(probability_at_each_fixation.shape, dtype=probability_at_each_fixation.dtype, buffer=shared_mem.buf)
-            shared_matrix[:] = probability_at_each_fixation[:]
-
-            procs = []
-            for chunk in chunks:
-                proc = Process(target=self.proc_compute_probability_on_chunk, args=(shared_mem.name, posterior, chunk, ))
-                procs.append(proc)
-                proc.start()
-            
-            # Wait for each process to complete
-            for proc in procs:
-                proc.join()
-            
-            # Copy back the data
-            probability_at_each_fixation[:] = shared_matrix[:]
-        finally:
-            # Free and release shared memory
-            shared_mem.close()
-            shared_mem.unlink()
+        posterior_flattened = posterior.flatten()
+        if self.posterior_pruning_epsilon <= 0:
+            return np.arange(len(posterior_flattened)), 0
+
+        locations_by_posterior = np.argsort(posterior_flattened, kind='mergesort')
+        cumulative_posterior   = np.cumsum(posterior_flattened[locations_by_posterior])
+        number_of_dropped      = np.searchsorted(cumulative_posterior, self.posterior_pruning_epsilon, side='right')
+        if number_of_dropped == 0:
+            return np.arange(len(posterior_flattened)), 0
+
+        return np.sort(locations_by_posterior[number_of_dropped:]), cumulative_posterior[number_of_dropped - 1]
     
-    def proc_compute_probability_on_chunk(self, matrix_pointer, posterior, chunk):
-        " This method is executed by each process, were self.number_of_processes to be greater than one "
-        " It runs on a subset of the rows on probability_at_each_fixation, which is stored at matrix_pointer "
-        try:
-            # Attach to existing shared memory block
-            shared_mem = shared_memory.SharedMemory(name=matrix_pointer)
-            probability_at_each_fixation = np.ndarray(shape=self.grid_size, dtype=np.float64, buffer=shared_mem.buf)
-
-            self.compute_probability_on_rows(probability_at_each_fixation, posterior, chunk)
-        except KeyboardInterrupt:
-            pass
-        finally:
-            # Clean up
-            shared_mem.close()
-
-    def compute_probability_on_rows(self, probability_at_each_fixation, posterior, rows):
-        " Computes the probability of being correct at each fixation on the given subset of rows of the matrix probability_at_each_fixation "
+    def parallelize_probability_computation(self, jobs):
+        " This method is only executed if self.number_of_processes is greater than one "
+        " It divides the computation of the probability of being correct at the candidates among the self.number_of_processes workers of the pool "
+        " Input and output are the same as those of compute_probability_of_being_correct "
+        # Processes will iterate over the candidates of every job. Divide them in equal chunks, which may span several jobs
+        number_of_procs      = self.number_of_processes
+        jobs_ends            = np.cumsum([len(candidates) for _, _, candidates in jobs], dtype=int)
+        jobs_starts          = jobs_ends - [len(candidates) for _, _, candidates in jobs]
+        number_of_candidates = jobs_ends[-1] if len(jobs) else 0
+        remainder            = number_of_candidates % number_of_procs
+        chunks_bounds = [(i * (number_of_candidates // number_of_procs) + min(i, remainder), (i + 1) * (number_of_candidates // number_of_procs) + min(i + 1, remainder)) \
+            for i in range(number_of_procs)]
+        # Each chunk is a list of (job index, part of the job)
+        chunks = [[(job_index, (posterior, target_locations, candidates[max(chunk_start - job_start, 0):chunk_end - job_start])) \
+            for job_index, ((posterior, target_locations, candidates), job_start, job_end) in enumerate(zip(jobs, jobs_starts, jobs_ends)) \
+                if job_start < chunk_end and chunk_start < job_end] for chunk_start, chunk_end in chunks_bounds]
+        chunks = [chunk for chunk in chunks if chunk]
+
+        # Only the posteriors and the target locations are sent to the workers, the rest of the model is already there
+        probability_on_chunks = self.get_pool().map(proc_compute_probability_on_chunk, [[part for _, part in chunk] for chunk in chunks])
+
+        # The parts of each job are in order
+        parts_of_jobs = [[] for _ in jobs]
+        for chunk, probability_on_chunk in zip(chunks, probability_on_chunks):
+            for (job_index, _), probability_on_part in zip(chunk, probability_on_chunk):
+                parts_of_jobs[job_index].append(probability_on_part)
+
+        return [np.concatenate(parts) if parts else np.empty(shape=0) for parts in parts_of_jobs]
+
+    def get_pool(self):
+        " The pool of processes is created the first time it's needed and lives until close is called. Each worker keeps its own copy of the model "
+        if self.pool is None:
+            self.pool = Pool(self.number_of_processes, initializer=initialize_worker, initargs=(self, ))
+
+        return self.pool
+
+    def close(self):
+        " Terminates the pool of processes, if there is one "
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __getstate__(self):
+        # The pool can't be sent to its own workers
+        state = self.__dict__.copy()
+        state['pool'] = None
+        state['scratch_buffers'] = {}
+
+        return state
+
+    def scratch_buffer(self, name, shape, dtype=None):
+        " Returns an uninitialized array of the given shape, whose memory is reused by every call with the same name. By default, its type is self.dtype "
+        dtype  = self.dtype if dtype is None else np.dtype(dtype)
+        size   = int(np.prod(shape))
+        buffer = self.scratch_buffers.get(name)
+        if buffer is None or buffer.size < size or buffer.dtype != dtype:
+            buffer = np.empty(shape=size, dtype=dtype)
+            self.scratch_buffers[name] = buffer
+
+        return np.reshape(buffer[:size], shape)
+
+    def compute_probability_of_being_correct_on_jobs(self, jobs):
+        " Computes the probability of being correct of every job in this process, with the chosen engine "
+        if self.engine == 'vectorized':
+            return self.compute_probability_of_being_correct_on_jobs_vectorized(jobs)
+
+        return [self.compute_probability_of_being_correct_on_candidates(posterior, target_locations, candidates) for posterior, target_locations, candidates in jobs]
+
+    def compute_probability_of_being_correct_on_candidates(self, posterior, target_locations, candidates):
+        " Computes the probability of being correct at each of the candidates, summed over the target locations in target_locations (flattened indexes) "
+        " Loop engine, which evaluates one pair (possible next fixation, possible target location) at a time "
         # Ignore user warnings due to masked values
         warnings.filterwarnings('ignore', category=UserWarning)
         # Ignore invalid and divide by zero warnings, they'll be dealt with later
         np.seterr(divide='ignore', invalid='ignore', over='ignore')
 
-        probability_of_being_correct = np.empty(shape=self.grid_size)
-        for possible_nextfix_row in rows: 
-            for possible_nextfix_column in range(self.grid_size[1]):
-                visibility_map_at_fixation = self.visibility_map.at_fixation((possible_nextfix_row, possible_nextfix_column))
-                for possible_target_location_row in range(self.grid_size[0]):
-                    for possible_target_location_column in range(self.grid_size[1]):
-                        probability_of_being_correct[possible_target_location_row, possible_target_location_column] = \
-                            self.compute_conditional_probability(possible_target_location_row, possible_target_location_column, posterior, visibility_map_at_fixation, alpha=1)
+        posterior_flattened = posterior.flatten()
+        probability_of_being_correct = np.zeros(shape=len(candidates))
+        for tile, log_ratios in self.log_ratios_tiles(posterior, target_locations):
+            tile_rows, tile_columns = np.unravel_index(tile, self.grid_size)
+            probability_on_tile = np.empty(shape=(len(candidates), len(tile)), dtype=self.dtype)
+            for index, (possible_nextfix_row, possible_nextfix_column) in enumerate(candidates):
+                visibility_map_at_fixation = self.visibility_at_fixation((possible_nextfix_row, possible_nextfix_column))
+                for position, (possible_target_location_row, possible_target_location_column) in enumerate(zip(tile_rows, tile_columns)):
+                    probability_on_tile[index, position] = \
+                        self.compute_conditional_probability(possible_target_location_row, possible_target_location_column, posterior, visibility_map_at_fixation, \
+                            np.reshape(log_ratios[position], self.grid_size), alpha=1)
+            probability_of_being_correct += self.sum_over_tile(posterior_flattened, tile, probability_on_tile)
+
+        return probability_of_being_correct
+
+    def compute_probability_of_being_correct_on_jobs_vectorized(self, jobs):
+        " Same as compute_probability_of_being_correct_on_candidates for every job, but the pairs (possible next fixation, possible target location) are evaluated "
+        " in batches with tensor operations. A batch may span several possible next fixations and several jobs, and its tensors hold about VECTORIZED_BATCH_SIZE elements "
+        " The visibility map at each candidate is computed once, even if it's a candidate of several jobs "
+        np.seterr(divide='ignore', invalid='ignore', over='ignore')
+
+        number_of_cells = self.grid_size[0] * self.grid_size[1]
+        probabilities_of_being_correct = [np.zeros(shape=len(candidates)) for _, _, candidates in jobs]
+        jobs_indexes = [job_index for job_index, (_, _, candidates) in enumerate(jobs) if candidates]
+        if not jobs_indexes:
+            return probabilities_of_being_correct
+
+        candidates_cells = sorted(set(candidate for job_index in jobs_indexes for candidate in jobs[job_index][2]))
+        visibility_rows  = {candidate: row for row, candidate in enumerate(candidates_cells)}
+        visibility_at_candidates = np.array([self.visibility_at_fixation(candidate).flatten() for candidate in candidates_cells])
+        jobs_candidates  = {job_index: np.array([visibility_rows[candidate] for candidate in jobs[job_index][2]]) for job_index in jobs_indexes}
+        posteriors_flattened = np.array([jobs[job_index][0].flatten() for job_index in jobs_indexes])
+
+        batch_size = max(VECTORIZED_BATCH_SIZE // number_of_cells, 1)
+
+        for tile_jobs, tile, log_ratios in self.log_ratios_tiles_of_jobs(posteriors_flattened, [jobs[job_index][1] for job_index in jobs_indexes]):
+            # Each pair is given by the row of the visibility map at the possible next fixation and the position of the possible target location in the tile
+            # Within each job of the tile, pairs go through its candidates in order
+            tile_segments = np.flatnonzero(np.diff(tile_jobs, prepend=-1, append=-1))
+            pairs_visibility_rows, pairs_positions = [], []
+            for segment_start, segment_end in zip(tile_segments[:-1], tile_segments[1:]):
+                job_candidates = jobs_candidates[jobs_indexes[tile_jobs[segment_start]]]
+                pairs_visibility_rows.append(np.repeat(job_candidates, segment_end - segment_start))
+                pairs_positions.append(np.tile(np.arange(segment_start, segment_end), len(job_candidates)))
+            pairs_visibility_rows, pairs_positions = np.concatenate(pairs_visibility_rows), np.concatenate(pairs_positions)
+
+            probability_at_pairs = np.empty(shape=len(pairs_positions), dtype=self.dtype)
+            for batch_start in range(0, len(pairs_positions), batch_size):
+                batch_end = batch_start + batch_size
+                batch_visibility_rows, batch_positions = pairs_visibility_rows[batch_start:batch_end], pairs_positions[batch_start:batch_end]
+                visibility_maps  = np.take(visibility_at_candidates, batch_visibility_rows, axis=0, \
+                    out=self.scratch_buffer('visibility_maps', (len(batch_visibility_rows), number_of_cells)))
+                batch_log_ratios = np.take(log_ratios, batch_positions, axis=0, out=self.scratch_buffer('log_ratios', (len(batch_positions), number_of_cells)))
+                probability_at_pairs[batch_start:batch_end] = \
+                    self.compute_conditional_probabilities(tile[batch_positions], visibility_maps, batch_log_ratios, alpha=1)
+
+            pairs_start = 0
+            for segment_start, segment_end in zip(tile_segments[:-1], tile_segments[1:]):
+                job_index   = jobs_indexes[tile_jobs[segment_start]]
+                pairs_end   = pairs_start + len(jobs_candidates[job_index]) * (segment_end - segment_start)
+                probability_on_segment = np.reshape(probability_at_pairs[pairs_start:pairs_end], (len(jobs_candidates[job_index]), segment_end - segment_start))
+                probabilities_of_being_correct[job_index] += \
+                    self.sum_over_tile(posteriors_flattened[tile_jobs[segment_start]], tile[segment_start:segment_end], probability_on_segment)
+                pairs_start = pairs_end
+
+        return probabilities_of_being_correct
+
+    def sum_over_tile(self, posterior_flattened, tile, probability_on_tile):
+        " Sum over the target locations of a tile of the probability of being correct at each candidate given each of them, weighted by the posterior "
+        " It's done in double precision, whatever the precision of the posterior. Both engines sum the same tiles in the same order, "
+        " so that the result doesn't depend on the jobs computed along with it "
+        """ Input:
+                posterior_flattened (1D array)  : flattened probability map
+                tile (1D array of ints)         : flattened indexes of the target locations
+                probability_on_tile (2D array)  : probability of being correct at each candidate (rows) given that the target is at each location of the tile (columns)
+            Output:
+                probability_of_being_correct (1D array) : weighted sum at each candidate
+        """
+        return np.nansum(posterior_flattened[tile].astype(np.float64) * probability_on_tile, axis=1)
+
+    def visibility_at_fixation(self, fixation):
+        " Visibility map used to compute the probability of being correct, floored at self.visibility_floor "
+        visibility_map = self.visibility_map.at_fixation(fixation)
+        if self.visibility_floor:
+            np.maximum(visibility_map, self.visibility_floor, out=visibility_map)
+
+        return visibility_map
+
+    def log_ratios_tiles(self, posterior, target_locations):
+        " The term -2 * log(posterior / posterior at the target location) of b doesn't depend on the possible next fixation "
+        " It's computed once for every candidate, in tiles of target locations which hold about LOG_RATIOS_TILE_SIZE elements "
+        """ Input:
+                posterior (2D array) : probability map of the size of the grid
+                target_locations (1D array of ints) : flattened indexes of the possible target locations
+            Output:
+                Generator of (tile, log_ratios), where tile (1D array of ints) is a subset of target_locations and log_ratios (2D array)
+                holds the flattened term for each of the target locations in tile
+        """
+        posterior_flattened = posterior.flatten()
+        tile_size = max(LOG_RATIOS_TILE_SIZE // len(posterior_flattened), 1)
+        for tile_start in range(0, len(target_locations), tile_size):
+            tile = target_locations[tile_start:tile_start + tile_size]
+
+            yield tile, -2 * np.log(posterior_flattened[np.newaxis, :] / posterior_flattened[tile][:, np.newaxis])
+
+    def log_ratios_tiles_of_jobs(self, posteriors_flattened, jobs_target_locations):
+        " Same as log_ratios_tiles, for the posterior and target locations of several jobs. The rows of each tile go through the target locations of every job in order "
+        " The target locations of each job are split in the same tiles as in log_ratios_tiles, which are never split further. Small ones are put together "
+        """ Input:
+                posteriors_flattened  (2D array)                : flattened probability map of each job
+                jobs_target_locations (list of 1D arrays of ints) : flattened indexes of the possible target locations of each job
+            Output:
+                Generator of (tile_jobs, tile, log_ratios), where tile_jobs (1D array of ints) and tile (1D array of ints) are the job and the target location
+                of each row, and log_ratios (2D array) holds the flattened term for each row
+        """
+        rows_jobs      = np.concatenate([np.full(len(target_locations), job, dtype=int) for job, target_locations in enumerate(jobs_target_locations)])
+        rows_locations = np.concatenate(jobs_target_locations)
+        tile_size = max(LOG_RATIOS_TILE_SIZE // posteriors_flattened.shape[1], 1)
+        # Rows where each tile of log_ratios_tiles ends
+        jobs_ends   = np.cumsum([len(target_locations) for target_locations in jobs_target_locations])
+        jobs_starts = jobs_ends - [len(target_locations) for target_locations in jobs_target_locations]
+        blocks_ends = np.concatenate([np.append(np.arange(job_start + tile_size, job_end, tile_size), job_end) \
+            for job_start, job_end in zip(jobs_starts, jobs_ends) if job_end > job_start] + [np.empty(shape=0, dtype=int)])
+        tile_start  = 0
+        while tile_start < len(rows_jobs):
+            tile_end  = blocks_ends[np.searchsorted(blocks_ends, tile_start + tile_size, side='right') - 1]
+            tile_jobs = rows_jobs[tile_start:tile_end]
+            tile      = rows_locations[tile_start:tile_end]
+
+            yield tile_jobs, tile, -2 * np.log(posteriors_flattened[tile_jobs] / posteriors_flattened[tile_jobs, tile][:, np.newaxis])
+            tile_start = tile_end
+
+    def compute_conditional_probabilities(self, target_locations, visibility_maps, log_ratios, alpha):
+        " Vectorized version of compute_conditional_probability, where each row of visibility_maps is paired with a possible target location "
+        """ Input:
+                target_locations (1D array of ints) : flattened index of the possible target location of each pair
+                visibility_maps  (2D array)         : flattened visibility map at the possible next fixation of each pair
+                log_ratios       (2D array)         : flattened term -2 * log(posterior / posterior at the target location) of each pair
+            Output:
+                probabilities (1D array) : probability of being correct for each pair
+        """
+        pairs = np.arange(len(target_locations))
+        visibility_at_target_locations = visibility_maps[pairs, target_locations]
+
+        # b = (log_ratios + visibility_maps ** 2 + visibility_at_target_locations ** 2) / (2 * visibility_maps), computed in the scratch buffers
+        b = np.square(visibility_maps, out=self.scratch_buffer('b', visibility_maps.shape))
+        np.add(log_ratios, b, out=b)
+        b += np.square(visibility_at_target_locations)[:, np.newaxis]
+        double_visibility_maps = np.multiply(visibility_maps, 2, out=self.scratch_buffer('double_visibility_maps', visibility_maps.shape))
+        b /= double_visibility_maps
+        m = np.divide(visibility_at_target_locations[:, np.newaxis], visibility_maps, out=self.scratch_buffer('m', visibility_maps.shape))
+
+        # We ensure the product is only for i != j (normcdf(1000000) = 1)
+        m[pairs, target_locations] = 0
+        b[pairs, target_locations] = 1000000
+
+        # Check the limits of the integral (normcdf(-20) = 0 and so will be the product)
+        # The limits of w for which each normcdf is greater than normcdf(-20), where m > 0, reuse the memory of 2 * visibility_maps
+        lower_limits = np.subtract(-20, b, out=double_visibility_maps)
+        lower_limits /= m
+        np.copyto(lower_limits, -np.inf, where=np.logical_not(np.greater(m, 0, out=self.scratch_buffer('positive_m', m.shape, dtype=bool))))
+        min_w = np.maximum(np.max(lower_limits, axis=1), -20)
+        min_w[visibility_at_target_locations == 0] = -20
+        max_w = 20
+
+        # Pairs where the integral's limits are empty have zero probability, there's no need to compute them
+        probabilities = np.zeros(shape=len(target_locations), dtype=self.dtype)
+        to_integrate  = np.flatnonzero(np.logical_not(min_w >= max_w))
+        batch_size    = max(VECTORIZED_BATCH_SIZE // (visibility_maps.shape[1] * self.quadrature.number_of_nodes), 1)
+        for batch_start in range(0, len(to_integrate), batch_size):
+            batch   = to_integrate[batch_start:batch_start + batch_size]
+            m_batch = np.take(m, batch, axis=0, out=self.scratch_buffer('m_batch', (len(batch), m.shape[1])))
+            b_batch = np.take(b, batch, axis=0, out=self.scratch_buffer('b_batch', (len(batch), b.shape[1])))
+            probabilities[batch] = self.integrate_conditional_probabilities(m_batch, b_batch, min_w[batch], max_w, alpha)
+
+        return probabilities
+
+    def integrate_conditional_probabilities(self, m, b, min_w, max_w, alpha):
+        " Integral of compute_conditional_probability, evaluated for every row of m and b at once "
+        def integrand(rows, w_range):
+            return self.product_of_normcdfs(m[rows], b[rows], w_range, alpha)
+
+        return self.quadrature.integrate(integrand, min_w, max_w)
+
+    def product_of_normcdfs(self, m, b, w_range, alpha):
+        " For each row of m and b, computes the product over every cell of normcdf(m * w + b) at each value of w in the corresponding row of w_range "
+        " The tensor of values is held in a scratch buffer and every operation is done in place "
+        shape = (m.shape[0], m.shape[1], w_range.shape[1])
+        # Nodes of some quadrature rules are always in double precision
+        w_range = w_range.astype(self.dtype, copy=False)
+        values_for_normcdf = np.multiply(m[:, :, np.newaxis], w_range[:, np.newaxis, :], out=self.scratch_buffer('values_for_normcdf', shape))
+        values_for_normcdf += b[:, :, np.newaxis]
+        np.copyto(values_for_normcdf, 1, where=np.isnan(values_for_normcdf, out=self.scratch_buffer('nan_values', shape, dtype=bool)))
 
-                probability_at_each_fixation[possible_nextfix_row, possible_nextfix_column] = np.nansum(posterior * probability_of_being_correct)
+        # Use the chosen backend to get the values needed
+        normcdf_at_values = self.norm_cdf(values_for_normcdf, out=values_for_normcdf)
+        normcdf_at_values *= alpha
 
+        return np.prod(normcdf_at_values, axis=1) / alpha
 
-    def compute_conditional_probability(self, target_location_row, target_location_column, posterior, visibility_map_at_fixation, alpha):
+    def compute_conditional_probability(self, target_location_row, target_location_column, posterior, visibility_map_at_fixation, log_ratio, alpha):
         " Computes the probability of being correct given the visibility map of the next fixation and that the true target location is (target_location_row, target_location_column) "
-        posterior_at_target_location  = posterior[target_location_row, target_location_column]
+        " log_ratio is the term -2 * log(posterior / posterior at the target location), which is the same for every possible next fixation "
         visibility_at_target_location = visibility_map_at_fixation[target_location_row, target_location_column]
 
-        b = (-2 * np.log(posterior / posterior_at_target_location) + np.square(visibility_map_at_fixation) \
-             + np.square(visibility_at_target_location)) / (2 * visibility_map_at_fixation)
+        b = (log_ratio + np.square(visibility_map_at_fixation) + np.square(visibility_at_target_location)) / (2 * visibility_map_at_fixation)
         m =  visibility_at_target_location /  visibility_map_at_fixation
 
         # We ensure the product is only for i != j (normcdf(1000000) = 1)
@@ -154,17 +600,22 @@ class BayesianModel:
 
         if min_w >= max_w: return 0
 
-        # TODO: Explicar ese 50 mágico
-        w_range = np.linspace(min_w, max_w, 50)
+        # The integral is computed with the chosen quadrature rule
+        probability = self.integrate_conditional_probabilities(m.flatten()[np.newaxis, :], b.flatten()[np.newaxis, :], np.array([min_w]), max_w, alpha)
 
-        values_for_normcdf = np.matmul(m.flatten()[:, np.newaxis], w_range[np.newaxis, :]) + np.tile(b.flatten()[:, np.newaxis], (1, len(w_range)))
-        values_for_normcdf[np.isnan(values_for_normcdf)] = 1
+        return probability[0]
 
-        # Use the previously computed normcdf table to get the values needed
-        normcdf_at_values = np.interp(values_for_normcdf, self.norm_cdf_table['x'], self.norm_cdf_table['y'])
-        #normcdf_at_values = interp1d(self.norm_cdf_table['x'], self.norm_cdf_table['y'], kind='nearest', fill_value='extrapolate')(values_for_normcdf)
+# Copy of the model held by each worker of the pool
+worker_model = None
 
-        phi_w  = np.exp(-0.5 * np.square(w_range)) / np.sqrt(2 * np.pi)
-        points = phi_w[np.newaxis, :] * (np.prod(alpha * normcdf_at_values, axis=0) / alpha)
+def initialize_worker(model):
+    " Executed once by each worker of the pool when it starts. The model, with its visibility map and normal cdf backend, is kept for the whole run "
+    global worker_model
+    # Interruptions are handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_model = model
 
-        return np.trapz(points, w_range)
\ No newline at end of file
+def proc_compute_probability_on_chunk(chunk):
+    " This function is executed by each worker of the pool, were number_of_processes to be greater than one "
+    " It runs on a list of jobs, each with a subset of the candidates, whose probability of being correct is returned "
+    return worker_model.compute_probability_of_being_correct_on_jobs(chunk)
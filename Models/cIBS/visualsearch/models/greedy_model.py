@@ -2,7 +2,11 @@ import numpy as np
 
 class GreedyModel:
     def __init__(self):
-        pass
+        # Every cell is taken into account, no posterior mass is left out
+        self.dropped_posterior_mass = 0
+        # Candidates aren't screened
+        self.screening_outcome  = None
+        self.screening_mismatch = None
 
     def next_fixation(self, posterior):
         " Given the posterior for each cell in the grid, this function computes the next fixation by searching for the maximum values from it "
@@ -14,4 +18,11 @@ class GreedyModel:
         coordinates = np.where(posterior == np.amax(posterior))
         next_fix    = (coordinates[0][0], coordinates[1][0])
 
-        return next_fix
\ No newline at end of file
+        return next_fix
+
+    def next_fixations(self, posteriors, trial_states):
+        " Next fixation of each trial of a batch. Since nothing is left out or screened, the trial states are left as they are "
+        return [self.next_fixation(posterior) for posterior in posteriors]
+
+    def close(self):
+        pass
@@ -0,0 +1,132 @@
+import argparse
+import time
+import numpy as np
+from scipy.stats import norm
+from scipy.special import ndtr
+
+" Backends for evaluating the cumulative distribution function of the standard normal distribution, used by bayesian search. table is the recommended default "
+" Run python -m visualsearch.models.norm_cdf to compare their accuracy and speed "
+
+BACKENDS = ['table', 'uniform_table', 'ndtr', 'erf']
+
+def create(backend, norm_cdf_tolerance):
+    " Returns the normal cdf backend with the given name "
+    """ Input:
+            backend (string)           : table, uniform_table, ndtr, erf
+            norm_cdf_tolerance (float) : for tables, value from which to compute the normal distribution probabilities
+        Output:
+            norm_cdf (NormCdf) : callable object which evaluates the normal cdf at each value of an array
+    """
+    if backend == 'table':
+        return Table(norm_cdf_tolerance)
+    elif backend == 'uniform_table':
+        return UniformTable(norm_cdf_tolerance)
+    elif backend == 'ndtr':
+        return Ndtr()
+    elif backend == 'erf':
+        return Erf()
+    else:
+        raise NameError('Unknown normal cdf backend: ' + backend)
+
+class NormCdf:
+    def __call__(self, values, out=None):
+        " Each subclass evaluates the normal cdf with its own method "
+        " If out is given, backends which can evaluate it in place store the result there, which may be values itself. The returned array must be used "
+        pass
+
+    def max_error(self, lower_limit=-20, upper_limit=20, number_of_values=400001):
+        " Maximum absolute difference with scipy's normal cdf in the interval [lower_limit, upper_limit] "
+        values = np.linspace(lower_limit, upper_limit, number_of_values)
+
+        return np.max(np.abs(self(values) - ndtr(values)))
+
+class Table(NormCdf):
+    " Linear interpolation over a table whose values are evenly spaced in probability. Each evaluation does a binary search "
+    def __init__(self, norm_cdf_tolerance):
+        # Row values go from norm_cdf_tolerance to 1 - norm_cdf_tolerance
+        self.x = norm.ppf(np.arange(start=norm_cdf_tolerance, stop=1, step=norm_cdf_tolerance))
+        self.y = norm.cdf(self.x)
+
+    def __call__(self, values, out=None):
+        return np.interp(values, self.x, self.y)
+
+class UniformTable(NormCdf):
+    " Linear interpolation over a table evenly spaced in x, with the same range and size as Table. The position of each value in the table is computed directly "
+    " Values can't be NaN "
+    def __init__(self, norm_cdf_tolerance):
+        number_of_rows = len(np.arange(start=norm_cdf_tolerance, stop=1, step=norm_cdf_tolerance))
+        self.start = norm.ppf(norm_cdf_tolerance)
+        self.end   = norm.ppf(1 - norm_cdf_tolerance)
+        self.step  = (self.end - self.start) / (number_of_rows - 1)
+        self.y     = norm.cdf(np.linspace(self.start, self.end, number_of_rows))
+        # Differences between consecutive rows, with a zero at the end for values at the upper limit
+        self.slopes = np.append(np.diff(self.y), 0)
+
+    def __call__(self, values, out=None):
+        # Operations are done in place, since there are as many values as in the tensors of bayesian search
+        positions = np.subtract(values, self.start, out=out)
+        positions /= self.step
+        np.clip(positions, 0, len(self.y) - 1, out=positions)
+        rows = positions.astype(np.intp)
+        positions -= rows
+        positions *= np.take(self.slopes, rows)
+        positions += np.take(self.y, rows)
+
+        return positions
+
+class Ndtr(NormCdf):
+    " Exact values, from scipy "
+    def __call__(self, values, out=None):
+        return ndtr(values, out=out)
+
+class Erf(NormCdf):
+    " Polynomial approximation of erf from Abramowitz and Stegun (7.1.26), with a maximum error of 1.5e-7 "
+    p = 0.3275911
+    coefficients = [1.061405429, -1.453152027, 1.421413741, -0.284496736, 0.254829592]
+
+    def __call__(self, values, out=None):
+        # The approximation is for positive values, normcdf(-x) = 1 - normcdf(x) is used for negative ones
+        positive_values = values >= 0
+        x = np.abs(values, out=out)
+        x /= np.sqrt(2)
+        t = x * self.p
+        t += 1
+        np.reciprocal(t, out=t)
+        polynomial = t * self.coefficients[0]
+        for coefficient in self.coefficients[1:]:
+            polynomial += coefficient
+            polynomial *= t
+        np.square(x, out=x)
+        np.negative(x, out=x)
+        np.exp(x, out=x)
+        # Half of the complement of erf
+        polynomial *= x
+        polynomial *= 0.5
+        np.subtract(1, polynomial, out=polynomial, where=positive_values)
+
+        return polynomial
+
+def benchmark(norm_cdf_tolerance, number_of_values, repetitions):
+    " Prints the maximum absolute error and the time taken by each backend to evaluate number_of_values values "
+    # Values are similar to those of bayesian search, where most of them fall on the tails
+    values = np.random.RandomState(0).standard_normal(number_of_values) * 5
+
+    print('Backend         Max. error   Time (ms)')
+    for backend in BACKENDS:
+        norm_cdf = create(backend, norm_cdf_tolerance)
+        start = time.time()
+        for _ in range(repetitions):
+            norm_cdf(values)
+        time_elapsed = (time.time() - start) / repetitions
+
+        print(backend.ljust(15) + ' ' + '{:.2e}'.format(norm_cdf.max_error()).ljust(12) + ' ' + str(round(time_elapsed * 1000, 3)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the normal cdf backends of bayesian search')
+    parser.add_argument('--tol', '--norm_cdf_tolerance', type=float, default=0.001, help='Tolerance used to build the tables')
+    parser.add_argument('--n', '--number_of_values', type=int, default=10 ** 6, help='Number of values evaluated by each backend')
+    parser.add_argument('--r', '--repetitions', type=int, default=10, help='Number of times each backend is timed')
+
+    args = parser.parse_args()
+
+    benchmark(args.tol, args.n, args.r)
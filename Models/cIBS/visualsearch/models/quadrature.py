@@ -0,0 +1,141 @@
+import numpy as np
+from numpy.polynomial.legendre  import leggauss
+from numpy.polynomial.hermite_e import hermegauss
+
+" Quadrature rules for the integral of the probability of being correct, which has the form of the integral of phi(w) * f(w) dw from min_w to max_w "
+" where phi is the standard normal density and f is the product of the normal cdfs. Each rule integrates a batch of integrals, one for each row "
+
+# Maximum number of times a panel can be halved by the adaptive rule
+MAX_ADAPTIVE_DEPTH = 10
+# Since f is at most one, the integral outside of [-PHI_SUPPORT, PHI_SUPPORT] is below the integral of phi there (about 1e-15)
+PHI_SUPPORT = 8
+
+def create(method, number_of_nodes, tolerance):
+    " Returns the quadrature rule with the given name "
+    """ Input:
+            method (string)       : trapezoid, gauss_legendre, gauss_hermite, adaptive
+            number_of_nodes (int) : number of nodes on which the integrand is evaluated. For the adaptive rule, it's the number of nodes of each panel
+            tolerance (float)     : absolute error allowed in each integral. Only used by the adaptive rule, for which it must be positive
+        Output:
+            quadrature (Quadrature) : object which integrates a batch of integrals
+    """
+    if method == 'trapezoid':
+        return Trapezoid(number_of_nodes)
+    elif method == 'gauss_legendre':
+        return GaussLegendre(number_of_nodes)
+    elif method == 'gauss_hermite':
+        return GaussHermite(number_of_nodes)
+    elif method == 'adaptive':
+        if tolerance is None or not tolerance > 0:
+            raise ValueError('The adaptive quadrature needs a positive tolerance, got ' + str(tolerance))
+        return Adaptive(number_of_nodes, tolerance)
+    else:
+        raise NameError('Unknown quadrature method: ' + method)
+
+def phi(w_range):
+    return np.exp(-0.5 * np.square(w_range)) / np.sqrt(2 * np.pi)
+
+class Quadrature:
+    def __init__(self, number_of_nodes):
+        self.number_of_nodes = number_of_nodes
+
+    def integrate(self, integrand, min_w, max_w):
+        " Each subclass integrates with its own rule "
+        """ Input:
+                integrand (function) : given the indexes of some rows (or a slice) and the values of w for each of them (2D array), it returns f evaluated at those values
+                min_w (1D array)     : lower limit of each integral
+                max_w (float)        : upper limit of every integral
+            Output:
+                integrals (1D array) : value of each integral
+        """
+        pass
+
+class Trapezoid(Quadrature):
+    " Evenly spaced nodes between min_w and max_w "
+    def integrate(self, integrand, min_w, max_w):
+        w_range = np.linspace(min_w, max_w, self.number_of_nodes, axis=1)
+        points  = phi(w_range) * integrand(slice(None), w_range)
+
+        return np.trapz(points, w_range, axis=1)
+
+class GaussLegendre(Quadrature):
+    " Gauss-Legendre nodes of a fixed order, mapped to the interval [min_w, max_w] clipped to where phi is not negligible "
+    def __init__(self, number_of_nodes):
+        super().__init__(number_of_nodes)
+        self.nodes, self.weights = leggauss(number_of_nodes)
+
+    def integrate(self, integrand, min_w, max_w):
+        panels_start, panels_end = self.clip(min_w, max_w)
+
+        return self.integrate_on_panels(integrand, slice(None), panels_start, panels_end)
+
+    def clip(self, min_w, max_w):
+        panels_start = np.clip(min_w, -PHI_SUPPORT, PHI_SUPPORT)
+        panels_end   = np.maximum(np.minimum(max_w, PHI_SUPPORT), panels_start)
+
+        return panels_start, panels_end
+
+    def integrate_on_panels(self, integrand, rows, panels_start, panels_end):
+        " Integrates each row on its own interval [panels_start, panels_end] "
+        half_length = (panels_end - panels_start)[:, np.newaxis] / 2
+        middle      = (panels_end + panels_start)[:, np.newaxis] / 2
+        w_range     = half_length * self.nodes[np.newaxis, :] + middle
+
+        return np.sum(half_length * self.weights[np.newaxis, :] * phi(w_range) * integrand(rows, w_range), axis=1)
+
+class GaussHermite(Quadrature):
+    " Gauss-Hermite nodes for the weight phi over the whole real line. Nodes outside of [min_w, max_w], where f is considered to be zero, are discarded "
+    def __init__(self, number_of_nodes):
+        super().__init__(number_of_nodes)
+        nodes, weights = hermegauss(number_of_nodes)
+        self.nodes   = nodes
+        self.weights = weights / np.sqrt(2 * np.pi)
+
+    def integrate(self, integrand, min_w, max_w):
+        w_range = np.tile(self.nodes[np.newaxis, :], (len(min_w), 1))
+        weights = np.where((w_range >= min_w[:, np.newaxis]) & (w_range <= max_w), self.weights[np.newaxis, :], 0)
+
+        return np.sum(weights * integrand(slice(None), w_range), axis=1)
+
+class Adaptive(GaussLegendre):
+    " Gauss-Legendre on panels which are halved until the estimates of each panel and its halves differ by less than their share of the tolerance "
+    def __init__(self, number_of_nodes, tolerance):
+        super().__init__(number_of_nodes)
+        self.tolerance = tolerance
+
+    def integrate(self, integrand, min_w, max_w):
+        integrals = np.zeros(shape=len(min_w))
+        panels_start, panels_end = self.clip(min_w, max_w)
+        # Empty panels add nothing to the integrals, there's no point in evaluating them. Invalid limits are kept, so that their integral is NaN
+        rows = np.flatnonzero(np.logical_not(panels_end <= panels_start))
+        if not len(rows):
+            return integrals
+        # Pending panels, given by their row, limits, estimate, share of the tolerance and depth. Each half of a panel gets half of its tolerance
+        panels = {'rows' : rows, 'start' : panels_start[rows], 'end' : panels_end[rows], 'tolerance' : np.full(shape=len(rows), fill_value=self.tolerance), \
+            'depth' : np.zeros(shape=len(rows), dtype=int)}
+        panels['value'] = self.integrate_on_panels(integrand, rows, panels['start'], panels['end'])
+
+        # Panels are refined in batches of at most as many as integrals were given, so that the integrand isn't evaluated on more rows than the caller allows
+        batch_size = len(min_w)
+        while len(panels['rows']):
+            batch  = {key : values[:batch_size] for key, values in panels.items()}
+            panels = {key : values[batch_size:] for key, values in panels.items()}
+
+            batch_middle   = (batch['start'] + batch['end']) / 2
+            left_values    = self.integrate_on_panels(integrand, batch['rows'], batch['start'], batch_middle)
+            right_values   = self.integrate_on_panels(integrand, batch['rows'], batch_middle, batch['end'])
+            refined_values = left_values + right_values
+
+            converged = np.abs(refined_values - batch['value']) <= batch['tolerance']
+            # Invalid integrals won't converge, there's no point in halving them
+            converged = converged | np.isnan(refined_values) | (batch['depth'] == MAX_ADAPTIVE_DEPTH)
+            np.add.at(integrals, batch['rows'][converged], refined_values[converged])
+
+            # Halve the panels which haven't converged
+            pending = np.logical_not(converged)
+            halves  = {'rows' : np.tile(batch['rows'][pending], 2), 'start' : np.concatenate((batch['start'][pending], batch_middle[pending])), \
+                'end' : np.concatenate((batch_middle[pending], batch['end'][pending])), 'tolerance' : np.tile(batch['tolerance'][pending] / 2, 2), \
+                'depth' : np.tile(batch['depth'][pending] + 1, 2), 'value' : np.concatenate((left_values[pending], right_values[pending]))}
+            panels  = {key : np.concatenate((panels[key], halves[key])) for key in panels}
+
+        return integrals
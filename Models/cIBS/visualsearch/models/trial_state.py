@@ -0,0 +1,11 @@
+class TrialState:
+    " Results of the search of a trial searched in lockstep with others, which the models update at each call to next_fixations "
+    " When trials are searched one at a time, the model holds them itself "
+    def __init__(self):
+        # Posterior mass of the target locations left out in the last saccade
+        self.dropped_posterior_mass = 0
+        # Outcome of the screening in the last saccade (None, 'screened' or 'fallback') and, if validated, whether it chose a different fixation
+        self.screening_outcome  = None
+        self.screening_mismatch = None
+        # Number of candidates on which branch and bound computed the probability of being correct at every target location, in the last saccade
+        self.fully_evaluated_candidates = None
@@ -1,32 +1,61 @@
 import numpy as np
-from os import path
+import hashlib
+from os import getpid, makedirs, path, replace
 from .utils import utils
 from .utils.deepgaze.create_saliencymap import create_saliencymap_for_image
 
-def load(image, image_name, image_size, prior_name, prior_dir):
-    " Returns initial probability of the target being there for each position in the image "
+def load(image, image_name, image_size, prior_name, prior_dir, grid, cache_dir=None):
+    " Returns initial probability of the target being there for each cell of the grid "
     """ Input:
             image      (2D array) : image on which to compute the prior
             image_name (string)   : name of the image
             image_size (int, int) : size of the image
             prior_name (string)   : what to use as prior (possible values are deepgaze, center, icf, etc.)
             prior_dir  (string)   : where to look for the prior images. It uses the prior_name as subdirectory
-            cell_size  (int, int) : size of the cells in the grid
+            grid       (Grid)     : grid to which the prior is reduced
+            cache_dir  (string)   : folder path where priors are stored once reduced to the grid, so that the prior image isn't decoded again. If None, they're always computed
         Output:
-            prior (2D array) : prior corresponding to the image, of the same size
+            grid_prior (2D array) : mean of the normalized prior over each cell of the grid
     """
     prior_path = prior_dir + prior_name + '/'
     if prior_name == 'noisy':
-        prior = utils.add_white_gaussian_noise(np.ones(shape=image_size), snr_db=25)
-    else:
-        if not path.exists(path.join(prior_path, image_name)):
-            create_saliencymap_for_image(image, path.join(prior_path, image_name))
-        prior = utils.load_image(prior_path, image_name)
+        # It's different every time, so it's not cached
+        return reduce_to_grid(utils.add_white_gaussian_noise(np.ones(shape=image_size), snr_db=25), grid)
 
+    if not path.exists(path.join(prior_path, image_name)):
+        create_saliencymap_for_image(image, path.join(prior_path, image_name))
+    if cache_dir is None:
+        return reduce_to_grid(utils.load_image(prior_path, image_name), grid)
+
+    # The prior image is hashed instead of decoded. If it changes, so does the name of the cached prior
+    cache_file = path.join(cache_dir, cache_key(prior_path, image_name, prior_name, grid) + '.npy')
+    if path.exists(cache_file):
+        return np.load(cache_file)
+
+    grid_prior = reduce_to_grid(utils.load_image(prior_path, image_name), grid)
+    makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first, so that other processes never read an incomplete one
+    temporary_file = cache_file + '.' + str(getpid()) + '.tmp'
+    with open(temporary_file, 'wb') as cache:
+        np.save(cache, grid_prior)
+    replace(temporary_file, cache_file)
+
+    return grid_prior
+
+def reduce_to_grid(prior, grid):
     # Normalize values
     prior = prior / np.max(prior)
 
-    return prior
+    return grid.reduce(prior, mode='mean')
+
+def cache_key(prior_path, image_name, prior_name, grid):
+    " Name of the prior, the image and the cell size, followed by a hash of the bytes of the prior image and the size of the grid "
+    key_hash = hashlib.sha256()
+    with open(path.join(prior_path, image_name), 'rb') as prior_file:
+        key_hash.update(prior_file.read())
+    key_hash.update((str(grid.cell_size) + str(grid.size())).encode())
+
+    return prior_name + '_' + path.splitext(image_name)[0] + '_' + str(grid.cell_size) + '_' + key_hash.hexdigest()
 
 # TODO: Definir para qué sirve la función y asignarle mejores nombres
 def sum(prior, max_saccades):
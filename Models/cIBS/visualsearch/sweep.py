@@ -0,0 +1,249 @@
+from .visibility_map  import VisibilityMap
+from .visual_searcher import VisualSearcher
+from .grid import Grid
+from .utils import utils
+from .utils import checkpoint_log
+from .utils import metrics
+from .main import load_trial_images, PREFETCHED_BATCHES
+from . import prior
+from multiprocessing import Pool
+from functools import partial
+from os import makedirs
+import numpy as np
+import json
+import signal
+import time
+import sys
+
+" Runs the visual search model with several configurations on the same trials. What doesn't depend on the configuration is computed once "
+" Images and targets are loaded once per trial, priors once per trial, prior and cell size, and grids and visibility maps once per cell size "
+" Target similarity maps are computed once per trial, method and cell size, and then read from the dataset's target_similarity_dir "
+
+# Fields of the configurations which only affect how the sweep is executed, and which may thus change when it's resumed
+EXECUTION_FIELDS = ['proc_number', 'trial_processes', 'trial_batch_size', 'save_probability_maps']
+
+def run(configs, dataset_info, trials_properties, output_path, sigma):
+    """ Input:
+            Configs (dict) : configurations to run, indexed by name. Each one has the fields described in main.run.
+                proc_number, trial_processes, trial_batch_size and save_probability_maps must be the same in all of them
+            Dataset info (dict) and trials properties (dict) : as in main.run
+            Output path (string) : folder path in which a subfolder is created for each configuration, named after it
+        Output:
+            Output_path/config_name/Scanpaths.json: scanpaths of the configuration, as in main.run
+            Output_path/config_name/metrics.jsonl: seconds spent by each trial of the configuration in each phase of the search, as in main.run.
+            Images and priors shared by several configurations are loaded once, and that time is recorded in each of them
+        Each configuration keeps its own checkpoint log, so an interrupted sweep resumes where each of them was left. If a configuration has changed since, save for
+        the fields in EXECUTION_FIELDS, its checkpoint is only discarded if the user agrees. Otherwise, the sweep stops
+    """
+    image_size       = (dataset_info['image_height'], dataset_info['image_width'])
+    execution_config = next(iter(configs.values()))
+
+    # Grids and visibility maps only depend on the cell size
+    visibility_maps = {}
+    for cell_size in set(config['cell_size'] for config in configs.values()):
+        grid = Grid(np.array(image_size), cell_size)
+        visibility_maps[cell_size] = (grid, VisibilityMap(image_size, grid, sigma))
+
+    configs_runs = {config_name : ConfigRun(config, config_output_path(output_path, config_name), trials_properties) for config_name, config in configs.items()}
+    for config_name, config_run in configs_runs.items():
+        if config_run.scanpaths:
+            print(config_name + ': resuming, ' + str(len(config_run.scanpaths)) + ' trials already searched')
+
+    print('Press Ctrl + C to interrupt execution and save a checkpoint \n')
+
+    # Each trial is searched by the configurations which haven't searched it yet. Trials already searched by every configuration are skipped
+    pending_trials = [(trial, [config_name for config_name, config_run in configs_runs.items() if config_run.is_pending(trial)]) for trial in trials_properties]
+    pending_trials = [(trial, configs_names) for trial, configs_names in pending_trials if configs_names]
+    trials       = [(trial, index + 1, len(pending_trials), configs_names) for index, (trial, configs_names) in enumerate(pending_trials)]
+    # Priors are reduced to the grid of each configuration
+    configs_priors = {config_name : (config['prior'], config['cell_size']) for config_name, config in configs.items()}
+    grids          = {cell_size : grid for cell_size, (grid, _) in visibility_maps.items()}
+    batch_size   = execution_config['trial_batch_size']
+    batches      = [trials[batch_start:batch_start + batch_size] for batch_start in range(0, len(trials), batch_size)]
+    searchers    = None
+    trials_pool  = None
+    try:
+        if execution_config['trial_processes'] > 1:
+            # Each process holds a visual searcher for every configuration, and searches a whole batch of trials with all of them
+            trials_pool    = Pool(execution_config['trial_processes'], initializer=initialize_sweep_worker, \
+                initargs=(configs, visibility_maps, output_path, dataset_info['target_similarity_dir'], ))
+            trials_results = trials_pool.imap_unordered(search_trials_in_worker, [(batch, configs_priors, grids, dataset_info, image_size) for batch in batches])
+        else:
+            searchers      = initialize_searchers(configs, visibility_maps, output_path, dataset_info['target_similarity_dir'])
+            # The images of the next batches are loaded while searching the current one
+            loaded_batches = utils.prefetch(partial(load_trials, configs_priors=configs_priors, grids=grids, dataset_info=dataset_info, image_size=image_size), batches, PREFETCHED_BATCHES)
+            trials_results = (search_loaded_trials(searchers, batch, trials_images, priors, load_timings, configs_priors, image_size) \
+                for batch, trials_images, priors, load_timings in loaded_batches)
+
+        for batch_results in trials_results:
+            for config_name, config_results in batch_results.items():
+                configs_runs[config_name].add_results(config_results, visibility_maps[configs[config_name]['cell_size']][0], dataset_info['name'])
+        for config_run in configs_runs.values():
+            config_run.metrics_log.finish()
+    except KeyboardInterrupt:
+        print('\nCheckpoints saved at ' + output_path)
+        print('Run the script again to resume execution')
+        sys.exit(0)
+    finally:
+        for config_run in configs_runs.values():
+            config_run.close()
+        if searchers is not None:
+            for visual_searcher in searchers.values():
+                visual_searcher.close()
+        if trials_pool is not None:
+            trials_pool.terminate()
+            trials_pool.join()
+
+    print('Configuration'.ljust(40) + ' Targets found   Time elapsed (s)')
+    for config_name, config_run in configs_runs.items():
+        config_run.finish()
+        print(config_name.ljust(40) + ' ' + (str(config_run.targets_found) + '/' + str(len(config_run.scanpaths))).ljust(15) + ' ' + str(round(config_run.time_elapsed, 4)))
+
+def config_output_path(output_path, config_name):
+    return output_path + config_name + '/'
+
+def initialize_searchers(configs, visibility_maps, output_path, target_similarity_dir):
+    " Creates a visual searcher for each configuration, on the grid and visibility map of its cell size "
+    visual_searchers = {}
+    for config_name, config in configs.items():
+        grid, visibility_map = visibility_maps[config['cell_size']]
+        visual_searchers[config_name] = VisualSearcher(config, grid, visibility_map, config_output_path(output_path, config_name), target_similarity_dir)
+
+    return visual_searchers
+
+def search_trials(searchers, batch, configs_priors, grids, dataset_info, image_size):
+    " Loads the images of a batch of trials once, and searches each of them with the configurations given for it "
+    """ Input:
+            batch (list)        : trial properties, trial number, total number of trials and names of the configurations with which to search it, for each trial
+            configs_priors (dict) : prior and cell size of each configuration
+            grids (dict)          : grid of each cell size
+        Output:
+            batch_results (dict) : for each configuration, a list with the image name, the scanpath, the target bounding box and the timings of each trial,
+                                   as in main.search_trials, and the time it took to search them
+    """
+    return search_loaded_trials(searchers, *load_trials(batch, configs_priors, grids, dataset_info, image_size), configs_priors, image_size)
+
+def load_trials(batch, configs_priors, grids, dataset_info, image_size):
+    " Loads the images and targets of a batch of trials, and the priors used by the configurations with which each of them is searched "
+    """ Output:
+            batch (list)          : the batch given
+            trials_images (list)  : image name, image, target, target bounding box and initial fixation of each trial, as returned by main.load_trial_images
+            priors (dict)         : priors of the trials reduced to the grid, indexed by image name, prior name and cell size
+            load_timings (dict)   : seconds spent loading the images of each trial, indexed by image name, and each prior, indexed as priors
+    """
+    trials_images, load_timings = [], {}
+    for trial, _, _, _ in batch:
+        start = time.time()
+        trials_images.append(load_trial_images(trial, dataset_info, image_size))
+        load_timings[trial['image']] = time.time() - start
+    # Each prior is loaded once for each cell size, whatever the number of configurations which use it
+    priors = {}
+    for trial_images, (_, _, _, configs_names) in zip(trials_images, batch):
+        image_name, image = trial_images[0], trial_images[1]
+        for prior_name, cell_size in set(configs_priors[config_name] for config_name in configs_names):
+            start = time.time()
+            priors[(image_name, prior_name, cell_size)] = prior.load(image, image_name, image_size, prior_name, dataset_info['saliency_dir'], grids[cell_size], \
+                dataset_info['grid_priors_dir'])
+            load_timings[(image_name, prior_name, cell_size)] = time.time() - start
+
+    return batch, trials_images, priors, load_timings
+
+def search_loaded_trials(searchers, batch, trials_images, priors, load_timings, configs_priors, image_size):
+    " Searches each trial of a batch whose images have already been loaded with the configurations given for it. The output is that of search_trials "
+    for trial, trial_number, total_trials, _ in batch:
+        print('Searching in image ' + trial['image'] + ' (' + str(trial_number) + '/' + str(total_trials) + ')...')
+
+    batch_results = {}
+    for config_name, visual_searcher in searchers.items():
+        search_args = []
+        for (image_name, image, target, target_bbox, initial_fixation), (_, _, _, configs_names) in zip(trials_images, batch):
+            if config_name in configs_names:
+                search_args.append((image_name, image_size, image, priors[(image_name, *configs_priors[config_name])], target, target_bbox, initial_fixation))
+        if not search_args:
+            continue
+
+        print('Configuration ' + config_name)
+        start = time.time()
+        trials_scanpaths = visual_searcher.search_batch(search_args)
+        batch_results[config_name] = ([(args[0], trial_scanpath, args[5], dict(image_load=load_timings[args[0]], prior_load=load_timings[(args[0], *configs_priors[config_name])], \
+            **trial_scanpath.pop('timings', {}))) for args, trial_scanpath in zip(search_args, trials_scanpaths)], time.time() - start)
+
+    return batch_results
+
+class ConfigRun:
+    " Scanpaths of a configuration of the sweep, and the checkpoint log where they're recorded as they're searched "
+    def __init__(self, config, output_path, trials_properties):
+        makedirs(output_path, exist_ok=True)
+        self.config        = config
+        self.output_path   = output_path
+        self.scanpaths     = {}
+        self.targets_found = 0
+        self.time_elapsed  = 0
+        if checkpoint_log.exists(output_path):
+            checkpoint = checkpoint_log.replay(output_path)
+            if self.resume_checkpoint(checkpoint['configuration']):
+                self.scanpaths, self.targets_found, self.time_elapsed = checkpoint['scanpaths'], checkpoint['targets_found'], checkpoint['time_elapsed']
+            else:
+                checkpoint_log.erase(output_path)
+        self.log = checkpoint_log.CheckpointLog(output_path, config, trials_properties)
+        self.metrics_log = metrics.MetricsLog(output_path, resume=bool(self.scanpaths))
+
+    def resume_checkpoint(self, checkpoint_config):
+        " Checks that the checkpoint was made with the same configuration, save for the fields in EXECUTION_FIELDS. If it wasn't, the user chooses whether to "
+        " discard it and start over or to stop the sweep "
+        # The configuration is compared as it's written in the checkpoint
+        config          = json.loads(json.dumps(self.config))
+        changed_fields  = sorted(field for field in set(config) | set(checkpoint_config) \
+            if field not in EXECUTION_FIELDS and config.get(field) != checkpoint_config.get(field))
+        if not changed_fields:
+            return True
+
+        print(self.output_path + ': checkpoint made with a different configuration. Fields changed: ' + ', '.join(changed_fields))
+        answer = ''
+        while answer not in ['Y', 'N']:
+            answer = input('Discard the checkpoint and search every trial again? Otherwise, the sweep stops (Y/N): ').upper()
+        if answer == 'N':
+            print('Sweep stopped. Restore the configuration or use a different sweep name to keep the checkpoint')
+            sys.exit(-1)
+        print('Checkpoint deleted\n')
+
+        return False
+
+    def is_pending(self, trial):
+        return trial['image'] not in self.scanpaths
+
+    def add_results(self, config_results, grid, dataset_name):
+        " Records the scanpaths of a batch of trials "
+        trials_results, time_elapsed = config_results
+        self.time_elapsed += time_elapsed
+        for image_name, trial_scanpath, target_bbox, trial_timings in trials_results:
+            if trial_scanpath:
+                # If there were no errors, save the scanpath
+                utils.add_scanpath_to_dict(image_name, trial_scanpath, target_bbox, grid, self.config, dataset_name, self.scanpaths)
+                self.log.append(image_name, self.scanpaths[image_name], self.time_elapsed)
+                self.metrics_log.append(image_name, trial_timings)
+                if trial_scanpath['target_found']:
+                    self.targets_found += 1
+
+    def close(self):
+        self.log.close()
+        self.metrics_log.close()
+
+    def finish(self):
+        " Compacts the log into the scanpaths file "
+        utils.save_scanpaths(self.output_path, self.scanpaths)
+        checkpoint_log.erase(self.output_path)
+
+# Visual searchers held by each process of the trials pool, one for each configuration
+worker_visual_searchers = None
+
+def initialize_sweep_worker(configs, visibility_maps, output_path, target_similarity_dir):
+    " Executed once by each process of the trials pool when it starts "
+    global worker_visual_searchers
+    # Interruptions are handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_configs = {config_name : dict(config, proc_number=1) for config_name, config in configs.items()}
+    worker_visual_searchers = initialize_searchers(worker_configs, visibility_maps, output_path, target_similarity_dir)
+
+def search_trials_in_worker(batch_args):
+    return search_trials(worker_visual_searchers, *batch_args)
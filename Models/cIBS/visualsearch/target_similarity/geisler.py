@@ -7,4 +7,6 @@ class Geisler(TargetSimilarity):
         return None
     
     def add_info_to_mu(self, target_similarity_info, visibility_map):
+        # Mu only depends on where the target is
+        self.target_similarity_map = None
         return 
\ No newline at end of file
@@ -12,6 +12,30 @@ from PIL import Image
 """ Full code, including a link to the paper, can be found at https://github.com/kreimanlab/VisualSearchZeroShot """
 """ This code is an adaptation to PyTorch """
 
+# Number of image blocks which go through the CNN at once
+BLOCKS_PER_BATCH = 16
+
+# Trunks of VGG16 used for the image and the target, loaded once by each process
+vgg16_trunks = None
+
+def load_vgg16_trunks():
+    " Builds the trunks of VGG16 the first time it's called in the process. Later calls return the same ones "
+    global vgg16_trunks
+    if vgg16_trunks is None:
+        model = models.vgg16(pretrained=True)
+
+        num_layers = 31
+        model_target = nn.Sequential(*list(model.features.children())[:num_layers])
+        model_image  = nn.Sequential(*list(model.features.children())[:(num_layers - 1)])
+
+        # Set models in evaluation mode
+        model_image.eval()
+        model_target.eval()
+
+        vgg16_trunks = (model_image, model_target)
+
+    return vgg16_trunks
+
 class Ivsn(TargetSimilarity):
     def compute_target_similarity(self, image, target, target_bbox):
         target_height, target_width = 32, 32
@@ -20,19 +44,11 @@ class Ivsn(TargetSimilarity):
         image_blocks = self.divide_into_blocks(image, (block_height, block_width))
 
         # Load the model
-        model = models.vgg16(pretrained=True)
+        model_image, model_target = load_vgg16_trunks()
 
         conv_size = 1
-        num_layers = 31
         num_templates = 512  
 
-        model_target = nn.Sequential(*list(model.features.children())[:num_layers])
-        model_image  = nn.Sequential(*list(model.features.children())[:(num_layers - 1)])   
-
-        # Set models in evaluation mode
-        model_image.eval()
-        model_target.eval() 
-
         MMConv = nn.Conv2d(num_templates, 1, conv_size, padding=1)
 
         target = Image.fromarray(target).convert('RGB')
@@ -42,36 +58,39 @@ class Ivsn(TargetSimilarity):
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         ])
         target = target_transformation(target)
+        image_transformation = transforms.Compose([
+            transforms.Resize((block_height, block_width)),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        ])
+
+        # View as mini-batch of size 1
+        # cast as 32-bit float since the model parameters are 32-bit floats
+        batch_target = target.unsqueeze(0).float()
+        with torch.no_grad():
+            # Target features are the same for every block
+            output_target = model_target(batch_target)
+            MMConv.weight = nn.parameter.Parameter(output_target, requires_grad=False)
 
         target_similarity_map = np.zeros(shape=image.shape[:2])
-        for image_block in image_blocks:
-            block_data = Image.fromarray(image_block['img_block']).convert('RGB')
-            image_transformation = transforms.Compose([
-                transforms.Resize((block_height, block_width)),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-            ])
-            block_data = image_transformation(block_data)
-
-            # View as mini-batch of size 1
-            # cast as 32-bit float since the model parameters are 32-bit floats
-            batch_image  = block_data.unsqueeze(0).float()
-            batch_target = target.unsqueeze(0).float()
+        for batch_start in range(0, len(image_blocks), BLOCKS_PER_BATCH):
+            batch_blocks = image_blocks[batch_start:batch_start + BLOCKS_PER_BATCH]
+            # Every block is resized to the input size of the CNN, so they're stacked in a single mini-batch
+            batch_image  = torch.stack([image_transformation(Image.fromarray(image_block['img_block']).convert('RGB')) for image_block in batch_blocks]).float()
 
             with torch.no_grad():
                 # Get the feature maps
-                output_stimuli = model_image(batch_image) .squeeze()
-                output_target  = model_target(batch_target)
-                MMConv.weight = nn.parameter.Parameter(output_target, requires_grad=False)
+                output_stimuli = model_image(batch_image)
                 # Output is the convolution of both representations
-                out = MMConv(output_stimuli.unsqueeze(0)).squeeze()
-
-            target_similarity_block = transform.resize(out.numpy(), image_block['img_block'].shape[:2])
-            from_row    = image_block['from_row']
-            from_column = image_block['from_column']
-            to_row    = from_row + block_height
-            to_column = from_column + block_width
-            target_similarity_map[from_row:to_row, from_column:to_column] = target_similarity_block
+                out = MMConv(output_stimuli).squeeze(1)
+
+            for image_block, block_out in zip(batch_blocks, out):
+                target_similarity_block = transform.resize(block_out.numpy(), image_block['img_block'].shape[:2])
+                from_row    = image_block['from_row']
+                from_column = image_block['from_column']
+                to_row    = from_row + block_height
+                to_column = from_column + block_width
+                target_similarity_map[from_row:to_row, from_column:to_column] = target_similarity_block
 
         target_similarity_map = exposure.rescale_intensity(target_similarity_map, out_range=(0, 1))
         return target_similarity_map
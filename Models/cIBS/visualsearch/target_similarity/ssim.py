@@ -1,37 +1,84 @@
 from .target_similarity import TargetSimilarity
 import numpy as np
-from skimage import io
-from skimage.metrics import structural_similarity as ssim
+from scipy.ndimage import uniform_filter
+from skimage.util.dtype import dtype_range
+
+""" Target similarity is computed as the structural similarity (SSIM) between the target and each tile of the image """
+""" Tiles have the size of the target and are aligned with its bounding box. All tiles of the same size are compared at once """
+
+# Parameters of skimage.metrics.structural_similarity, whose results are reproduced
+WINDOW_SIZE = 7
+K1, K2      = 0.01, 0.03
 
 class Ssim(TargetSimilarity):
     def compute_target_similarity(self, image, target, target_bbox):
         target_size = np.shape(target)[:2]
         image_size  = np.shape(image)[:2]
         ssim_values = np.zeros(shape=image_size, dtype= np.dtype('float64'))
-        
+
         off_bounds_area = self.get_image_off_bounds_area(target_bbox, target_size, image_size)
         padding_size    =  (np.tile(target_size, 2) - off_bounds_area) % np.tile(target_size, 2)
-        padded_image_shape = tuple(np.array(image_size) + padding_size[0:2] + padding_size[2:4])
         #basicamente agrego como padding lo necesario para que ancho y altura sean multiplos de target_size
         #si la parte que queda fuera de la imagen es 0, no sumo nada, por eso el módulo
-        
-        for row in range(0, padded_image_shape[0], target_size[0]):
-            for column in range(0, padded_image_shape[1], target_size[1]):
-                target_to_use, row_in_image, column_in_image, end_row, end_column= self.handle_image_borders(target, off_bounds_area, row, column, target_size, image_size, padding_size)
-                
-                pixels_in_interval = np.array(image[row_in_image:end_row, column_in_image:end_column])
-                if np.shape(pixels_in_interval)[0] >= 7 and np.shape(pixels_in_interval)[1] >= 7:
-                    ssim_result = ssim(pixels_in_interval, target_to_use)
-                else:
-                    ssim_result = 0
-                ssim_values[row_in_image:end_row, column_in_image:end_column] += ssim_result
 
-        
-        # io.imsave('test_ssim.png',ssim_values) esto es para testear
-        # print('SAVED!')
+        rows_tiles    = self.group_tiles_by_size(self.tiles_along_axis(0, off_bounds_area, target_size, image_size, padding_size))
+        columns_tiles = self.group_tiles_by_size(self.tiles_along_axis(1, off_bounds_area, target_size, image_size, padding_size))
+        # As in skimage, the dynamic range is given by the type of the image
+        data_range = dtype_range[image.dtype.type][1] - dtype_range[image.dtype.type][0]
+
+        for (row_target_start, row_target_end), (first_row, number_of_rows) in rows_tiles.items():
+            for (column_target_start, column_target_end), (first_column, number_of_columns) in columns_tiles.items():
+                target_to_use = target[row_target_start:row_target_end, column_target_start:column_target_end]
+                tile_size     = np.shape(target_to_use)
+                if tile_size[0] < WINDOW_SIZE or tile_size[1] < WINDOW_SIZE:
+                    # Tiles too small for the window have a value of zero
+                    continue
+                # Tiles of the same size are next to each other. Each row of them is compared at once, so that the intermediate arrays are small
+                last_column = first_column + number_of_columns * tile_size[1]
+                for row_in_image in range(first_row, first_row + number_of_rows * tile_size[0], tile_size[0]):
+                    end_row = row_in_image + tile_size[0]
+                    tiles   = image[row_in_image:end_row, first_column:last_column].reshape(tile_size[0], number_of_columns, tile_size[1])
+                    ssim_values[row_in_image:end_row, first_column:last_column] = np.repeat(self.structural_similarity(tiles, target_to_use, data_range), tile_size[1])
 
         return ssim_values
-    
+
+    def structural_similarity(self, tiles, target, data_range):
+        " Mean structural similarity between each tile and the target, computed as skimage.metrics.structural_similarity does with its default parameters "
+        """ Input:
+                tiles (3D array)   : row of tiles, indexed by (row in tile, tile, column in tile)
+                target (2D array)  : image of the same size as each tile
+                data_range (float) : dynamic range of the images
+            Output:
+                mean_ssim (1D array) : mean structural similarity of each tile
+        """
+        tiles  = tiles.astype(np.float64)
+        target = target.astype(np.float64)
+        # Local means and covariances are computed over a window which only moves within each tile. The target's are the same for every tile
+        window_size = (WINDOW_SIZE, 1, WINDOW_SIZE)
+        ux  = uniform_filter(tiles, size=window_size)
+        uy  = uniform_filter(target, size=WINDOW_SIZE)[:, np.newaxis, :]
+        uxx = uniform_filter(tiles * tiles, size=window_size)
+        uyy = uniform_filter(target * target, size=WINDOW_SIZE)[:, np.newaxis, :]
+        uxy = uniform_filter(tiles * target[:, np.newaxis, :], size=window_size)
+
+        # Values closer to the border of each tile than half the window are left out
+        pad = (WINDOW_SIZE - 1) // 2
+        ux, uy, uxx, uyy, uxy = (u[pad:-pad, :, pad:-pad] for u in (ux, uy, uxx, uyy, uxy))
+
+        # Sample covariance
+        number_of_pixels = WINDOW_SIZE ** 2
+        covariance_norm  = number_of_pixels / (number_of_pixels - 1)
+        vx  = covariance_norm * (uxx - ux * ux)
+        vy  = covariance_norm * (uyy - uy * uy)
+        vxy = covariance_norm * (uxy - ux * uy)
+
+        C1 = (K1 * data_range) ** 2
+        C2 = (K2 * data_range) ** 2
+        A1, A2, B1, B2 = 2 * ux * uy + C1, 2 * vxy + C2, ux ** 2 + uy ** 2 + C1, vx + vy + C2
+        S = (A1 * A2) / (B1 * B2)
+
+        return np.mean(S, axis=(0, 2))
+
     def get_image_off_bounds_area(self, target_bbox, target_size, image_size):
         target_starting_pixel = np.array(target_bbox[:2])
         
@@ -45,23 +92,35 @@ class Ssim(TargetSimilarity):
         
         return np.concatenate((top_and_left, bottom_and_right))
 
-    def handle_image_borders(self, target, off_bounds_area,row,column, target_size, image_size, padding):
-        
-        row_in_image = row - padding[0]
-        column_in_image = column - padding[1]
-        target_to_use = target
-        end_row = row_in_image+target_size[0]
-        end_column = column_in_image+target_size[1]
-        if row_in_image < 0: 
-            target_to_use = target_to_use[padding[0]:target_size[0],:]
-            row_in_image = 0
-        if column_in_image < 0:
-            target_to_use = target_to_use[:,padding[1]:target_size[1]]
-            column_in_image = 0
-        if row_in_image >= image_size[0] - off_bounds_area[2]:
-            target_to_use = target_to_use[0:target_size[0] - padding[2],:]
-            end_row = end_row - padding[2]
-        if column_in_image >= image_size[1] - off_bounds_area[3]:
-            target_to_use = target_to_use[:,0:target_size[1] - padding[3]]
-            end_column = end_column - padding[3]
-        return (target_to_use, row_in_image, column_in_image, end_row, end_column)
+    def tiles_along_axis(self, axis, off_bounds_area, target_size, image_size, padding):
+        " Tiles along an axis (0 for rows, 1 for columns). Tiles at the borders of the image are cropped, and so is the part of the target they're compared with "
+        """ Output:
+                tiles (list) : for each tile, its first pixel in the image, followed by its first and last pixel in the target
+        """
+        tiles = []
+        padded_length = image_size[axis] + padding[axis] + padding[axis + 2]
+        for position in range(0, padded_length, target_size[axis]):
+            start_in_image  = position - padding[axis]
+            start_in_target = 0
+            end_in_target   = target_size[axis]
+            if start_in_image < 0:
+                start_in_target = padding[axis]
+                start_in_image  = 0
+            if start_in_image >= image_size[axis] - off_bounds_area[axis + 2]:
+                end_in_target = min(start_in_target + target_size[axis] - padding[axis + 2], target_size[axis])
+            tiles.append((start_in_image, start_in_target, end_in_target))
+
+        return tiles
+
+    def group_tiles_by_size(self, tiles):
+        " Groups the tiles along an axis by the part of the target they're compared with, which determines their size "
+        """ Output:
+                tiles_by_size (dict) : for each (first, last) pixel in the target, the first pixel in the image of the tiles compared with it and the number of tiles
+            Tiles of the same size are consecutive, since only those at the borders of the image are cropped
+        """
+        tiles_by_size = {}
+        for start_in_image, start_in_target, end_in_target in tiles:
+            first_start, number_of_tiles = tiles_by_size.get((start_in_target, end_in_target), (start_in_image, 0))
+            tiles_by_size[(start_in_target, end_in_target)] = (first_start, number_of_tiles + 1)
+
+        return tiles_by_size
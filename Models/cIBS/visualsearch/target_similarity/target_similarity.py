@@ -1,11 +1,20 @@
+from os import getpid, makedirs, path, replace
+import hashlib
 import numpy as np
 
+# Target similarity maps are cached reduced to the grid, in this precision. The precision of the model is applied afterwards
+CACHE_DTYPE = np.float64
+
 class TargetSimilarity():
-    def __init__(self, image, target, target_bbox, visibility_map, scale_factor, additive_shift, grid, seed):
-        # Set the seed for generating random noise
-        np.random.seed(seed)
+    def __init__(self, image, target, target_bbox, visibility_map, scale_factor, additive_shift, grid, seed, cache_dir=None):
+        # Each trial draws its random noise from its own generator, so that trials searched in lockstep don't affect each other
+        self.random_state = np.random.RandomState(seed)
 
         self.grid = grid
+        # Mu and sigma have the same precision as the visibility map
+        self.dtype = visibility_map.dtype
+        # Folder where the target similarity maps are stored, so that they're computed only once. If None, they're always computed
+        self.cache_dir = cache_dir
         self.create_target_similarity_map(image, target, target_bbox, visibility_map, scale_factor, additive_shift)
 
     def create_target_similarity_map(self, image, target, target_bbox, visibility_map, scale_factor, additive_shift):
@@ -18,7 +27,9 @@ class TargetSimilarity():
                 scale_factor   (int) : modulates the inverse of the visibility and prevents the variance from diverging
                 additive_shift (int) : modulates the inverse of the visibility and prevents the variance from diverging
             Output:
-                sigma, mu (4D arrays) : values of the normal distribution for each possible fixation in the grid. It's based on target similarity and visibility
+                target_mask (2D array) : value of mu before adding target similarity and visibility info
+                target_similarity_map (2D array) : target similarity reduced to the grid, with values in the interval [-0.5, 0.5]
+            Sigma and mu, the values of the normal distribution at each cell, are computed from these for a given fixation in at_fixation
         """
         grid_size = self.grid.size()
         target_bbox_in_grid = np.empty(len(target_bbox), dtype=np.int)
@@ -26,18 +37,16 @@ class TargetSimilarity():
         target_bbox_in_grid[2], target_bbox_in_grid[3] = self.grid.map_to_cell((target_bbox[2], target_bbox[3]))
 
         # Initialize mu, where each cell has a value of 0.5 if the target is present and -0.5 otherwise
-        self.mu = np.zeros(shape=(grid_size[0], grid_size[1], grid_size[0], grid_size[1])) - 0.5
-        for row in range(target_bbox_in_grid[0], target_bbox_in_grid[2] + 1):
-            for column in range(target_bbox_in_grid[1], target_bbox_in_grid[3] + 1):
-                self.mu[row, column] = np.zeros(shape=grid_size) + 0.5
-        
-        # Initialize sigma
-        self.sigma = np.ones(shape=self.mu.shape)
-        # Variance now depends on the visibility
-        self.sigma = self.sigma / (visibility_map.normalized_at_every_fixation() * scale_factor + additive_shift)
-
-        # Calculate target similarity based on a specific method 
-        target_similarity_map = self.compute_target_similarity(image, target, target_bbox)
+        self.target_mask = np.zeros(shape=grid_size, dtype=self.dtype) - 0.5
+        self.target_mask[target_bbox_in_grid[0]:target_bbox_in_grid[2] + 1, target_bbox_in_grid[1]:target_bbox_in_grid[3] + 1] = 0.5
+
+        # Variance depends on the visibility
+        self.visibility_map = visibility_map
+        self.scale_factor   = scale_factor
+        self.additive_shift = additive_shift
+
+        # Calculate target similarity based on a specific method and reduce it to the grid, unless it was already done for the same image, target and grid
+        target_similarity_map = self.load_or_compute_target_similarity(image, target, target_bbox)
 
         # Add target similarity and visibility info to mu
         self.add_info_to_mu(target_similarity_map, visibility_map)
@@ -48,25 +57,79 @@ class TargetSimilarity():
         """ Each subclass calculates the target similarity map with its own method """
         pass
 
-    def add_info_to_mu(self, target_similarity_map, visibility_map):
-        """ Once target similarity has been computed, its information is added to mu, alongside the visibility map """
-        # Reduce to grid
-        target_similarity_map = self.grid.reduce(target_similarity_map, mode='max')
+    def load_or_compute_target_similarity(self, image, target, target_bbox):
+        " Looks for the target similarity map, reduced to the grid, in the cache folder. If it's not there, it's computed, reduced and stored in it "
+        """ Input:
+                image  (2D array) : search image
+                target (2D array) : target image
+                target_bbox (array) : bounding box of the target in the image
+            Output:
+                target_similarity_map (2D array) : target similarity map reduced to the grid, in CACHE_DTYPE precision
+            The map is stored as a .npy file, whose name is a hash of everything it depends on. Only the reduced map is stored, since it's the one the model uses
+            Maps which are None are not stored
+        """
+        if self.cache_dir is None:
+            return self.reduce_to_grid(self.compute_target_similarity(image, target, target_bbox))
+
+        cache_file = path.join(self.cache_dir, self.cache_key(image, target, target_bbox) + '.npy')
+        if path.exists(cache_file):
+            return np.load(cache_file)
+
+        target_similarity_map = self.reduce_to_grid(self.compute_target_similarity(image, target, target_bbox))
+        if target_similarity_map is not None:
+            makedirs(self.cache_dir, exist_ok=True)
+            # The map is written to a temporary file first, so that processes reading it at the same time never find it incomplete
+            temporary_file = cache_file + '.' + str(getpid()) + '.tmp'
+            with open(temporary_file, 'wb') as cache:
+                np.save(cache, target_similarity_map)
+            replace(temporary_file, cache_file)
+
+        return target_similarity_map
 
+    def cache_key(self, image, target, target_bbox):
+        " Name of the method followed by a hash of the image and target bytes, the target bounding box, the image size, "
+        " and how the map is stored: the reduction, the cell size, the size of the grid and the precision "
+        key_hash = hashlib.sha256()
+        for array in (np.ascontiguousarray(image), np.ascontiguousarray(target)):
+            key_hash.update((str(array.shape) + str(array.dtype)).encode())
+            key_hash.update(array.tobytes())
+        key_hash.update(str([int(coordinate) for coordinate in target_bbox]).encode())
+        key_hash.update(str(np.shape(image)[:2]).encode())
+        key_hash.update(('max' + str(self.grid.cell_size) + str([int(size) for size in self.grid.size()]) + np.dtype(CACHE_DTYPE).name).encode())
+
+        return type(self).__name__.lower() + '_' + key_hash.hexdigest()
+
+    def reduce_to_grid(self, target_similarity_map):
+        " Reduces the target similarity map to the grid, where each cell keeps its largest value "
+        if target_similarity_map is None:
+            return None
+
+        return self.grid.reduce(target_similarity_map, mode='max').astype(CACHE_DTYPE, copy=False)
+
+    def add_info_to_mu(self, target_similarity_map, visibility_map):
+        """ Once target similarity has been reduced to the grid, its information is added to mu, alongside the visibility map, in at_fixation """
         # Convert values to the interval [-0.5, 0.5] 
         target_similarity_map = target_similarity_map - np.min(target_similarity_map)
         target_similarity_map = target_similarity_map / np.max(target_similarity_map) - 0.5
-        # Make it the same shape as mu
-        grid_size = self.grid.size()
-        target_similarity_map = np.tile(target_similarity_map[:, :, np.newaxis, np.newaxis], (1, 1, grid_size[0], grid_size[1]))
+        self.target_similarity_map = target_similarity_map.astype(self.dtype, copy=False)
 
+        return
+
+    def sigma_at_fixation(self, fixation):
+        " Variance of the normal distribution at each cell in the grid for the given fixation "
+        return 1 / (self.visibility_map.normalized_at_fixation(fixation) * self.scale_factor + self.additive_shift)
+
+    def mu_at_fixation(self, fixation):
+        " Mean of the normal distribution at each cell in the grid for the given fixation "
+        if self.target_similarity_map is None:
+            return self.target_mask
+
+        visibility_map_normalized = self.visibility_map.normalized_at_fixation(fixation)
         # Modify mu in order to incorporate target similarity and visibility
-        self.mu = self.mu * (visibility_map.normalized_at_every_fixation() + 0.5) + target_similarity_map * (1 - visibility_map.normalized_at_every_fixation() + 0.5)
+        mu = self.target_mask * (visibility_map_normalized + 0.5) + self.target_similarity_map * (1 - visibility_map_normalized + 0.5)
         # Convert values to the interval [-1, 1]
-        self.mu = self.mu / 2
+        return mu / 2
 
-        return
-    
     def at_fixation(self, fixation):
         " Given a fixation in the grid, it returns the target similarity map, represented as a 2D array of scalars with added random noise "
         """ Input:
@@ -76,6 +139,7 @@ class TargetSimilarity():
         """
         grid_size = self.grid.size()
         # For backwards compatibility with MATLAB, it's necessary to transpose the matrix
-        random_noise = np.transpose(np.random.standard_normal((grid_size[1], grid_size[0])))
+        # The noise is drawn in double precision, so that it's the same whatever the precision of mu and sigma
+        random_noise = np.transpose(self.random_state.standard_normal((grid_size[1], grid_size[0]))).astype(self.dtype, copy=False)
 
-        return self.sigma[:, :, fixation[0], fixation[1]] * random_noise + self.mu[:, :, fixation[0], fixation[1]]
+        return self.sigma_at_fixation(fixation) * random_noise + self.mu_at_fixation(fixation)
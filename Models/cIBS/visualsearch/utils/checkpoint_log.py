@@ -0,0 +1,130 @@
+from os import fsync, path, remove, replace
+import json
+import time
+
+" Append-only log of the trials searched so far, from which an interrupted execution is resumed "
+" The first line holds the configuration and the trials of the execution. Each of the following ones holds the scanpath of a trial, as soon as it's searched "
+" Lines are flushed as they're written, so they survive the process being killed. They're synced to disk in batches "
+
+CHECKPOINT_FILE = 'checkpoint.jsonl'
+# Checkpoint of previous versions, a single JSON file written when the execution was interrupted
+LEGACY_CHECKPOINT_FILE = 'checkpoint.json'
+# Lines written since the last sync to disk which trigger a new one. A system crash may lose up to this number of trials
+FSYNC_BATCH_SIZE = 16
+# Seconds since the last sync to disk which trigger a new one
+FSYNC_INTERVAL   = 30
+
+def file_path(output_path):
+    return output_path + CHECKPOINT_FILE
+
+def exists(output_path):
+    return path.exists(file_path(output_path))
+
+def legacy_exists(output_path):
+    return path.exists(output_path + LEGACY_CHECKPOINT_FILE)
+
+def convert_legacy(output_path):
+    " Rewrites the checkpoint of a previous version as a log, which is then resumed as any other, and removes it "
+    " It held the configuration, the trials which hadn't been searched, and the scanpaths of the ones which had, alongside the time spent on them "
+    with open(output_path + LEGACY_CHECKPOINT_FILE, 'r') as legacy_file:
+        legacy_checkpoint = json.load(legacy_file)
+
+    # The log is written to a temporary file first, so that the legacy checkpoint is only removed once it's complete
+    temporary_file = file_path(output_path) + '.tmp'
+    with open(temporary_file, 'w') as log_file:
+        log_file.write(json.dumps({'configuration' : legacy_checkpoint['configuration'], 'trials_properties' : legacy_checkpoint['trials_properties']}) + '\n')
+        for image_name, scanpath in legacy_checkpoint['scanpaths'].items():
+            log_file.write(json.dumps({'image_name' : image_name, 'scanpath' : scanpath, 'time_elapsed' : legacy_checkpoint['time_elapsed']}) + '\n')
+        log_file.flush()
+        fsync(log_file.fileno())
+    replace(temporary_file, file_path(output_path))
+    remove(output_path + LEGACY_CHECKPOINT_FILE)
+
+def erase(output_path):
+    if exists(output_path):
+        remove(file_path(output_path))
+
+def replay(output_path):
+    " Rebuilds the state of the execution from the log "
+    """ Input:
+            output_path (string) : folder path where the log is stored
+        Output:
+            checkpoint (dict). Fields:
+                configuration     (dict) : configuration of the execution
+                trials_properties (list) : trials which haven't been searched yet
+                scanpaths         (dict) : scanpaths of the trials searched so far, indexed by image name
+                targets_found     (int)  : number of those trials in which the target was found
+                time_elapsed      (float): seconds spent searching them
+        A last line which was left incomplete by a crash is ignored
+    """
+    header, records = read_lines(output_path)
+    scanpaths    = {}
+    time_elapsed = 0
+    for record in records:
+        scanpaths[record['image_name']] = record['scanpath']
+        time_elapsed = record['time_elapsed']
+
+    return {'configuration' : header['configuration'], 'scanpaths' : scanpaths, 'time_elapsed' : time_elapsed, \
+        'targets_found' : sum(scanpath['target_found'] for scanpath in scanpaths.values()), \
+        'trials_properties' : [trial for trial in header['trials_properties'] if trial['image'] not in scanpaths]}
+
+def read_lines(output_path):
+    " Returns the header of the log and the records of the trials. Lines which can't be parsed are only allowed at the end "
+    with open(file_path(output_path), 'r') as log_file:
+        lines = log_file.read().split('\n')
+
+    records = []
+    for line_number, line in enumerate(lines):
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            if any(lines[line_number + 1:]):
+                raise
+            break
+
+    return records[0], records[1:]
+
+class CheckpointLog:
+    " Appends the scanpath of each trial to the log as soon as it's searched "
+    def __init__(self, output_path, config, trials_properties):
+        """ Input:
+                output_path (string)     : folder path where the log is stored
+                config (dict)            : configuration of the execution
+                trials_properties (list) : trials to be searched. They're only written if the log is new, since it's otherwise being resumed
+        """
+        self.output_path = output_path
+        if exists(output_path):
+            self.truncate_incomplete_line()
+            self.log_file = open(file_path(output_path), 'a')
+        else:
+            self.log_file = open(file_path(output_path), 'w')
+            self.write_line({'configuration' : config, 'trials_properties' : trials_properties})
+            self.sync()
+        self.unsynced_lines = 0
+        self.last_sync      = time.time()
+
+    def append(self, image_name, scanpath, time_elapsed):
+        " Records the scanpath of the trial, as stored in Scanpaths.json, alongside the time elapsed since the execution began "
+        self.write_line({'image_name' : image_name, 'scanpath' : scanpath, 'time_elapsed' : time_elapsed})
+        self.unsynced_lines += 1
+        if self.unsynced_lines >= FSYNC_BATCH_SIZE or time.time() - self.last_sync >= FSYNC_INTERVAL:
+            self.sync()
+
+    def close(self):
+        self.sync()
+        self.log_file.close()
+
+    def write_line(self, record):
+        self.log_file.write(json.dumps(record) + '\n')
+        self.log_file.flush()
+
+    def sync(self):
+        fsync(self.log_file.fileno())
+        self.unsynced_lines = 0
+        self.last_sync      = time.time()
+
+    def truncate_incomplete_line(self):
+        " Removes what was written of a line before a crash, so that new lines are appended after the last complete one "
+        with open(file_path(self.output_path), 'rb+') as log_file:
+            content = log_file.read()
+            log_file.truncate(content.rfind(b'\n') + 1)
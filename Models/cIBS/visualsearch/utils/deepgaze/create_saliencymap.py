@@ -1,59 +1,128 @@
 import argparse
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.ndimage import zoom
 from scipy.special import logsumexp
-from skimage import io, color, img_as_ubyte
+from skimage import io, color
 from os import listdir, makedirs, path, environ, getcwd
 # Ignore tensorflow messages
 environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 import sys
+from threading import Lock
 import tensorflow.compat.v1 as tf
 
-def create_saliencymap_for_image(image, save_path):
-    print('Creating saliency map for search image...')
-    # Ignore warnings
-    tf.logging.set_verbosity(tf.logging.ERROR)
-    # To make tf 2.0 compatible with tf1.0 code, we disable the tf2.0 functionalities
-    tf.disable_eager_execution()
-
-    # load precomputed log density over a 1024x1024 image
-    script_path = path.dirname(__file__)
-    centerbias_template = np.load(path.join(script_path, 'centerbias.npy'))
-    # rescale to match image size
-    img_size   = (image.shape[0], image.shape[1])
-    centerbias = zoom(centerbias_template, (img_size[0]/1024, img_size[1]/1024), order=0, mode='nearest')
-    # renormalize log density
-    centerbias -= logsumexp(centerbias)
-
-    centerbias_data = centerbias[np.newaxis, :, :, np.newaxis]  # BHWC, 1 channel (log density)
-
-    tf.reset_default_graph()
-    check_point = 'DeepGazeII.ckpt'  # DeepGaze II
-    new_saver   = tf.train.import_meta_graph(path.join(script_path, '{}.meta'.format(check_point)))
-
-    input_tensor      = tf.get_collection('input_tensor')[0]
-    centerbias_tensor = tf.get_collection('centerbias_tensor')[0]
-    log_density       = tf.get_collection('log_density')[0]
-
-    if len(image.shape) < 3:
-        image = color.gray2rgb(image)
-    image_data = image[np.newaxis, :, :, :]  # BHWC, three channels (RGB)
-
-    with tf.Session() as sess:
-        new_saver.restore(sess, path.join(script_path, check_point))
-        
-        log_density_prediction = sess.run(log_density, {
-            input_tensor: image_data,
-            centerbias_tensor: centerbias_data,
+CHECK_POINT = 'DeepGazeII.ckpt'  # DeepGaze II
+
+# DeepGaze II, restored once by each process
+deepgaze_model = None
+# Trials are loaded by background threads, which may need the model at the same time
+deepgaze_model_lock = Lock()
+
+def load_model():
+    " Restores DeepGaze II the first time it's called in the process. Later calls return the same model "
+    global deepgaze_model
+    if deepgaze_model is None:
+        with deepgaze_model_lock:
+            # Another thread may have restored it while this one waited for the lock
+            if deepgaze_model is None:
+                deepgaze_model = DeepGazeII()
+
+    return deepgaze_model
+
+class DeepGazeII:
+    " DeepGaze II restored into a session which is kept open, so that the graph is loaded only once for every image "
+    def __init__(self):
+        # Ignore warnings
+        tf.logging.set_verbosity(tf.logging.ERROR)
+        # To make tf 2.0 compatible with tf1.0 code, we disable the tf2.0 functionalities
+        tf.disable_eager_execution()
+
+        script_path = path.dirname(__file__)
+        # load precomputed log density over a 1024x1024 image
+        self.centerbias_template = np.load(path.join(script_path, 'centerbias.npy'))
+        # Center bias for each image size, as it's computed
+        self.centerbiases = {}
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            new_saver = tf.train.import_meta_graph(path.join(script_path, '{}.meta'.format(CHECK_POINT)))
+
+            self.input_tensor      = tf.get_collection('input_tensor')[0]
+            self.centerbias_tensor = tf.get_collection('centerbias_tensor')[0]
+            self.log_density       = tf.get_collection('log_density')[0]
+
+            self.session = tf.Session(graph=self.graph)
+            new_saver.restore(self.session, path.join(script_path, CHECK_POINT))
+
+    def centerbias(self, img_size):
+        " Center bias log density for images of the given size "
+        if img_size not in self.centerbiases:
+            # rescale to match image size
+            centerbias = zoom(self.centerbias_template, (img_size[0]/1024, img_size[1]/1024), order=0, mode='nearest')
+            # renormalize log density
+            centerbias -= logsumexp(centerbias)
+            self.centerbiases[img_size] = centerbias
+
+        return self.centerbiases[img_size]
+
+    def saliency_maps(self, images):
+        " Computes the saliency maps of a batch of images of the same size at once "
+        """ Input:
+                images (list of arrays) : grayscale or RGB images, all of the same height and width
+            Output:
+                saliency_maps (list of 2D arrays) : grayscale saliency map of each image, as unsigned bytes
+        """
+        img_size   = (images[0].shape[0], images[0].shape[1])
+        image_data = np.array([color.gray2rgb(image) if len(image.shape) < 3 else image for image in images])  # BHWC, three channels (RGB)
+        centerbias_data = np.tile(self.centerbias(img_size)[np.newaxis, :, :, np.newaxis], (len(images), 1, 1, 1))  # BHWC, 1 channel (log density)
+
+        log_density_prediction = self.session.run(self.log_density, {
+            self.input_tensor: image_data,
+            self.centerbias_tensor: centerbias_data,
         })
 
+        return [density_to_grayscale(np.exp(log_density[:, :, 0])) for log_density in log_density_prediction]
+
+    def close(self):
+        self.session.close()
+
+def density_to_grayscale(density):
+    " Rescales the density to [0, 1] and maps it to 256 levels of gray, as saving it with matplotlib's gray colormap does "
+    density = (density - np.min(density)) / (np.max(density) - np.min(density))
+
+    return np.minimum(density * 256, 255).astype(np.uint8)
+
+def save_saliencymap(saliency_map, save_path):
     if not path.exists(path.dirname(save_path)):
         makedirs(path.dirname(save_path))
-    plt.imsave(save_path, np.exp(log_density_prediction[0, :, :, 0]), cmap=plt.cm.gray)
-    # Remove channels and keep one
-    image = io.imread(save_path)
-    io.imsave(save_path, img_as_ubyte(color.rgb2gray(image)))
+    io.imsave(save_path, saliency_map, check_contrast=False)
+
+def create_saliencymap_for_image(image, save_path):
+    print('Creating saliency map for search image...')
+    saliency_map = load_model().saliency_maps([image])[0]
+    save_saliencymap(saliency_map, save_path)
+
+def create_saliencymaps(images, save_paths, batch_size):
+    " Creates the saliency maps of a sequence of images. Consecutive images of the same size are run through DeepGaze II at once, in batches of up to batch_size "
+    """ Input:
+            images (iterable)     : images, which may be loaded as they're needed
+            save_paths (iterable) : path where to save the saliency map of each image
+            batch_size (int)      : maximum number of images in each batch
+    """
+    model = load_model()
+    batch = []
+    for image, save_path in zip(images, save_paths):
+        if batch and (len(batch) == batch_size or image.shape[:2] != batch[0][0].shape[:2]):
+            create_saliencymaps_for_batch(model, batch)
+            batch = []
+        batch.append((image, save_path))
+    if batch:
+        create_saliencymaps_for_batch(model, batch)
+
+def create_saliencymaps_for_batch(model, batch):
+    " Runs a batch of (image, save_path) pairs through DeepGaze II at once and saves their saliency maps "
+    saliency_maps = model.saliency_maps([image for image, _ in batch])
+    for saliency_map, (_, save_path) in zip(saliency_maps, batch):
+        save_saliencymap(saliency_map, save_path)
 
 
 if __name__ == '__main__':
@@ -71,4 +140,4 @@ if __name__ == '__main__':
     image_name  = str(args.img).split('/')[-1]
     output_path = path.join(args.o, '') + image_name[:-4] + '_saliency' + image_name[-4:]
 
-    create_saliencymap_for_image(image, output_path)    
+    create_saliencymap_for_image(image, output_path)
@@ -0,0 +1,83 @@
+from os import path
+import numpy as np
+import json
+
+" Seconds spent by each trial in each phase of the search, appended to a JSONL file next to Scanpaths.json as trials are searched "
+" At the end of the run, the median and the 95th percentile of each phase are appended to it as well "
+
+METRICS_FILE = 'metrics.jsonl'
+# Phases timed once per trial. search is the sum of the phases of its saccades, so it doesn't include the time spent on other trials searched in lockstep
+TRIAL_PHASES   = ['image_load', 'prior_load', 'target_similarity', 'search']
+# Phases timed once per saccade, which hold a list with the time of each one
+SACCADE_PHASES = ['likelihood_update', 'next_fixation', 'probability_map_saving']
+
+def file_path(output_path):
+    return output_path + METRICS_FILE
+
+def new_trial_timings():
+    return {phase : [] for phase in SACCADE_PHASES}
+
+def summarize(records):
+    " Median and 95th percentile, in seconds, of each phase. Phases timed once per saccade are summarized over every saccade of every trial "
+    """ Input:
+            records (list) : timings of each trial, as appended to the metrics file
+        Output:
+            summary (dict) : number of values, total, p50 and p95 of each phase, indexed by phase
+    """
+    summary = {}
+    for phase in TRIAL_PHASES + SACCADE_PHASES:
+        values = []
+        for record in records:
+            if phase in record['timings']:
+                phase_timings = record['timings'][phase]
+                values.extend(phase_timings if isinstance(phase_timings, list) else [phase_timings])
+        if values:
+            p50, p95 = np.percentile(values, [50, 95])
+            summary[phase] = {'count' : len(values), 'total' : float(np.sum(values)), 'p50' : float(p50), 'p95' : float(p95)}
+
+    return summary
+
+def print_summary(summary):
+    print('Phase'.ljust(24) + ' Count   Total (s)   p50 (ms)   p95 (ms)')
+    for phase, phase_summary in summary.items():
+        print(phase.ljust(24) + ' ' + str(phase_summary['count']).ljust(7) + ' ' + '{:<11.4f} {:<10.3f} {:.3f}'.format(phase_summary['total'], \
+            phase_summary['p50'] * 1000, phase_summary['p95'] * 1000))
+
+class MetricsLog:
+    " Appends the timings of each trial to the metrics file as soon as it's searched "
+    def __init__(self, output_path, resume):
+        """ Input:
+                output_path (string) : folder path where the metrics file is stored
+                resume (bool)        : indicates whether the execution is being resumed, in which case the timings of the trials already searched are kept
+        """
+        self.records = []
+        if resume and path.exists(file_path(output_path)):
+            with open(file_path(output_path), 'rb+') as metrics_file:
+                content = metrics_file.read()
+                # What was written of a line before a crash is discarded
+                metrics_file.truncate(content.rfind(b'\n') + 1)
+            with open(file_path(output_path), 'r') as metrics_file:
+                self.records = [record for record in map(json.loads, metrics_file) if 'timings' in record]
+            self.metrics_file = open(file_path(output_path), 'a')
+        else:
+            self.metrics_file = open(file_path(output_path), 'w')
+
+    def append(self, image_name, timings):
+        " Records the timings of the trial, indexed by phase "
+        record = {'image_name' : image_name, 'timings' : timings}
+        self.records.append(record)
+        self.write_line(record)
+
+    def finish(self):
+        " Appends the summary of the timings of the trials searched and returns it "
+        summary = summarize(self.records)
+        self.write_line({'summary' : summary})
+
+        return summary
+
+    def close(self):
+        self.metrics_file.close()
+
+    def write_line(self, record):
+        self.metrics_file.write(json.dumps(record) + '\n')
+        self.metrics_file.flush()
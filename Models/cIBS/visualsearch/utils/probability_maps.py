@@ -0,0 +1,89 @@
+from os import makedirs, path
+from queue import Queue
+from threading import Thread
+import zipfile
+import numpy as np
+
+" Storage of the posterior computed at each saccade. The posteriors of each image are appended to a single compressed .npz file "
+" They're written by a background thread, so that the search doesn't wait for them "
+
+# Maximum number of posteriors waiting to be written. When reached, the search waits for the writer
+MAX_PENDING_WRITES = 32
+
+def file_path(output_path, image_name):
+    " Path of the file where the probability maps of the image are stored "
+    return path.join(output_path, 'probability_maps', path.splitext(image_name)[0] + '.npz')
+
+def append(output_path, image_name, probability_map, fixation_number):
+    " Adds the probability map of the given fixation to the file of the image. The first fixation starts a new file "
+    file_name = file_path(output_path, image_name)
+    makedirs(path.dirname(file_name), exist_ok=True)
+    with zipfile.ZipFile(file_name, mode='w' if fixation_number == 0 else 'a', compression=zipfile.ZIP_DEFLATED) as npz_file:
+        with npz_file.open('fixation_' + str(fixation_number + 1) + '.npy', mode='w') as array_file:
+            np.lib.format.write_array(array_file, np.asanyarray(probability_map), allow_pickle=False)
+
+def load(output_path, image_name):
+    " Reads every probability map of the image "
+    """ Input:
+            output_path (string) : folder path where scanpaths and probability maps were stored
+            image_name  (string) : name of the image
+        Output:
+            probability_maps (3D array) : posterior after each fixation, indexed by (fixation number, row, column)
+    """
+    with np.load(file_path(output_path, image_name)) as npz_file:
+        number_of_fixations = len(npz_file.files)
+
+        return np.array([npz_file['fixation_' + str(fixation_number + 1)] for fixation_number in range(number_of_fixations)])
+
+def load_at_fixation(output_path, image_name, fixation_number):
+    " Reads the probability map of the image after the given fixation, starting from zero "
+    with np.load(file_path(output_path, image_name)) as npz_file:
+        return npz_file['fixation_' + str(fixation_number + 1)]
+
+class ProbabilityMapsWriter:
+    " Writes the probability maps in a background thread, in the order in which they're given "
+    def __init__(self, output_path, dtype):
+        """ Input:
+                output_path (string) : folder path where probability maps will be stored
+                dtype (string)       : float64, float32, float16. Floating point type in which they're stored. In float16, values below 6e-8 become zero
+        """
+        self.output_path = output_path
+        self.dtype       = np.dtype(dtype)
+        self.queue       = Queue(maxsize=MAX_PENDING_WRITES)
+        self.error       = None
+        self.thread      = Thread(target=self.write_pending, daemon=True)
+        self.thread.start()
+
+    def save(self, image_name, probability_map, fixation_number):
+        " Queues the probability map to be written. It's copied, so the caller can modify it afterwards "
+        self.raise_error()
+        self.queue.put((image_name, probability_map.astype(self.dtype), fixation_number))
+
+    def wait(self):
+        " Waits until every queued probability map has been written "
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        " Writes the pending probability maps and stops the background thread "
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+    def write_pending(self):
+        while True:
+            pending_write = self.queue.get()
+            try:
+                if pending_write is None:
+                    return
+                # Once a write has failed, the rest are discarded. The error is raised by the search
+                if self.error is None:
+                    append(self.output_path, *pending_write)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
@@ -1,47 +1,10 @@
-from os import makedirs, path, remove
 from skimage import io, transform
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import islice
+import hashlib
 import json
 import numpy  as np
-import pandas as pd
-
-def load_data_from_checkpoint(output_path):
-    checkpoint_file = output_path + 'checkpoint.json'
-    scanpaths     = {}
-    targets_found = 0
-    time_elapsed  = 0
-    if path.exists(checkpoint_file):
-        checkpoint    = load_from_json(checkpoint_file)
-        scanpaths     = checkpoint['scanpaths']
-        targets_found = checkpoint['targets_found']
-        time_elapsed  = checkpoint['time_elapsed']
-    
-    return scanpaths, targets_found, time_elapsed
-
-def save_checkpoint(config, scanpaths, targets_found, trials_properties, time_elapsed, output_path):
-    checkpoint = {}
-    checkpoint['configuration']     = config
-    checkpoint['targets_found']     = targets_found
-    checkpoint['time_elapsed']      = time_elapsed
-    checkpoint['scanpaths']         = scanpaths
-    checkpoint['trials_properties'] = remove_trials_already_processed(trials_properties, scanpaths)
-
-    save_to_json(output_path + 'checkpoint.json', checkpoint)
-    print('\nCheckpoint saved at ' + output_path)
-    print('Run the script again to resume execution')
-
-def erase_checkpoint(output_path):
-    checkpoint_file = output_path + 'checkpoint.json'
-    if path.exists(checkpoint_file):
-        remove(checkpoint_file)
-
-def remove_trials_already_processed(trials_properties, scanpaths):
-    remaining_trials = []
-    for trial in trials_properties:
-        image_name = trial['image']
-        if not image_name in scanpaths:
-            remaining_trials.append(trial)
-    
-    return remaining_trials
 
 def save_scanpaths(output_path, scanpaths):
     save_to_json(output_path + 'Scanpaths.json', scanpaths)
@@ -63,13 +26,11 @@ def load_image(path, name, image_size='default'):
 
     return img
 
-def save_probability_map(output_path, image_name, probability_map, fixation_number):
-    save_path = output_path + '/probability_maps/' + image_name + '/'
-    if not path.exists(save_path):
-        makedirs(save_path)
+def get_trial_seed(seed, image_name):
+    " Derives a seed for the trial from the seed in the configuration and the name of its image. It's the same in every process and execution "
+    seed_hash = hashlib.sha256((str(seed) + ':' + image_name).encode())
 
-    posterior_df = pd.DataFrame(probability_map)
-    posterior_df.to_csv(save_path + 'fixation_' + str(fixation_number + 1) + '.csv')
+    return int(seed_hash.hexdigest(), 16) % (2 ** 32)
 
 def add_white_gaussian_noise(image, snr_db):
     """ Input:
@@ -100,4 +61,26 @@ def add_scanpath_to_dict(image_name, image_scanpath, target_bbox, grid, config,
 
 def are_within_boundaries(top_left_coordinates, bottom_right_coordinates, top_left_coordinates_to_compare, bottom_right_coordinates_to_compare):
     return top_left_coordinates[0] >= top_left_coordinates_to_compare[0] and top_left_coordinates[1] >= top_left_coordinates_to_compare[1] \
-         and bottom_right_coordinates[0] < bottom_right_coordinates_to_compare[0] and bottom_right_coordinates[1] < bottom_right_coordinates_to_compare[1]
\ No newline at end of file
+         and bottom_right_coordinates[0] < bottom_right_coordinates_to_compare[0] and bottom_right_coordinates[1] < bottom_right_coordinates_to_compare[1]
+
+def prefetch(function, items, depth):
+    " Yields the result of applying the function to each item, in order. Up to depth results are computed ahead, in background threads "
+    """ Input:
+            function (function) : function to apply, which should release the GIL most of the time (e.g. reading files)
+            items (iterable)    : values to which it's applied
+            depth (int)         : maximum number of results computed, or being computed, which haven't been yielded yet
+        Output:
+            results (generator) : result for each item. If the function raised an exception for an item, it's raised when its result is reached
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        pending_results = deque(executor.submit(function, item) for item in islice(items, depth))
+        try:
+            while pending_results:
+                result = pending_results.popleft().result()
+                pending_results.extend(executor.submit(function, item) for item in islice(items, 1))
+                yield result
+        finally:
+            # If the results are no longer needed, those not started yet are discarded
+            for pending_result in pending_results:
+                pending_result.cancel()
@@ -1,56 +1,78 @@
+import copy
 import numpy as np
-from scipy.stats import multivariate_normal
 
 " The visibility map represents how focus decays over distance from the fovea "
 " This implementation uses the gaussian distribution, where the mean values correspond to the center of the fixation in pixels "
 " The covariance matrix was calculated before hand by estimating the vision angle of the fovea to the screen in the human experiments "
+" Since the gaussian only depends on the distance between each cell and the fixation, only its factors along each axis are stored. The visibility map at each fixation is their product "
+" It's always computed in double precision; dtype is the precision of the maps it returns "
 
 class VisibilityMap:
-    def __init__(self, image_size, grid, sigma):
-        self.visibility_map = self.create(image_size, grid, sigma)
-        self.visibility_map_normalized = self.convert_to_unit_interval()
+    def __init__(self, image_size, grid, sigma, dtype=np.float64):
+        self.grid_size = grid.size()
+        self.dtype     = np.dtype(dtype)
+        self.create(image_size, grid, sigma)
+
+    def with_dtype(self, dtype):
+        " Returns a visibility map which shares the distances and rescaling values of this one, but whose maps have the given precision "
+        if np.dtype(dtype) == self.dtype:
+            return self
+        visibility_map = copy.copy(self)
+        visibility_map.dtype = np.dtype(dtype)
+
+        return visibility_map
 
     def create(self, image_size, grid, sigma):
-        " Creates a visibility map for a given image and cell size. The output's shape is grid size x grid size."
+        " Stores the distances, and the factors of the gaussian, along each axis, between the cells in the grid and the fixations. Also computes the minimum and maximum values of the visibility map, used for rescaling it "
         """ Input:
                 image_size (int, int) : height and width of the image, respectively, in pixels
                 grid  (Grid)          : representation of the image in cells
                 sigma (2D array)      : covariance matrix of the multivariate normal
             Output:
-                visibility_map [a, b, c, d] (4D array) : where visibility_map[:, :, c, d] is the visibility map of fixing the view in position (c, d)
+                rows_distances    [a, b] (2D array) : distance, in pixels, between row a of the visibility map and the center of the cells in row b
+                columns_distances [a, b] (2D array) : distance, in pixels, between column a of the visibility map and the center of the cells in column b
+                rows_factors      [a, b] (2D array) : factor of the multivariate normal at the cells in row b when fixating on row a
+                columns_factors   [a, b] (2D array) : factor of the multivariate normal at the cells in column b when fixating on column a
         """
-        visibility_map = np.empty(shape=grid.size() + grid.size())
+        x_range = np.linspace(0, image_size[0], self.grid_size[0])
+        y_range = np.linspace(0, image_size[1], self.grid_size[1])
 
-        x_range = np.linspace(0, image_size[0], grid.size()[0])
-        y_range = np.linspace(0, image_size[1], grid.size()[1])
+        cells_centers_rows    = np.array([grid.map_cell_to_pixels((row, 0))[0] for row in range(self.grid_size[0])])
+        cells_centers_columns = np.array([grid.map_cell_to_pixels((0, column))[1] for column in range(self.grid_size[1])])
 
-        x_matrix, y_matrix = np.meshgrid(x_range, y_range)
-        for row in range(grid.size()[0]):
-            for column in range(grid.size()[1]):
-                fixation = grid.map_cell_to_pixels((row, column))
+        self.rows_distances    = x_range[:, np.newaxis] - cells_centers_rows[np.newaxis, :]
+        self.columns_distances = y_range[:, np.newaxis] - cells_centers_columns[np.newaxis, :]
+        # The first coordinate of the gaussian is the distance along the columns and the second one, the distance along the rows
+        # Its density at each cell is the product of one factor which depends on the row and another which depends on the column,
+        # plus a cross term when sigma isn't diagonal. Factors are computed once for every fixation
+        precision     = np.linalg.inv(sigma)
+        normalization = 1 / (2 * np.pi * np.sqrt(np.linalg.det(sigma)))
+        self.rows_factors    = normalization * np.exp(-0.5 * precision[1, 1] * self.rows_distances ** 2)
+        self.columns_factors = np.exp(-0.5 * precision[0, 0] * self.columns_distances ** 2)
+        self.cross_term      = precision[0, 1]
 
-                quantiles = np.transpose([y_matrix.flatten(), x_matrix.flatten()])
-                mvn_at_fixation = multivariate_normal.pdf(quantiles, mean=[fixation[1], fixation[0]], cov=sigma)
-                mvn_at_fixation = np.reshape(mvn_at_fixation, grid.size(), order='F')
+        # Minimum and maximum values of the multivariate normal over every fixation, used for rescaling the visibility map to [0, 3]
+        if self.cross_term == 0:
+            # Factors are positive, so the extremes of their product are the products of their extremes
+            self.min_value = np.min(self.rows_factors) * np.min(self.columns_factors)
+            self.max_value = np.max(self.rows_factors) * np.max(self.columns_factors)
+        else:
+            self.min_value = np.inf
+            self.max_value = -np.inf
+            for row in range(self.grid_size[0]):
+                for column in range(self.grid_size[1]):
+                    mvn_at_fixation = self.mvn_at_fixation((row, column))
+                    self.min_value  = min(self.min_value, np.min(mvn_at_fixation))
+                    self.max_value  = max(self.max_value, np.max(mvn_at_fixation))
+        self.max_value = self.max_value - self.min_value
 
-                visibility_map[row, column] = mvn_at_fixation
-        
-        # TODO: Explicar para qué sirven estas cuentas
-        visibility_map = visibility_map - np.min(visibility_map)
-        visibility_map = visibility_map / np.max(visibility_map) * 3
+    def mvn_at_fixation(self, fixation):
+        " Values of the multivariate normal at every cell in the grid for the given fixation "
+        mvn_at_fixation = self.rows_factors[fixation[0]][:, np.newaxis] * self.columns_factors[fixation[1]][np.newaxis, :]
+        if self.cross_term != 0:
+            mvn_at_fixation *= np.exp(-self.cross_term * np.outer(self.rows_distances[fixation[0]], self.columns_distances[fixation[1]]))
 
-        return visibility_map
-    
-    def convert_to_unit_interval(self):
-        " Returns a matrix where values go from zero to one for each fixation, where one corresponds to the maximum value in visibility_map at the corresponding fixation "
-        grid_size = (self.visibility_map.shape[0], self.visibility_map.shape[1])
-        visibility_map_normalized = np.empty(shape=(grid_size[0], grid_size[1], grid_size[0], grid_size[1]))
-        for row in range(grid_size[0]):
-            for column in range(grid_size[1]):
-                visibility_map_normalized[:, :, row, column] = self.visibility_map[:, :, row, column] - np.min(self.visibility_map[:, :, row, column])
-                visibility_map_normalized[:, :, row, column] = self.visibility_map[:, :, row, column] / np.max(self.visibility_map[:, :, row, column])
-        
-        return visibility_map_normalized
+        return mvn_at_fixation
 
     def at_fixation(self, fixation):
         " Given a fixation in the grid, it returns the visibility map, represented as a 2D array of scalars "
@@ -59,8 +81,12 @@ class VisibilityMap:
             Output:
                 visibility_map (2D array of floats) : matrix the size of the grid, where each value is a scalar which represents how much the view diminishes
         """
-        return self.visibility_map[:, :, fixation[0], fixation[1]]
-    
-    def normalized_at_every_fixation(self):
-        " It returns the visibility map for every fixation possible, represented as a 4D array, where each value goes from zero to one"
-        return self.visibility_map_normalized
\ No newline at end of file
+        visibility_map = (self.mvn_at_fixation(fixation) - self.min_value) / self.max_value * 3
+
+        return visibility_map.astype(self.dtype, copy=False)
+
+    def normalized_at_fixation(self, fixation):
+        " Given a fixation in the grid, it returns the visibility map with values from zero to one, where one corresponds to its maximum value "
+        visibility_map = self.at_fixation(fixation)
+
+        return visibility_map / np.max(visibility_map)
@@ -1,12 +1,16 @@
 from .models.bayesian_model import BayesianModel
 from .models.greedy_model   import GreedyModel
+from .models.trial_state    import TrialState
 from .utils import utils
+from .utils.probability_maps import ProbabilityMapsWriter
+from .utils import metrics
 from . import prior
 import numpy as np
+import importlib
 import time
 
 class VisualSearcher: 
-    def __init__(self, config, grid, visibility_map, output_path):
+    def __init__(self, config, grid, visibility_map, output_path, target_similarity_dir=None):
         " Creates a new instance of the visual search model "
         """ Input:
                 Config (dict). One entry. Fields:
@@ -18,10 +22,23 @@ class VisualSearcher:
                     scale_factor          (int)    : modulates the variance of target similarity and prevents 1 / d' from diverging in bayesian search
                     additive_shift        (int)    : modulates the variance of target similarity and prevents 1 / d' from diverging in bayesian search
                     save_probability_maps (bool)   : indicates whether to save the posterior to a file after each saccade or not
+                    probability_maps_dtype (string) : float64, float32, float16. Floating point type in which the probability maps are saved
                     proc_number           (int)    : number of processes on which to execute bayesian search
+                    engine                (string) : loop, vectorized. How bayesian search evaluates each possible next fixation
+                    quadrature            (string) : trapezoid, gauss_legendre, gauss_hermite, adaptive. Rule used by bayesian search to integrate the probability of being correct
+                    quadrature_nodes      (int)    : number of nodes of the quadrature rule. For the adaptive rule, it's the number of nodes of each panel
+                    quadrature_tolerance  (float)  : absolute error allowed in each integral by the adaptive rule
+                    norm_cdf_backend      (string) : table, uniform_table, ndtr, erf. How bayesian search evaluates the normal cdf
+                    posterior_pruning_epsilon (float) : maximum posterior mass of the possible target locations left out by bayesian search at each saccade. Zero disables pruning
+                    candidate_screening   (int)    : number of possible next fixations, ranked by a cheap proxy, on which bayesian search computes the probability of being correct. Zero disables screening
+                    screening_validation  (bool)   : indicates whether to also evaluate every possible next fixation when screening, to count how often it chooses a different one
+                    branch_and_bound      (bool)   : indicates whether bayesian search discards, with bounds, the possible next fixations which can't be the best one. The fixation chosen is the same. It can't be used along with candidate screening
+                    precision             (string) : float64, float32. Floating point type of the likelihood, the posterior and the tensors of bayesian search
+                    precision_validation  (bool)   : indicates whether to also search each image in double precision, to report where the scanpath diverges from it
                 grid           (Grid)          : representation of an image with cells instead of pixels
                 visibility_map (VisibilityMap) : visibility map with the size of the grid
                 Output path    (string)        : folder path where scanpaths and probability maps will be stored
+                target_similarity_dir (string) : folder path where target similarity maps are stored, to be reused by later runs. If None, they're always computed
         """
         self.max_saccades             = config['max_saccades']
         self.grid                     = grid
@@ -29,40 +46,108 @@ class VisualSearcher:
         self.additive_shift           = config['additive_shift']
         self.seed                     = config['seed']
         self.save_posterior           = config['save_probability_maps']
-        self.visibility_map           = visibility_map
-        self.search_model             = self.initialize_model(config['search_model'], self.grid.size(), visibility_map, config['norm_cdf_tolerance'], config['proc_number'])
+        self.dtype                    = np.dtype(config['precision'])
+        self.visibility_map           = visibility_map.with_dtype(self.dtype)
+        self.search_model             = self.initialize_model(config, self.grid.size(), self.visibility_map)
         self.target_similarity_method = config['target_similarity']
+        self.target_similarity_dir    = target_similarity_dir
         self.output_path              = output_path        
+        self.probability_maps_writer  = ProbabilityMapsWriter(output_path, config['probability_maps_dtype']) if self.save_posterior else None
+        self.reference_searcher       = self.initialize_reference_searcher(config, grid, visibility_map)
 
-    def search(self, image_name, image_size, image, image_prior, target, target_bbox, initial_fixation):
+    def search(self, image_name, image_size, image, grid_prior, target, target_bbox, initial_fixation):
         " Given an image, a target, and a prior of that image, it looks for the object in the image, generating a scanpath "
         """ Input:
             Specifies the data of the image on which to run the visual search model. Fields:
                 image_name (string)         : name of the image
                 image_size (int, int)       : height and width of the image, respectively
                 image (2D array)            : grayscale search image of size image_size
-                image_prior (2D array)      : grayscale image with values between 0 and 1 that serves as prior
+                grid_prior (2D array)       : prior with values between 0 and 1, reduced to the grid, as returned by prior.load
                 target (2D array)           : grayscale target image
                 target_bbox (array)         : bounding box (upper left row, upper left column, lower right row, lower right column) of the target inside the search image
                 initial_fixation (int, int) : row and column of the first fixation on the search image
             Output:
                 image_scanpath   (dict)      : scanpath made by the model on the search image, alongside a 'target_found' field which indicates if the target was found
-                probability_maps (csv files) : if self.save_posterior is True, the posterior of each saccade is stored in a .csv file inside a folder in self.output_path 
+                                               and a 'timings' field with the seconds spent in each phase of the search, as described in utils.metrics
+                probability_maps (npz file)  : if self.save_posterior is True, the posterior of each saccade is stored in a .npz file of the image inside a folder in self.output_path
         """
+        return self.search_batch([(image_name, image_size, image, grid_prior, target, target_bbox, initial_fixation)])[0]
+
+    def search_batch(self, trials):
+        " Searches several images in lockstep. At each saccade, the next fixation of every trial whose target hasn't been found yet is computed at once "
+        " Trials are dropped from the batch as their targets are found. Each scanpath is the same as if its image had been searched on its own "
+        """ Input:
+                trials (list of tuples) : image_name, image_size, image, grid_prior, target, target_bbox and initial_fixation of each trial, as in search
+            Output:
+                images_scanpaths (list of dicts) : scanpath made by the model on each search image, as in search. It's empty if the trial couldn't be searched
+        """
+        images_scanpaths = [{} for _ in trials]
+        active_trials    = [trial for trial in (self.start_trial(index, *trial_args) for index, trial_args in enumerate(trials)) if trial is not None]
+        finished_trials  = []
+
+        # Search
+        print('Fixation:', end=' ')
+        for fixation_number in range(self.max_saccades + 1):
+            if not active_trials:
+                break
+            print(fixation_number + 1, end=' ')
+
+            searching_trials = []
+            for trial in active_trials:
+                current_fixation = trial.fixations[fixation_number]
+                if utils.are_within_boundaries(current_fixation, current_fixation, (trial.target_bbox_in_grid[0], trial.target_bbox_in_grid[1]), \
+                    (trial.target_bbox_in_grid[2] + 1, trial.target_bbox_in_grid[3] + 1)):
+                    trial.target_found = True
+                    trial.fixations    = trial.fixations[:fixation_number + 1]
+                # If the limit has been reached, don't compute the next fixation
+                elif fixation_number < self.max_saccades:
+                    self.update_posterior(trial, fixation_number)
+                    searching_trials.append(trial)
+                    continue
+                trial.time_elapsed = trial.search_time()
+                finished_trials.append(trial)
+            active_trials = searching_trials
+
+            if active_trials:
+                next_fixations_start = time.time()
+                next_fixations = self.search_model.next_fixations(np.array([trial.posterior for trial in active_trials]), [trial.model_state for trial in active_trials])
+                # The next fixations of the batch are computed at once, so each trial is attributed an equal share of the time
+                next_fixation_time = (time.time() - next_fixations_start) / len(active_trials)
+                for trial, next_fix in zip(active_trials, next_fixations):
+                    trial.fixations[fixation_number + 1] = next_fix
+                    trial.timings['next_fixation'].append(next_fixation_time)
+                    trial.update_statistics()
+        print()
+
+        for trial in sorted(finished_trials, key=lambda trial: trial.index):
+            images_scanpaths[trial.index] = self.finish_trial(trial, print_name=len(trials) > 1)
+        # Probability maps are written while searching, the batch is over once they're all stored
+        if self.save_posterior:
+            self.probability_maps_writer.wait()
+
+        if self.reference_searcher is not None:
+            print('Searching again in double precision, for validation')
+            reference_scanpaths = self.reference_searcher.search_batch(trials)
+            for image_scanpath, reference_scanpath in zip(images_scanpaths, reference_scanpaths):
+                if image_scanpath and reference_scanpath:
+                    self.report_divergence(image_scanpath, reference_scanpath)
+
+        return images_scanpaths
+
+    def start_trial(self, index, image_name, image_size, image, grid_prior, target, target_bbox, initial_fixation):
+        " Checks the data of the trial and initializes what's needed to search it. If something's wrong, it returns None "
         # Check if image size coincides with that of the dataset
         if not(image.shape[:2] == image_size):
             print(image_name + ': image size doesn\'t match dataset\'s dimensions')
-            return {}
+            return None
 
-        # Convert prior to grid
-        image_prior = self.grid.reduce(image_prior, mode='mean')
         grid_size   = self.grid.size()
         # Check prior dimensions
-        if not(image_prior.shape == grid_size):
+        if not(grid_prior.shape == grid_size):
             print(image_name + ': prior image\'s dimensions don\'t match dataset\'s dimensions')
-            return {}
+            return None
         # Sum probabilities
-        image_prior = prior.sum(image_prior, self.max_saccades)
+        grid_prior  = prior.sum(grid_prior, self.max_saccades).astype(self.dtype, copy=False)
       
         # Convert target bounding box to grid cells
         target_bbox_in_grid = np.empty(len(target_bbox), dtype=np.int)
@@ -70,85 +155,154 @@ class VisualSearcher:
         target_bbox_in_grid[2], target_bbox_in_grid[3] = self.grid.map_to_cell((target_bbox[2], target_bbox[3]))
         if not(utils.are_within_boundaries((target_bbox_in_grid[0], target_bbox_in_grid[1]), (target_bbox_in_grid[2], target_bbox_in_grid[3]), np.zeros(2), grid_size)):
             print(image_name + ': target bounding box is outside of the grid')
-            return {}
+            return None
         
         # Initialize fixations matrix
         fixations    = np.empty(shape=(self.max_saccades + 1, 2), dtype=int)
         fixations[0] = self.grid.map_to_cell(initial_fixation)
         if not(utils.are_within_boundaries(fixations[0], fixations[0], np.zeros(2), grid_size)):
             print(image_name + ': initial fixation falls off the grid')
-            return {}
+            return None
 
-        target_similarity_map = self.initialize_target_similarity_map(image, target, target_bbox)
+        target_similarity_start = time.time()
+        target_similarity_map   = self.initialize_target_similarity_map(image_name, image, target, target_bbox)
+        trial = Trial(index, image_name, grid_prior, target_bbox_in_grid, fixations, target_similarity_map, self.dtype)
+        trial.timings['target_similarity'] = time.time() - target_similarity_start
 
-        # Initialize variables for computing each fixation        
-        likelihood = np.zeros(shape=grid_size)
-        posterior  = np.zeros(shape=grid_size)
+        return trial
 
-        # Search
-        print('Fixation:', end=' ')
-        target_found = False
+    def update_posterior(self, trial, fixation_number):
+        " Adds the information of the current fixation of the trial to its likelihood and computes its posterior "
         start = time.time()
-        for fixation_number in range(self.max_saccades + 1):
-            current_fixation = fixations[fixation_number]
-            print(fixation_number + 1, end=' ')
-            
-            if utils.are_within_boundaries(current_fixation, current_fixation, (target_bbox_in_grid[0], target_bbox_in_grid[1]), (target_bbox_in_grid[2] + 1, target_bbox_in_grid[3] + 1)):
-                target_found = True
-                fixations = fixations[:fixation_number + 1]
-                break
-
-            # If the limit has been reached, don't compute the next fixation
-            if fixation_number == self.max_saccades:
-                break
-
-            if fixation_number == 0:
-                likelihood = target_similarity_map.at_fixation(current_fixation) * (np.square(self.visibility_map.at_fixation(current_fixation)))
-                likelihood_times_prior = image_prior * np.exp(likelihood)
-            else:
-                likelihood = likelihood + target_similarity_map.at_fixation(current_fixation) * (np.square(self.visibility_map.at_fixation(current_fixation)))
-                likelihood_times_prior = posterior * np.exp(likelihood)
-
-            marginal  = np.sum(likelihood_times_prior)
-            posterior = likelihood_times_prior / marginal
+        current_fixation = trial.fixations[fixation_number]
+        if fixation_number == 0:
+            trial.likelihood = trial.target_similarity_map.at_fixation(current_fixation) * (np.square(self.visibility_map.at_fixation(current_fixation)))
+            likelihood_times_prior = trial.grid_prior * np.exp(trial.likelihood)
+        else:
+            trial.likelihood = trial.likelihood + trial.target_similarity_map.at_fixation(current_fixation) * (np.square(self.visibility_map.at_fixation(current_fixation)))
+            likelihood_times_prior = trial.posterior * np.exp(trial.likelihood)
 
-            if self.save_posterior:
-                utils.save_probability_map(self.output_path, image_name, posterior, fixation_number)
+        marginal        = np.sum(likelihood_times_prior)
+        trial.posterior = likelihood_times_prior / marginal
+        trial.timings['likelihood_update'].append(time.time() - start)
 
-            fixations[fixation_number + 1] = self.search_model.next_fixation(posterior)
-            
-        end = time.time()
+        if self.save_posterior:
+            start = time.time()
+            # Maps are written in the background, so this is the time it takes to hand it to the writer
+            self.probability_maps_writer.save(trial.image_name, trial.posterior, fixation_number)
+            trial.timings['probability_map_saving'].append(time.time() - start)
 
-        if target_found:
-            print('\nTarget found!')
+    def finish_trial(self, trial, print_name):
+        " Prints the outcome of the search of the trial and returns its scanpath "
+        prefix = trial.image_name + ': ' if print_name else ''
+        if trial.target_found:
+            print(prefix + 'Target found!')
         else:
-            print('\nTarget NOT FOUND!')
-        print('Time elapsed: ' + str(end - start) + '\n')
+            print(prefix + 'Target NOT FOUND!')
+        if trial.max_dropped_posterior_mass > 0:
+            print('Max. posterior mass left out by pruning: ' + '{:.2e}'.format(trial.max_dropped_posterior_mass))
+        screening_counts = trial.screening_counts
+        if screening_counts['screened'] or screening_counts['fallback']:
+            print('Candidate screening: ' + str(screening_counts['screened']) + ' saccades screened, ' + str(screening_counts['fallback']) + ' fell back to every candidate')
+            if self.search_model.screening_validation:
+                print('Screened saccades whose fixation differs from the exhaustive search: ' + str(screening_counts['mismatches']))
+        print('Time elapsed: ' + str(trial.time_elapsed) + '\n')
 
         # Revert back to pixels
         # fixations = [self.grid.map_cell_to_pixels(fixation) for fixation in fixations]
 
         # Note: each x coordinate refers to a column in the image, and each y coordinate refers to a row in the image
-        scanpath_x_coordinates = self.get_coordinates(fixations, axis=1)
-        scanpath_y_coordinates = self.get_coordinates(fixations, axis=0)
+        scanpath_x_coordinates = self.get_coordinates(trial.fixations, axis=1)
+        scanpath_y_coordinates = self.get_coordinates(trial.fixations, axis=0)
+
+        trial.timings['search'] = trial.time_elapsed
+
+        return { 'target_found' : trial.target_found, 'scanpath_x' : scanpath_x_coordinates, 'scanpath_y' : scanpath_y_coordinates, 'timings' : trial.timings }
+
+    def report_divergence(self, image_scanpath, reference_scanpath):
+        " Prints the first fixation at which the scanpath differs from the one searched in double precision, if any "
+        fixations           = list(zip(image_scanpath['scanpath_y'], image_scanpath['scanpath_x']))
+        reference_fixations = list(zip(reference_scanpath['scanpath_y'], reference_scanpath['scanpath_x']))
+        if fixations == reference_fixations:
+            print('Scanpath in ' + str(self.dtype) + ' is the same as in float64\n')
+            return
+
+        first_difference = next((fix_number for fix_number, (fixation, reference_fixation) in enumerate(zip(fixations, reference_fixations)) \
+            if fixation != reference_fixation), min(len(fixations), len(reference_fixations)))
+        print('Scanpath in ' + str(self.dtype) + ' diverges from the one in float64 at fixation ' + str(first_difference + 1) + ' (' + str(len(fixations)) \
+            + ' fixations vs ' + str(len(reference_fixations)) + ', target ' + ('found' if image_scanpath['target_found'] else 'NOT found') + ' vs ' \
+            + ('found' if reference_scanpath['target_found'] else 'NOT found') + ')\n')
+
+    def close(self):
+        " Releases the resources held by the search model, such as its pool of processes, and writes the pending probability maps "
+        self.search_model.close()
+        if self.save_posterior:
+            self.probability_maps_writer.close()
+        if self.reference_searcher is not None:
+            self.reference_searcher.close()
 
-        return { 'target_found' : target_found, 'scanpath_x' : scanpath_x_coordinates, 'scanpath_y' : scanpath_y_coordinates }
-    
     def get_coordinates(self, fixations, axis):
         fixations_as_list = np.array(fixations).flatten()
 
         return [fixations_as_list[fix_number] for fix_number in range(axis, len(fixations_as_list), 2)]
 
-    def initialize_model(self, search_model, grid_size, visibility_map, norm_cdf_tolerance, number_of_processes):
-        if search_model == 'greedy':
+    def initialize_model(self, config, grid_size, visibility_map):
+        if config['search_model'] == 'greedy':
             return GreedyModel()
         else:
-            return BayesianModel(grid_size, visibility_map, norm_cdf_tolerance, number_of_processes)
+            return BayesianModel(grid_size, visibility_map, config['norm_cdf_tolerance'], config['proc_number'], config['engine'], \
+                config['quadrature'], config['quadrature_nodes'], config['quadrature_tolerance'], config['norm_cdf_backend'], \
+                config['posterior_pruning_epsilon'], config['candidate_screening'], config['screening_validation'], \
+                config['branch_and_bound'], config['precision'])
+
+    def initialize_reference_searcher(self, config, grid, visibility_map):
+        " When validating a lower precision, the same search is made in double precision, without saving its probability maps "
+        if not config['precision_validation'] or self.dtype == np.float64:
+            return None
+        reference_config = dict(config, precision='float64', precision_validation=False, save_probability_maps=False)
 
-    def initialize_target_similarity_map(self, image, target, target_bbox):
+        return VisualSearcher(reference_config, grid, visibility_map, output_path=None, target_similarity_dir=self.target_similarity_dir)
+
+    def initialize_target_similarity_map(self, image_name, image, target, target_bbox):
         # Load corresponding module
         module = importlib.import_module('.target_similarity.' + self.target_similarity_method.lower(), 'visualsearch')
         # Get the class
         target_similarity_class = getattr(module, self.target_similarity_method.capitalize())
-        target_similarity_map   = target_similarity_class(image, target, target_bbox, self.visibility_map, self.scale_factor, self.additive_shift, self.grid, self.seed)
+        # Each trial has its own seed, so that its scanpath doesn't depend on which trials were searched before it
+        trial_seed              = utils.get_trial_seed(self.seed, image_name)
+        target_similarity_map   = target_similarity_class(image, target, target_bbox, self.visibility_map, self.scale_factor, self.additive_shift, self.grid, trial_seed, \
+            self.target_similarity_dir)
         return target_similarity_map
+
+class Trial:
+    " State of the search of a trial: its likelihood and posterior, the fixations made so far and the statistics of the search model "
+    def __init__(self, index, image_name, grid_prior, target_bbox_in_grid, fixations, target_similarity_map, dtype):
+        self.index                 = index
+        self.image_name            = image_name
+        self.grid_prior            = grid_prior
+        self.target_bbox_in_grid   = target_bbox_in_grid
+        self.fixations             = fixations
+        self.target_similarity_map = target_similarity_map
+        self.target_found          = False
+        self.time_elapsed          = 0
+        self.likelihood            = np.zeros(shape=grid_prior.shape, dtype=dtype)
+        self.posterior             = np.zeros(shape=grid_prior.shape, dtype=dtype)
+        self.model_state           = TrialState()
+        # Bound on how much the probability of being correct at each fixation was underestimated, due to pruning
+        self.max_dropped_posterior_mass = 0
+        # Number of saccades by outcome of the candidate screening
+        self.screening_counts = {'screened' : 0, 'fallback' : 0, 'mismatches' : 0}
+        # Seconds spent in each phase of the search
+        self.timings = metrics.new_trial_timings()
+
+    def search_time(self):
+        " Seconds spent searching the trial, as the sum of the phases of its saccades. When searched in lockstep, it has an equal share of the next fixations of the batch "
+        return sum(sum(self.timings[phase]) for phase in metrics.SACCADE_PHASES)
+
+    def update_statistics(self):
+        " Adds the results of the last saccade of the search model to the statistics of the trial "
+        self.max_dropped_posterior_mass = max(self.max_dropped_posterior_mass, self.model_state.dropped_posterior_mass)
+        if self.model_state.screening_outcome is not None:
+            self.screening_counts[self.model_state.screening_outcome] += 1
+        if self.model_state.screening_mismatch:
+            self.screening_counts['mismatches'] += 1